@@ -10,16 +10,375 @@ Also extracts structured knowledge graph tags from each entry.
 
 import os
 import json
-import google.generativeai as genai
+import functools
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Iterator
 from dotenv import load_dotenv
 
+import prompt_builder
+import rate_limit
+import response_cache
+
 load_dotenv()
 
 # ── Model setup ───────────────────────────────────────────────────────────────
+#
+# The model comes from a pluggable backend: a factory
+# (api_key, model_name, system_instruction) -> model, where the model offers
+# the slice of google.generativeai.GenerativeModel used here (generate_content
+# and start_chat().send_message, both with stream=True). "gemini" is the real
+# API; "fake" is the offline stand-in in fake_gemini.py (no key or network,
+# deterministic, with optional latency and failure injection). Pick one with
+# AI_MEMORIES_MODEL_BACKEND; AI_MEMORIES_FAKE_MODEL=1 is a shortcut for "fake".
+
+BACKEND_ENV = "AI_MEMORIES_MODEL_BACKEND"
+FAKE_MODEL_ENV = "AI_MEMORIES_FAKE_MODEL"
+MODEL_NAME = "gemini-2.0-flash"
+CHAT_CACHE_SIZE = 64
+
+def _genai():
+    """
+    google.generativeai, imported on first model use: it drags in gRPC and
+    protobuf, which screens that never call the model (login, onboarding)
+    should not pay for.
+    """
+    import google.generativeai as genai
+    return genai
+
+
+@functools.lru_cache(maxsize=16)
+def _gemini_client(api_key: str):
+    """A GenerativeService client bound to one API key (clients are thread-safe and reused)."""
+    from google.ai import generativelanguage as glm
+    return glm.GenerativeServiceClient(client_options={"api_key": api_key})
+
+
+def _gemini_backend(api_key: str, model_name: str, system_instruction: str | None):
+    model = _genai().GenerativeModel(model_name, system_instruction=system_instruction)
+    # Left alone, the model builds its client on its first request from the
+    # process-wide genai.configure key, which by then may be another user's
+    model._client = _gemini_client(api_key)
+    return model
+
+
+def _fake_backend(api_key: str, model_name: str, system_instruction: str | None):
+    import fake_gemini
+    return fake_gemini.FakeGenerativeModel(model_name, system_instruction=system_instruction)
+
+
+_backends: dict[str, Callable] = {
+    "gemini": _gemini_backend,
+    "fake": _fake_backend,
+}
+
+
+def register_backend(name: str, factory: Callable):
+    """Make a model backend selectable by name (e.g. a pre-configured fake for benchmarks)."""
+    _backends[name] = factory
+    _load_model.cache_clear()
+
+
+def backend_name() -> str:
+    name = os.getenv(BACKEND_ENV) or ("fake" if os.getenv(FAKE_MODEL_ENV) else "gemini")
+    if name not in _backends:
+        raise ValueError(f"Unknown model backend {name!r} (known: {', '.join(_backends)})")
+    return name
+
+
+def _model_id() -> str:
+    """Name of the model actually answering (keeps fake responses out of real caches)."""
+    name = backend_name()
+    return MODEL_NAME if name == "gemini" else f"{name}:{MODEL_NAME}"
+
+
+def _get_model(api_key: str, system_instruction: str | None = None):
+    """One model per (backend, API key, system instruction), reused across reruns."""
+    return _load_model(backend_name(), api_key, system_instruction)
+
+
+@functools.lru_cache(maxsize=16)
+def _load_model(backend: str, api_key: str, system_instruction: str | None):
+    return _backends[backend](api_key, MODEL_NAME, system_instruction)
+
+
+# ── Rate limiting ─────────────────────────────────────────────────────────────
+#
+# Every model request goes through the API key's rate_limit.Limiter. Replies
+# the user is waiting for are INTERACTIVE; extraction and summaries are
+# BACKGROUND. An interactive request that hits the quota is retried once the
+# key's pause is over, as long as that pause is short; background requests
+# fail fast and are rescheduled by their caller (extraction job backoff).
+
+INTERACTIVE_RETRIES = 2
+MAX_RETRY_WAIT_S = 10.0
+
+
+def _retryable(exc: Exception, limiter: rate_limit.Limiter, priority: int, attempt: int) -> bool:
+    return (
+        priority == rate_limit.INTERACTIVE
+        and attempt < INTERACTIVE_RETRIES
+        and rate_limit.is_rate_limited(exc)
+        and limiter.blocked_for() <= MAX_RETRY_WAIT_S
+    )
+
+
+def _request(api_key: str, priority: int, send: Callable[[], str]) -> str:
+    """Run `send` (one model request, returning its text) under the key's rate limit."""
+    limiter = rate_limit.limiter(api_key)
+    for attempt in itertools.count():
+        try:
+            with limiter.slot(priority):
+                return send()
+        except Exception as e:
+            if not _retryable(e, limiter, priority, attempt):
+                raise
+
+
+# ── Live chat sessions ────────────────────────────────────────────────────────
+#
+# A conversation keeps its ChatSession between Streamlit reruns instead of
+# rebuilding it from st.session_state each turn. Sessions are keyed by
+# (api_key, conversation_id) and evicted least-recently-used. The per-turn
+# context block is stripped from the stored user turn after each reply, so the
+# live history holds exactly what the user and model said.
+
+class _LiveChat:
+    def __init__(self, model, chat, turns: list[tuple[str, str]]):
+        self.model = model
+        self.chat = chat
+        self.turns = turns      # (role, text) pairs mirrored in chat.history
+
+
+_chats: OrderedDict = OrderedDict()
+_chats_lock = threading.Lock()
+
+
+def _open_chat(model, api_key: str, conversation_id: str | None, history: list[dict]) -> _LiveChat:
+    """
+    Reuse the cached session when its turns end with `history` (dropping any
+    older turns the token budget no longer allows); otherwise start a new one.
+    """
+    turns = [(msg["role"], msg["content"]) for msg in history]
+    key = (api_key, conversation_id)
+
+    live = None
+    if conversation_id is not None:
+        with _chats_lock:
+            live = _chats.get(key)
+            if live is not None:
+                _chats.move_to_end(key)
+
+    if live is not None and live.model is model:
+        drop = len(live.turns) - len(turns)
+        if drop >= 0 and live.turns[drop:] == turns:
+            if drop:
+                live.chat.history = live.chat.history[drop:]
+                live.turns = turns
+            return live
+
+    chat = model.start_chat(history=[
+        {"role": role, "parts": [{"text": text}]} for role, text in turns
+    ])
+    live = _LiveChat(model, chat, turns)
+    if conversation_id is not None:
+        with _chats_lock:
+            _chats[key] = live
+            _chats.move_to_end(key)
+            while len(_chats) > CHAT_CACHE_SIZE:
+                _chats.popitem(last=False)
+    return live
+
+
+def _record_turn(live: _LiveChat, user_text: str, reply: str):
+    """Replace the context-laden message in the live history with the bare user text."""
+    history = list(live.chat.history)
+    history[-2] = {"role": "user", "parts": [{"text": user_text}]}
+    live.chat.history = history
+    live.turns = live.turns + [("user", user_text), ("model", reply)]
+
+
+def _forget_chat(api_key: str, conversation_id: str | None):
+    with _chats_lock:
+        _chats.pop((api_key, conversation_id), None)
+
+
+# ── Conversation memory ───────────────────────────────────────────────────────
+#
+# Turns older than the last few are folded into a running summary once the
+# unsummarized part of a conversation passes SUMMARY_TRIGGER_TOKENS. The fold
+# runs on a background thread after a reply is delivered, so the next message
+# never waits for it; until it lands, that message simply goes out with the
+# previous summary and a few more verbatim turns.
+
+SUMMARY_TRIGGER_TOKENS = 1200
+SUMMARY_KEEP_TURNS = 6          # messages (3 exchanges) always sent verbatim
+SUMMARY_MAX_TOKENS = 400
+
+SUMMARY_PROMPT = """
+You maintain the running summary of a conversation between a user and their diary assistant.
+Merge the new messages into the previous summary. Keep names, places, feelings, plans and
+anything the user asked to remember; drop greetings and filler. Write in the same language
+as the conversation, in the third person ("the user…"), at most {max_words} words.
+Return only the summary text.
+
+Previous summary:
+{summary}
+
+New messages:
+{messages}
+"""
+
+_summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="chat-summary")
+
+
+class ConversationMemory:
+    """Running summary of the oldest `covered` messages of one conversation."""
+
+    def __init__(self):
+        self.summary = ""
+        self.covered = 0
+        self._last = None       # history[covered - 1], to notice a history that was replaced
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def view(self, history: list[dict]) -> tuple[str, list[dict]]:
+        """(summary, messages it does not cover) for the full conversation `history`."""
+        with self._lock:
+            if self.covered and (self.covered > len(history) or history[self.covered - 1] != self._last):
+                self.summary, self.covered, self._last = "", 0, None
+            return self.summary, history[self.covered:]
+
+    def after_turn(self, api_key: str, history: list[dict]):
+        """Schedule folding older turns into the summary if the verbatim part grew too long."""
+        summary, recent = self.view(history)
+        fold = len(recent) - SUMMARY_KEEP_TURNS
+        fold -= fold % 2        # keep the verbatim part starting on a user turn
+        if fold <= 0 or sum(prompt_builder.estimate_tokens(m["content"]) + 4 for m in recent) \
+                <= SUMMARY_TRIGGER_TOKENS:
+            return
+        with self._lock:
+            if self._pending is not None and not self._pending.done():
+                return
+            start = self.covered
+            self._pending = _summary_executor.submit(
+                self._fold, api_key, summary, start, history[:start + fold]
+            )
+
+    def _fold(self, api_key: str, summary: str, start: int, history: list[dict]):
+        try:
+            new_summary = summarize_messages(api_key, summary, history[start:])
+        except Exception:
+            return      # left as it was; retried after the next turn
+        with self._lock:
+            if self.covered == start:
+                self.summary, self.covered, self._last = new_summary, len(history), history[-1]
+
+    def wait(self, timeout: float | None = None):
+        """Block until a scheduled fold has finished (benchmarks and scripts)."""
+        pending = self._pending
+        if pending is not None:
+            pending.exception(timeout)
+
+
+_memories: OrderedDict = OrderedDict()
+_memories_lock = threading.Lock()
+
+
+def conversation_memory(api_key: str, conversation_id: str | None) -> ConversationMemory | None:
+    """The memory of one conversation; None for one-off requests without a conversation_id."""
+    if conversation_id is None:
+        return None
+    key = (api_key, conversation_id)
+    with _memories_lock:
+        memory = _memories.get(key)
+        if memory is None:
+            memory = _memories[key] = ConversationMemory()
+        _memories.move_to_end(key)
+        while len(_memories) > CHAT_CACHE_SIZE:
+            _memories.popitem(last=False)
+    return memory
+
+
+def summarize_messages(api_key: str, summary: str, messages: list[dict]) -> str:
+    """Fold `messages` into `summary` with one model call."""
+    lines = "\n".join(
+        f"{'User' if m['role'] == 'user' else 'Assistant'}: {m['content']}" for m in messages
+    )
+    prompt = SUMMARY_PROMPT.format(
+        max_words=SUMMARY_MAX_TOKENS * 3 // 4, summary=summary or "(none yet)", messages=lines
+    )
+    text = _request(api_key, rate_limit.BACKGROUND,
+                    lambda: _get_model(api_key).generate_content(prompt).text).strip()
+    return prompt_builder.truncate_to_tokens(text, SUMMARY_MAX_TOKENS)
+
+
+def _split_history(api_key: str, conversation_id: str | None,
+                   history: list[dict]) -> tuple[str, list[dict]]:
+    memory = conversation_memory(api_key, conversation_id)
+    return memory.view(history) if memory is not None else ("", history)
+
+
+def _remember_turn(api_key: str, conversation_id: str | None, history: list[dict],
+                   user_text: str, reply: str):
+    memory = conversation_memory(api_key, conversation_id)
+    if memory is not None:
+        memory.after_turn(api_key, history + [
+            {"role": "user", "content": user_text}, {"role": "model", "content": reply},
+        ])
+
+
+def _send(live: _LiveChat, api_key: str, conversation_id, message: str, user_text: str) -> str:
+    try:
+        reply = _request(api_key, rate_limit.INTERACTIVE, lambda: live.chat.send_message(message).text)
+        _record_turn(live, user_text, reply)
+    except Exception:
+        _forget_chat(api_key, conversation_id)
+        raise
+    return reply
 
-def _get_model(api_key: str):
-    genai.configure(api_key=api_key)
-    return genai.GenerativeModel("gemini-2.0-flash")
+
+def _send_stream(live: _LiveChat, api_key: str, conversation_id, message: str,
+                 user_text: str) -> Iterator[str]:
+    """Yield the reply chunk by chunk; the generator's return value is the whole reply."""
+    limiter = rate_limit.limiter(api_key)
+    parts = []
+    try:
+        for attempt in itertools.count():
+            response = None
+            try:
+                # The slot is held until the last chunk has arrived
+                with limiter.slot(rate_limit.INTERACTIVE):
+                    response = live.chat.send_message(message, stream=True)
+                    for text in _stream_text(response):
+                        parts.append(text)
+                        yield text
+                break
+            except Exception as e:
+                # Only a request that never started may be resent on the same session
+                if response is not None or not _retryable(e, limiter, rate_limit.INTERACTIVE, attempt):
+                    raise
+        reply = "".join(parts)
+        _record_turn(live, user_text, reply)
+    except BaseException:
+        # Includes GeneratorExit: a half-read stream leaves the session inconsistent
+        _forget_chat(api_key, conversation_id)
+        raise
+    return reply
+
+
+def _stream_text(response) -> Iterator[str]:
+    """Yield the text of each streamed chunk as soon as it arrives."""
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            continue    # chunk without text parts (e.g. the final finish_reason chunk)
+        if text:
+            yield text
 
 
 # ── Onboarding Q&A ────────────────────────────────────────────────────────────
@@ -76,41 +435,87 @@ Do not give unsolicited advice. Mirror and reflect; don't prescribe.
 Respond in the same language the user writes in.
 """
 
-def get_journaling_response(
+def _journaling_chat(
     api_key: str,
     user_entry: str,
     profile: dict,
     conversation_history: list[dict],
-    knowledge_summary: str,
-) -> str:
-    model = _get_model(api_key)
-
-    profile_context = ""
+    knowledge_items: list[dict],
+    related_entries: list[dict] | None = None,
+    conversation_id: str | None = None,
+) -> tuple[_LiveChat, str]:
+    """Open the chat session and build the outgoing message for a journaling turn."""
+    model = _get_model(api_key, JOURNALING_SYSTEM_PROMPT)
+
+    profile_text = ""
     if profile:
-        profile_context = f"""
-The user's profile baseline:
-- Name / Life stage: {profile.get('name_and_life_stage', 'Unknown')}
-- Foundational memory: {profile.get('foundational_memory', 'Unknown')}
-- Linguistic style: {profile.get('linguistic_style', 'Unknown')}
-"""
+        profile_text = (
+            f"- Name / Life stage: {profile.get('name_and_life_stage', 'Unknown')}\n"
+            f"- Foundational memory: {profile.get('foundational_memory', 'Unknown')}\n"
+            f"- Linguistic style: {profile.get('linguistic_style', 'Unknown')}"
+        )
+
+    summary, recent = _split_history(api_key, conversation_id, conversation_history)
+    ctx = prompt_builder.build_context(
+        profile_text=profile_text,
+        knowledge_items=knowledge_items,
+        entries=related_entries or [],
+        history=recent,
+        history_summary=summary,
+    )
+
+    # The system prompt travels once as system_instruction; only the context
+    # that changes between turns is sent with the message.
+    context = ""
+    if ctx["profile"]:
+        context += f"The user's profile baseline:\n{ctx['profile']}\n"
+    if ctx["knowledge"]:
+        context += f"\nKnowledge graph (accumulated memories):\n{ctx['knowledge']}\n"
+    if ctx["entries"]:
+        context += f"\nPast entries related to this one:\n{ctx['entries']}\n"
+    if ctx["history_summary"]:
+        context += f"\nEarlier in this conversation (summary):\n{ctx['history_summary']}\n"
 
-    knowledge_context = f"\nKnowledge graph (accumulated memories):\n{knowledge_summary}" if knowledge_summary else ""
+    # Multi-turn history, trimmed to its token budget (newest turns kept)
+    live = _open_chat(model, api_key, conversation_id, ctx["history"])
+    message = f"{context}\n---\nUser's journal entry:\n{user_entry}"
+    return live, message
 
-    system = JOURNALING_SYSTEM_PROMPT + profile_context + knowledge_context
 
-    # Build history for multi-turn conversation
-    history = []
-    for msg in conversation_history[-10:]:  # Keep last 10 turns for context
-        history.append({
-            "role": msg["role"],
-            "parts": [{"text": msg["content"]}]
-        })
+def get_journaling_response(
+    api_key: str,
+    user_entry: str,
+    profile: dict,
+    conversation_history: list[dict],
+    knowledge_items: list[dict],
+    related_entries: list[dict] | None = None,
+    conversation_id: str | None = None,
+) -> str:
+    live, message = _journaling_chat(
+        api_key, user_entry, profile, conversation_history, knowledge_items, related_entries,
+        conversation_id,
+    )
+    reply = _send(live, api_key, conversation_id, message, user_entry)
+    _remember_turn(api_key, conversation_id, conversation_history, user_entry, reply)
+    return reply
+
 
-    chat = model.start_chat(history=history)
-    response = chat.send_message(
-        [{"text": f"{system}\n\n---\nUser's journal entry:\n{user_entry}"}]
+def stream_journaling_response(
+    api_key: str,
+    user_entry: str,
+    profile: dict,
+    conversation_history: list[dict],
+    knowledge_items: list[dict],
+    related_entries: list[dict] | None = None,
+    conversation_id: str | None = None,
+) -> Iterator[str]:
+    """Like get_journaling_response, but yields the margin note chunk by chunk."""
+    live, message = _journaling_chat(
+        api_key, user_entry, profile, conversation_history, knowledge_items, related_entries,
+        conversation_id,
     )
-    return response.text
+    reply = yield from _send_stream(live, api_key, conversation_id, message, user_entry)
+    _remember_turn(api_key, conversation_id, conversation_history, user_entry, reply)
 
 
 # ── Past Self Mode ────────────────────────────────────────────────────────────
@@ -125,46 +530,100 @@ If asked something you don't have data for, say so honestly: "I don't think I wr
 Respond in the same language the user writes in.
 """
 
-def get_past_self_response(
+def _past_self_chat(
     api_key: str,
     user_message: str,
     profile: dict,
-    knowledge_summary: str,
-    all_entries: list[dict],
+    knowledge_items: list[dict],
+    context_entries: list[dict],
     conversation_history: list[dict],
-) -> str:
-    model = _get_model(api_key)
-
-    # Compile recent journal entries for context
-    recent_entries = "\n\n".join(
-        [f"[{e['created_at'][:10]}]: {e['content']}" for e in all_entries[-20:]]
-    )
-
-    profile_str = (
+    related_entries: list[dict] | None = None,
+    conversation_id: str | None = None,
+    as_of: str | None = None,
+) -> tuple[_LiveChat, str]:
+    """
+    Open the chat session and build the outgoing message for a Past Self turn.
+    `as_of` (an ISO date) is the day the past self lives in; the caller passes
+    knowledge and entries already limited to it.
+    """
+    model = _get_model(api_key, PAST_SELF_SYSTEM_PROMPT)
+
+    profile_text = (
         f"Name/Life stage: {profile.get('name_and_life_stage', '?')}\n"
         f"Foundational memory: {profile.get('foundational_memory', '?')}\n"
         f"Linguistic style: {profile.get('linguistic_style', '?')}"
     )
 
-    system = (
-        PAST_SELF_SYSTEM_PROMPT
-        + f"\n\nProfile baseline:\n{profile_str}"
-        + f"\n\nKnowledge graph:\n{knowledge_summary}"
-        + f"\n\nJournal entries (most recent 20):\n{recent_entries}"
+    # Retrieved entries first (ranked for this question), then related memories
+    seen = {e["id"] for e in context_entries if "id" in e}
+    entries = list(context_entries) + [
+        e for e in (related_entries or []) if e.get("id") not in seen
+    ]
+
+    summary, recent = _split_history(api_key, conversation_id, conversation_history)
+    ctx = prompt_builder.build_context(
+        profile_text=profile_text,
+        knowledge_items=knowledge_items,
+        entries=entries,
+        history=recent,
+        history_summary=summary,
+        now=datetime.fromisoformat(as_of[:10]) if as_of else None,
+    )
+
+    context = (
+        f"Profile baseline:\n{ctx['profile']}"
+        + f"\n\nKnowledge graph:\n{ctx['knowledge']}"
+        + f"\n\nJournal entries (most relevant to this conversation):\n{ctx['entries']}"
+    )
+    if as_of:
+        context = (f"Today is {as_of[:10]} for you: you have not lived, or written, "
+                   f"anything after that date.\n\n") + context
+    if ctx["history_summary"]:
+        context += f"\n\nEarlier in this conversation (summary):\n{ctx['history_summary']}"
+
+    live = _open_chat(model, api_key, conversation_id, ctx["history"])
+    message = f"{context}\n\n---\nUser says: {user_message}"
+    return live, message
+
+
+def get_past_self_response(
+    api_key: str,
+    user_message: str,
+    profile: dict,
+    knowledge_items: list[dict],
+    context_entries: list[dict],
+    conversation_history: list[dict],
+    related_entries: list[dict] | None = None,
+    conversation_id: str | None = None,
+    as_of: str | None = None,
+) -> str:
+    live, message = _past_self_chat(
+        api_key, user_message, profile, knowledge_items, context_entries, conversation_history,
+        related_entries, conversation_id, as_of,
     )
+    reply = _send(live, api_key, conversation_id, message, user_message)
+    _remember_turn(api_key, conversation_id, conversation_history, user_message, reply)
+    return reply
 
-    history = []
-    for msg in conversation_history[-10:]:
-        history.append({
-            "role": msg["role"],
-            "parts": [{"text": msg["content"]}]
-        })
 
-    chat = model.start_chat(history=history)
-    response = chat.send_message(
-        [{"text": f"{system}\n\n---\nUser says: {user_message}"}]
+def stream_past_self_response(
+    api_key: str,
+    user_message: str,
+    profile: dict,
+    knowledge_items: list[dict],
+    context_entries: list[dict],
+    conversation_history: list[dict],
+    related_entries: list[dict] | None = None,
+    conversation_id: str | None = None,
+    as_of: str | None = None,
+) -> Iterator[str]:
+    """Like get_past_self_response, but yields the reply chunk by chunk."""
+    live, message = _past_self_chat(
+        api_key, user_message, profile, knowledge_items, context_entries, conversation_history,
+        related_entries, conversation_id, as_of,
     )
-    return response.text
+    reply = yield from _send_stream(live, api_key, conversation_id, message, user_message)
+    _remember_turn(api_key, conversation_id, conversation_history, user_message, reply)
 
 
 # ── Knowledge Graph Extraction ────────────────────────────────────────────────
@@ -189,18 +648,168 @@ Format:
 Journal entry:
 """
 
-def extract_knowledge_tags(api_key: str, entry: str) -> list[dict]:
-    """Extract structured knowledge graph tags from a journal entry."""
+# Part of the response-cache key: editing the prompt invalidates cached tags.
+EXTRACTION_PROMPT_VERSION = response_cache.prompt_version(EXTRACTION_PROMPT)
+
+BATCH_EXTRACTION_PROMPT = """
+You are a silent data structuring engine. Below are several journal entries, each starting
+with a line "### Entry <id>". Extract structured tags from every entry separately.
+Return ONLY a valid JSON object mapping each entry id (as a string) to its array of tags.
+No markdown, no explanation. Include every id, with [] if an entry has nothing to tag.
+
+Tag types to use:
+- "Event": A specific occurrence (with or without explicit date)
+- "Entity": A person, pet, place, or organization mentioned
+- "Sentiment/Trigger": An emotion expressed and what triggered it
+- "Core Belief": A value, opinion, or life philosophy stated or implied
+- "Syntax": A distinctive phrase, word, or tone pattern used by the writer
+
+Format:
+{
+  "12": [{"type": "Event", "value": "..."}, {"type": "Entity", "value": "..."}],
+  "13": []
+}
+
+Journal entries:
+"""
+
+# Batch sizing: entry text per request is capped at BATCH_TOKEN_BUDGET (the
+# JSON answer grows with it and must fit the model's output limit).
+BATCH_TOKEN_BUDGET = 4000
+BATCH_MAX_ENTRIES = 20
+
+
+def _parse_json(raw: str):
+    """json.loads, tolerating the markdown code fences models like to add."""
+    raw = raw.strip()
+    if raw.startswith("```"):
+        raw = raw.split("```")[1]
+        if raw.startswith("json"):
+            raw = raw[4:]
+    return json.loads(raw)
+
+
+def _clean_tags(tags) -> list[dict]:
+    """The model's tags as {"type": str, "value": str} dicts; anything else in the answer is dropped."""
+    if not isinstance(tags, list):
+        return []
+    return [
+        {"type": str(t["type"]), "value": str(t["value"])}
+        for t in tags
+        if isinstance(t, dict) and t.get("type") and t.get("value")
+    ]
+
+
+def extract_knowledge_tags(
+    api_key: str, entry: str, raise_errors: bool = False, username: str | None = None
+) -> list[dict]:
+    """
+    Extract structured knowledge graph tags from a journal entry of `username`'s
+    diary (whose response cache is used). By default any failure yields [];
+    with raise_errors=True API and parse errors propagate so a caller (the
+    extraction worker) can retry.
+    """
     try:
+        key = response_cache.make_key(_model_id(), EXTRACTION_PROMPT_VERSION, entry)
+        cached = response_cache.get(key, username)
+        if cached is not None:
+            return _clean_tags(json.loads(cached))
+
         model = _get_model(api_key)
-        response = model.generate_content(EXTRACTION_PROMPT + entry)
-        raw = response.text.strip()
-        # Strip markdown code fences if present
-        if raw.startswith("```"):
-            raw = raw.split("```")[1]
-            if raw.startswith("json"):
-                raw = raw[4:]
-        tags = json.loads(raw)
-        return tags if isinstance(tags, list) else []
+        text = _request(api_key, rate_limit.BACKGROUND,
+                        lambda: model.generate_content(EXTRACTION_PROMPT + entry).text)
+        tags = _clean_tags(_parse_json(text))
+        response_cache.put(key, json.dumps(tags, ensure_ascii=False), username)
+        return tags
     except Exception:
+        if raise_errors:
+            raise
         return []
+
+
+def plan_extraction_batches(
+    entries: list[tuple[int, str]],
+    token_budget: int = BATCH_TOKEN_BUDGET,
+    max_entries: int = BATCH_MAX_ENTRIES,
+) -> list[list[tuple[int, str]]]:
+    """Group (entry_id, text) pairs, in order, into batches that fit the token budget.
+    An entry larger than the whole budget travels alone."""
+    batches, current, used = [], [], 0
+    for entry_id, text in entries:
+        cost = prompt_builder.estimate_tokens(text) + 8      # + "### Entry <id>" header
+        if current and (used + cost > token_budget or len(current) >= max_entries):
+            batches.append(current)
+            current, used = [], 0
+        current.append((entry_id, text))
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _extract_batch(api_key: str, batch: list[tuple[int, str]]) -> dict[int, list[dict]]:
+    """One model call for the whole batch; returns the entries answered with a tag list, cleaned."""
+    body = "\n\n".join(f"### Entry {entry_id}\n{text}" for entry_id, text in batch)
+    text = _request(api_key, rate_limit.BACKGROUND,
+                    lambda: _get_model(api_key).generate_content(BATCH_EXTRACTION_PROMPT + body).text)
+    try:
+        parsed = _parse_json(text)
+    except ValueError:
+        return {}
+    if not isinstance(parsed, dict):
+        return {}
+    results = {}
+    for entry_id, _ in batch:
+        tags = parsed.get(str(entry_id))
+        if isinstance(tags, list):
+            results[entry_id] = _clean_tags(tags)
+    return results
+
+
+def extract_knowledge_tags_batch(
+    api_key: str, entries: list[tuple[int, str]], username: str | None = None
+) -> tuple[dict[int, list[dict]], dict[int, str]]:
+    """
+    Extract tags for many (entry_id, text) pairs of `username`'s diary with as
+    few model calls as possible. Entries in the diary's response cache cost
+    nothing; the rest are packed into batches by plan_extraction_batches.
+    Entries missing or malformed in a batch answer are retried one by one with
+    extract_knowledge_tags.
+    Returns (tags by entry_id, error message by entry_id) — every id lands in
+    exactly one of the two, so a caller can complete or reschedule each job.
+    """
+    results: dict[int, list[dict]] = {}
+    errors: dict[int, str] = {}
+    model_id = _model_id()
+    keys = {entry_id: response_cache.make_key(model_id, EXTRACTION_PROMPT_VERSION, text)
+            for entry_id, text in entries}
+
+    todo = []
+    for entry_id, text in entries:
+        cached = response_cache.get(keys[entry_id], username)
+        if cached is not None:
+            results[entry_id] = _clean_tags(json.loads(cached))
+        else:
+            todo.append((entry_id, text))
+
+    for batch in plan_extraction_batches(todo):
+        if len(batch) > 1:
+            try:
+                answered = _extract_batch(api_key, batch)
+            except Exception as e:
+                # The request itself failed (quota, network): retrying each entry
+                # separately would only repeat the failure N times.
+                for entry_id, _ in batch:
+                    errors[entry_id] = f"{type(e).__name__}: {e}"
+                continue
+            for entry_id, tags in answered.items():
+                response_cache.put(keys[entry_id], json.dumps(tags, ensure_ascii=False), username)
+            results.update(answered)
+        for entry_id, text in batch:
+            if entry_id in results:
+                continue
+            try:
+                results[entry_id] = extract_knowledge_tags(api_key, text, raise_errors=True, username=username)
+            except Exception as e:
+                errors[entry_id] = f"{type(e).__name__}: {e}"
+    return results, errors
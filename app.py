@@ -9,13 +9,18 @@ Run with:  streamlit run app.py
 
 import streamlit as st
 import os
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
 import memories_db as db
 import ai_engine as ai
+import rate_limit
+import tag_worker
+import telemetry
 
 load_dotenv()
+telemetry.enable_from_env()
 
 # ── Page config ───────────────────────────────────────────────────────────────
 
@@ -214,18 +219,33 @@ if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
 if "past_self_history" not in st.session_state:
     st.session_state.past_self_history = []
+# Date the Past Self lives in (None: the whole diary)
+if "past_self_date" not in st.session_state:
+    st.session_state.past_self_date = None
 if "consent_given" not in st.session_state:
     st.session_state.consent_given = False
+# Keys for the live chat sessions ai_engine keeps between reruns
+if "conversation_id" not in st.session_state:
+    st.session_state.conversation_id = uuid.uuid4().hex
+if "past_self_conversation_id" not in st.session_state:
+    st.session_state.past_self_conversation_id = uuid.uuid4().hex
+# Timing records of the latest reruns, for the debug panel
+if "telemetry_runs" not in st.session_state:
+    st.session_state.telemetry_runs = []
+st.session_state.telemetry_runs = (
+    st.session_state.telemetry_runs + [telemetry.begin_rerun(st.session_state.phase)]
+)[-2:]
 
 
 def _advance_after_login(username: str):
     """Decide which phase to go to after successful login."""
     st.session_state.current_user = username
-    st.session_state.consent_given = db.profile_is_complete()
+    db.adopt_legacy_diary(username)
+    st.session_state.consent_given = db.profile_is_complete(username)
 
     if not db.user_has_quick_profile(username):
         st.session_state.phase = "quick_profile"
-    elif db.profile_is_complete():
+    elif db.profile_is_complete(username):
         st.session_state.phase = "journaling"
     else:
         st.session_state.phase = "onboarding"
@@ -249,11 +269,12 @@ with st.sidebar:
 
     st.markdown("---")
 
-    entry_count = db.get_entry_count()
+    username = st.session_state.current_user
+    sidebar = db.get_sidebar_summary(username=username) if username else None
+    entry_count = sidebar["entries"] if sidebar else 0
     st.markdown(f"**📝 Entradas:** {entry_count}")
 
-    if st.session_state.current_user:
-        username = st.session_state.current_user
+    if username:
         qp = db.get_quick_profile(username)
         alias = qp.get("alias") or username
         st.markdown(f"**👤 «{alias}»**")
@@ -269,24 +290,41 @@ with st.sidebar:
                 else:
                     st.session_state.phase = "past_self"
                     st.session_state.past_self_history = []
+                    st.session_state.past_self_conversation_id = uuid.uuid4().hex
+                    st.session_state.past_self_date = None
+                    st.rerun()
+            if st.button("📈 Línea de tiempo", use_container_width=True):
+                if entry_count == 0:
+                    st.warning("Escribe al menos una entrada primero.")
+                else:
+                    st.session_state.phase = "timeline"
                     st.rerun()
 
-        elif st.session_state.phase == "past_self":
+        elif st.session_state.phase in ("past_self", "timeline"):
             if st.button("📖 Volver al Diario", use_container_width=True):
                 st.session_state.phase = "journaling"
                 st.rerun()
 
+        # Tag extraction queue: restart draining after a crash, show backlog
+        jobs = db.get_extraction_status(username)
+        if api_key and (jobs["pending"] or jobs["running"]):
+            tag_worker.ensure_started(api_key, username)
+        if jobs["pending"] or jobs["running"]:
+            retrying = f" · {jobs['retrying']} reintentando" if jobs["retrying"] else ""
+            st.markdown(
+                f'<small style="color:#8a7a58">🏷️ Etiquetando '
+                f'{jobs["pending"] + jobs["running"]} entrada(s){retrying}</small>',
+                unsafe_allow_html=True
+            )
+
         # Knowledge graph summary
         if entry_count > 0:
             st.markdown("---")
             st.markdown("**🧠 Memoria**")
-            tags = db.get_all_tags()
-            tag_types = list(set(t["tag_type"] for t in tags))
-            for tt in tag_types:
-                vals = [t["tag_value"] for t in tags if t["tag_type"] == tt][:3]
-                preview = ", ".join(vals)
+            for tt in sidebar["tag_types"]:
+                preview = ", ".join(tt["preview"])
                 st.markdown(
-                    f'<span class="tag-pill">{tt}</span> <small style="color:#8a7a58">{preview[:50]}</small>',
+                    f'<span class="tag-pill">{tt["tag_type"]}</span> <small style="color:#8a7a58">{preview[:50]}</small>',
                     unsafe_allow_html=True
                 )
 
@@ -304,6 +342,88 @@ with st.sidebar:
         unsafe_allow_html=True
     )
 
+    # Debug panel: filled at the end of the script, once this rerun's work is done
+    # Only shows or hides this session's panel; instrumentation itself is
+    # process-wide and switched on with AI_MEMORIES_TELEMETRY (enable_from_env)
+    if st.checkbox("🔧 Panel de depuración", value=False, key="debug_panel"):
+        debug_slot = st.empty()
+    else:
+        debug_slot = None
+
+
+def _render_debug_panel(slot):
+    """Per-rerun breakdown: top-level spans, SQL statements and prompt token sizes."""
+    with slot.container():
+        api_key = st.session_state.get("api_key_input", "")
+        if api_key:
+            quota = rate_limit.limiter(api_key).stats()
+            st.markdown(
+                f'<small>Cuota API: {quota["current_rpm"]:g}/{quota["rpm"]:g} pet./min · '
+                f'{quota["active"]} en curso · {quota["waiting"]} en cola · '
+                f'{quota["throttled"]} rechazadas</small>',
+                unsafe_allow_html=True
+            )
+        if not telemetry.enabled:
+            st.caption("Tiempos desactivados: arranca la app con AI_MEMORIES_TELEMETRY=1 para verlos.")
+            return
+        for run in reversed(st.session_state.telemetry_runs):
+            st.markdown(
+                f'<small><b>{run.label}</b> · {run.total_ms():.1f} ms · '
+                f'{run.queries} consultas SQL</small>',
+                unsafe_allow_html=True
+            )
+            tokens = run.notes.get("prompt_tokens")
+            if tokens:
+                st.markdown(
+                    f'<small>Tokens del prompt: perfil {tokens["profile"]} · '
+                    f'memoria {tokens["knowledge"]} · entradas {tokens["entries"]} · '
+                    f'historial {tokens["history"]} (de {tokens["budget"]})</small>',
+                    unsafe_allow_html=True
+                )
+            rows = run.breakdown(top_level_only=True)[:8]
+            if rows:
+                st.markdown(
+                    "| Tramo | Llamadas | ms |\n|---|---:|---:|\n"
+                    + "\n".join(f"| `{r['span']}` | {r['calls']} | {r['ms']:.1f} |" for r in rows)
+                )
+
+
+def _render_stream(chunks, css_class: str, spinner_text: str) -> str:
+    """
+    Render a streamed model reply into a bubble as it arrives and return the
+    full text. The spinner only covers the wait for the first chunk.
+    """
+    placeholder = st.empty()
+    text = ""
+    try:
+        with st.spinner(spinner_text):
+            text = next(chunks, "")
+        placeholder.markdown(f'<div class="{css_class}">{text}▌</div>', unsafe_allow_html=True)
+        for chunk in chunks:
+            text += chunk
+            placeholder.markdown(f'<div class="{css_class}">{text}▌</div>', unsafe_allow_html=True)
+    except Exception as e:
+        text += f"*(Algo salió mal: {e})*"
+    placeholder.markdown(f'<div class="{css_class}">{text}</div>', unsafe_allow_html=True)
+    return text
+
+
+VISIBLE_MESSAGES = 20
+
+
+def _render_history(history: list[dict], ai_class: str):
+    """
+    Render the last VISIBLE_MESSAGES bubbles of a conversation. Older turns stay
+    in session state (the model sees them through ai_engine's running summary);
+    they are just not redrawn on every rerun.
+    """
+    hidden = max(0, len(history) - VISIBLE_MESSAGES)
+    if hidden:
+        st.caption(f"… {hidden} mensajes anteriores en esta conversación")
+    for msg in history[hidden:]:
+        css_class = "user-bubble" if msg["role"] == "user" else ai_class
+        st.markdown(f'<div class="{css_class}">{msg["content"]}</div>', unsafe_allow_html=True)
+
 
 # ── PHASE 0: Login / Register ─────────────────────────────────────────────────
 
@@ -337,14 +457,14 @@ def render_login():
 
     if submit_named:
         raw = username_input.strip()
-        uname = raw if raw else "invitado"
+        uname = raw if raw else db.GUEST_USERNAME
         db.create_user(uname)
         _advance_after_login(uname)
         st.rerun()
 
     if submit_guest:
-        db.create_user("invitado")
-        _advance_after_login("invitado")
+        db.create_user(db.GUEST_USERNAME)
+        _advance_after_login(db.GUEST_USERNAME)
         st.rerun()
 
     st.markdown(
@@ -358,7 +478,7 @@ def render_login():
 # ── PHASE 0.5: Quick Profile (first time only) ────────────────────────────────
 
 def render_quick_profile():
-    username = st.session_state.current_user or "invitado"
+    username = st.session_state.current_user or db.GUEST_USERNAME
     st.markdown("# 📖 Antes de empezar…")
     st.markdown("*Cuéntame un poco sobre ti para que el diario te conozca desde el primer día.*")
     st.markdown("---")
@@ -401,7 +521,7 @@ def render_quick_profile():
             foco=foco.strip() or "Sin respuesta",
         )
         # Advance to onboarding or journaling
-        if db.profile_is_complete():
+        if db.profile_is_complete(username):
             st.session_state.phase = "journaling"
         else:
             st.session_state.phase = "onboarding"
@@ -412,6 +532,7 @@ def render_quick_profile():
 # ── PHASE 1: Onboarding ───────────────────────────────────────────────────────
 
 def render_onboarding():
+    username = st.session_state.current_user or db.GUEST_USERNAME
     st.markdown("# 📖 AI of Memories")
     st.markdown("*Tu cápsula del tiempo personal.*")
     st.markdown("---")
@@ -438,7 +559,7 @@ def render_onboarding():
         )
         if consent:
             st.session_state.consent_given = True
-            db.set_profile("consent", "true")
+            db.set_profile("consent", "true", username)
             st.rerun()
         return
 
@@ -447,7 +568,7 @@ def render_onboarding():
     step = st.session_state.onboarding_step
 
     if step >= len(questions):
-        db.set_profile("onboarding_complete", "true")
+        db.set_profile("onboarding_complete", "true", username)
         st.session_state.phase = "journaling"
         st.session_state.chat_history = []
         st.rerun()
@@ -459,7 +580,7 @@ def render_onboarding():
     for i in range(step):
         prev_q = questions[i]
         st.markdown(f'<div class="ai-bubble">{prev_q["prompt"]}</div>', unsafe_allow_html=True)
-        stored = db.get_profile().get(prev_q["store_key"], "")
+        stored = db.get_profile(username).get(prev_q["store_key"], "")
         if stored:
             st.markdown(f'<div class="user-bubble">{stored}</div>', unsafe_allow_html=True)
 
@@ -471,7 +592,7 @@ def render_onboarding():
         submitted = st.form_submit_button("Continuar →")
 
     if submitted and answer.strip():
-        db.set_profile(q["store_key"], answer.strip())
+        db.set_profile(q["store_key"], answer.strip(), username)
         st.session_state.onboarding_step += 1
         st.rerun()
 
@@ -479,6 +600,7 @@ def render_onboarding():
 # ── PHASE 2: Daily Journaling ─────────────────────────────────────────────────
 
 def render_journaling():
+    username = st.session_state.current_user or db.GUEST_USERNAME
     st.markdown("# 📖 Entrada de hoy")
 
     api_key = st.session_state.get("api_key_input", "")
@@ -489,9 +611,7 @@ def render_journaling():
     st.markdown("---")
 
     # Render existing chat history
-    for msg in st.session_state.chat_history:
-        css_class = "user-bubble" if msg["role"] == "user" else "ai-bubble"
-        st.markdown(f'<div class="{css_class}">{msg["content"]}</div>', unsafe_allow_html=True)
+    _render_history(st.session_state.chat_history, "ai-bubble")
 
     st.markdown("")
 
@@ -506,11 +626,10 @@ def render_journaling():
         submitted = st.form_submit_button("✍️ Añadir al Diario")
 
     if submitted and entry.strip():
-        profile = db.get_profile()
-        knowledge_summary = db.get_knowledge_summary()
+        profile = db.get_profile(username)
+        knowledge_items = db.get_knowledge_items(username=username)
 
         # Enrich profile with quick profile data
-        username = st.session_state.current_user or "invitado"
         qp = db.get_quick_profile(username)
         if qp:
             profile["alias"] = qp.get("alias", "")
@@ -523,26 +642,30 @@ def render_journaling():
             for m in st.session_state.chat_history
         ]
 
-        with st.spinner("📝 Escribiendo nota al margen…"):
-            try:
-                response = ai.get_journaling_response(
-                    api_key=api_key,
-                    user_entry=entry,
-                    profile=profile,
-                    conversation_history=history_for_ai,
-                    knowledge_summary=knowledge_summary,
-                )
-            except Exception as e:
-                response = f"*(Algo salió mal: {e})*"
-
-        entry_id = db.save_entry(content=entry, ai_response=response)
+        # Looked up before saving so the entry does not match itself
+        related_entries = db.get_related_entries(entry, k=3, username=username)
+
+        # Save first and queue tag extraction: the background workers run it
+        # alongside the margin note and retry it if the API call fails.
+        entry_id = db.save_entry(content=entry, username=username)
+        tag_worker.submit(api_key, entry_id, username)
+
+        st.markdown(f'<div class="user-bubble">{entry}</div>', unsafe_allow_html=True)
+        response = _render_stream(
+            ai.stream_journaling_response(
+                api_key=api_key,
+                user_entry=entry,
+                profile=profile,
+                conversation_history=history_for_ai,
+                knowledge_items=knowledge_items,
+                related_entries=related_entries,
+                conversation_id=st.session_state.conversation_id,
+            ),
+            css_class="ai-bubble",
+            spinner_text="📝 Escribiendo nota al margen…",
+        )
 
-        try:
-            tags = ai.extract_knowledge_tags(api_key=api_key, entry=entry)
-            if tags:
-                db.save_tags(entry_id=entry_id, tags=tags)
-        except Exception:
-            pass
+        db.update_entry_response(entry_id, response, username)
 
         st.session_state.chat_history.append({"role": "user", "content": entry})
         st.session_state.chat_history.append({"role": "assistant", "content": response})
@@ -553,21 +676,39 @@ def render_journaling():
 # ── PHASE 3: Past Self Mode ───────────────────────────────────────────────────
 
 def render_past_self():
-    profile = db.get_profile()
-    all_entries = db.get_all_entries()
-    knowledge_summary = db.get_knowledge_summary()
-
-    if all_entries:
-        first_date = all_entries[0]["created_at"][:10]
-        last_date = all_entries[-1]["created_at"][:10]
-        date_range = f"{first_date} – {last_date}"
+    username = st.session_state.current_user or db.GUEST_USERNAME
+    span = db.get_entry_date_range(username)
+    banner = st.empty()
+    as_of = None
+    if span:
+        first, last = (datetime.fromisoformat(d[:10]).date() for d in span)
+        shown = st.session_state.past_self_date or last
+        picked = st.date_input(
+            "📅 Hablar con mi yo del día…",
+            value=min(max(shown, first), last),
+            min_value=first,
+            max_value=last,
+            format="YYYY-MM-DD",
+        )
+        if picked != shown:
+            # Another date is another person: start a fresh conversation
+            st.session_state.past_self_date = picked
+            st.session_state.past_self_history = []
+            st.session_state.past_self_conversation_id = uuid.uuid4().hex
+        if picked < last:
+            as_of = picked.isoformat()
+        date_range = f"{span[0][:10]} – {as_of or span[1][:10]}"
     else:
         date_range = "sin entradas aún"
 
-    st.markdown(
+    if as_of:
+        who = f"tu yo del <em>{as_of}</em>, que solo recuerda lo escrito hasta ese día ({date_range})"
+    else:
+        who = f"tu yo pasado de <em>{date_range}</em>"
+    banner.markdown(
         f'<div class="past-self-banner">'
         f'🕰️ <strong>Modo Yo Pasado Activo</strong><br>'
-        f'<small>Estás hablando con tu yo pasado de <em>{date_range}</em>. '
+        f'<small>Estás hablando con {who}. '
         f'Las respuestas se basan estrictamente en lo que escribiste en tu diario.</small>'
         f'</div>',
         unsafe_allow_html=True
@@ -578,11 +719,7 @@ def render_past_self():
         st.warning("⚠️ Introduce tu clave API de Gemini en el panel lateral.", icon="🔑")
         return
 
-    for msg in st.session_state.past_self_history:
-        if msg["role"] == "user":
-            st.markdown(f'<div class="user-bubble">{msg["content"]}</div>', unsafe_allow_html=True)
-        else:
-            st.markdown(f'<div class="past-self-bubble">{msg["content"]}</div>', unsafe_allow_html=True)
+    _render_history(st.session_state.past_self_history, "past-self-bubble")
 
     st.markdown("")
 
@@ -596,29 +733,107 @@ def render_past_self():
         submitted = st.form_submit_button("💬 Enviar")
 
     if submitted and message.strip():
+        profile = db.get_profile(username)
+        # Entities the question mentions, and those around them, rank first
+        knowledge_items = db.get_knowledge_items_for(message, username=username, as_of=as_of)
+        context_entries = db.get_relevant_entries(message, username=username, as_of=as_of)
+        related_entries = db.get_related_entries(
+            message, k=3, exclude_ids=[e["id"] for e in context_entries], username=username,
+            as_of=as_of,
+        )
+
         history_for_ai = [
             {"role": "user" if m["role"] == "user" else "model", "content": m["content"]}
             for m in st.session_state.past_self_history
         ]
 
-        with st.spinner("🕰️ Buscando en el pasado…"):
-            try:
-                response = ai.get_past_self_response(
-                    api_key=api_key,
-                    user_message=message,
-                    profile=profile,
-                    knowledge_summary=knowledge_summary,
-                    all_entries=all_entries,
-                    conversation_history=history_for_ai,
-                )
-            except Exception as e:
-                response = f"*(Algo salió mal: {e})*"
+        st.markdown(f'<div class="user-bubble">{message}</div>', unsafe_allow_html=True)
+        response = _render_stream(
+            ai.stream_past_self_response(
+                api_key=api_key,
+                user_message=message,
+                profile=profile,
+                knowledge_items=knowledge_items,
+                context_entries=context_entries,
+                conversation_history=history_for_ai,
+                related_entries=related_entries,
+                conversation_id=st.session_state.past_self_conversation_id,
+                as_of=as_of,
+            ),
+            css_class="past-self-bubble",
+            spinner_text="🕰️ Buscando en el pasado…",
+        )
 
         st.session_state.past_self_history.append({"role": "user", "content": message})
         st.session_state.past_self_history.append({"role": "assistant", "content": response})
         st.rerun()
 
 
+# ── PHASE 4: Timeline ─────────────────────────────────────────────────────────
+
+TIMELINE_GRAINS = {"Día": "day", "Semana": "week", "Mes": "month"}
+# Default window per grain, ending at the newest entry (None: the whole diary)
+TIMELINE_WINDOW_DAYS = {"day": 90, "week": 365, "month": None}
+
+
+def render_timeline():
+    username = st.session_state.current_user or db.GUEST_USERNAME
+    st.markdown("### 📈 Línea de tiempo")
+    span = db.get_entry_date_range(username)
+    if not span:
+        st.info("Aún no hay entradas.")
+        return
+    first, last = (datetime.fromisoformat(d[:10]).date() for d in span)
+
+    label = st.radio("Agrupar por", list(TIMELINE_GRAINS), index=2, horizontal=True)
+    grain = TIMELINE_GRAINS[label]
+    window = TIMELINE_WINDOW_DAYS[grain]
+    picked = st.date_input(
+        "Periodo",
+        value=(max(first, last - timedelta(days=window)) if window else first, last),
+        min_value=first,
+        max_value=last,
+        format="YYYY-MM-DD",
+    )
+    if len(picked) != 2:
+        return      # only the start of the range is chosen so far
+    start, end = picked
+
+    timeline = db.get_timeline(grain, start.isoformat(), end.isoformat(), username=username)
+    if not timeline:
+        st.info("No hay etiquetas en este periodo.")
+        return
+
+    totals: dict[str, int] = {}
+    for bucket in timeline:
+        for tag_type, count in bucket["mentions"].items():
+            totals[tag_type] = totals.get(tag_type, 0) + count
+    tag_types = sorted(totals, key=lambda t: -totals[t])
+    chart = {"periodo": [b["period"] for b in timeline]}
+    for tag_type in tag_types:
+        chart[tag_type] = [b["mentions"].get(tag_type, 0) for b in timeline]
+    st.bar_chart(chart, x="periodo", y=tag_types)
+
+    def _top(bucket: dict, tag_type: str) -> str:
+        return ", ".join(f'{t["name"]} ({t["mentions"]})' for t in bucket["top"].get(tag_type, []))
+
+    st.markdown("**Lo que más aparece en cada periodo**")
+    st.dataframe(
+        [
+            {
+                "Periodo": b["period"],
+                "Menciones": b["total"],
+                "Sentimientos": _top(b, "Sentiment/Trigger"),
+                "Personas y lugares": _top(b, "Entity"),
+                "Creencias": _top(b, "Core Belief"),
+            }
+            for b in reversed(timeline)
+        ],
+        use_container_width=True,
+        hide_index=True,
+    )
+
+
 # ── Router ────────────────────────────────────────────────────────────────────
 
 phase = st.session_state.phase
@@ -633,3 +848,8 @@ elif phase == "journaling":
     render_journaling()
 elif phase == "past_self":
     render_past_self()
+elif phase == "timeline":
+    render_timeline()
+
+if debug_slot is not None:
+    _render_debug_panel(debug_slot)
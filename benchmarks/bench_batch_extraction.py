@@ -0,0 +1,95 @@
+"""
+bench_batch_extraction.py
+-------------------------
+Backfill benchmark for knowledge-tag extraction.
+
+Tags a diary of N entries twice against the offline model (fake_gemini) with a
+simulated per-request latency: once with one extract_knowledge_tags call and
+one save_tags transaction per entry, and once with extract_knowledge_tags_batch
+plus complete_extraction_jobs. Each run uses a fresh database and response
+cache, so neither benefits from the other.
+
+Run with:  python benchmarks/bench_batch_extraction.py [--entries 200] [--latency 0.3]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ["AI_MEMORIES_FAKE_MODEL"] = "1"
+
+import fake_gemini  # noqa: E402
+import memories_db as db  # noqa: E402
+import ai_engine as ai  # noqa: E402
+import rate_limit  # noqa: E402
+
+
+def _with_latency(latency: float):
+    """Make every fake generate_content call cost `latency` seconds, like a network round trip."""
+    original = fake_gemini.FakeGenerativeModel.generate_content
+    calls = [0]
+
+    def generate_content(self, *args, **kwargs):
+        calls[0] += 1
+        time.sleep(latency)
+        return original(self, *args, **kwargs)
+
+    fake_gemini.FakeGenerativeModel.generate_content = generate_content
+    return calls
+
+
+def _seed(entries: int) -> list[tuple[int, str]]:
+    db.init_db()
+    seeded = []
+    for i in range(entries):
+        text = f"Hoy hablé con Marta {i} sobre el viaje a Lisboa. Estaba cansado pero contento."
+        seeded.append((db.save_entry(text), text))
+    return seeded
+
+
+def _single(seeded):
+    for entry_id, text in seeded:
+        db.save_tags(entry_id, ai.extract_knowledge_tags("bench", text))
+
+
+def _batched(seeded):
+    tags, errors = ai.extract_knowledge_tags_batch("bench", seeded)
+    assert not errors, errors
+    db.complete_extraction_jobs(tags)
+
+
+def _run(fn, entries: int, calls: list[int]) -> tuple[float, int]:
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = Path(tmp) / "memories.db"
+        seeded = _seed(entries)
+        calls[0] = 0
+        start = time.perf_counter()
+        fn(seeded)
+        elapsed = time.perf_counter() - start
+        db.close_connections()
+    return elapsed, calls[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--entries", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds per model request")
+    args = parser.parse_args()
+
+    calls = _with_latency(args.latency)
+    rate_limit.configure("bench", rpm=0)     # compare request counts, not the client-side quota
+    single_s, single_calls = _run(_single, args.entries, calls)
+    batch_s, batch_calls = _run(_batched, args.entries, calls)
+
+    print(f"entries             : {args.entries}")
+    print(f"one call per entry  : {single_s:8.2f} s  ({single_calls} requests)")
+    print(f"batched             : {batch_s:8.2f} s  ({batch_calls} requests)")
+    print(f"speed-up            : {single_s / batch_s:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+bench_connections.py
+--------------------
+Micro-benchmark for the memories_db connection layer.
+
+Replays the database calls that a single Streamlit rerun of app.py makes
+(sidebar + journaling page) against a seeded temporary diary, first with the
+old "open a fresh sqlite3 connection per call" behaviour and then with the
+pooled WAL connections, and reports reruns per second for each.
+
+Run with:  python benchmarks/bench_connections.py [--entries 500] [--seconds 3]
+"""
+
+import argparse
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import memories_db as db  # noqa: E402
+
+
+@contextmanager
+def _fresh_connection(path=None):
+    """The pre-pool behaviour: connect, run, commit, throw the handle away."""
+    conn = sqlite3.connect(path or db.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def _seed(entries: int):
+    db.init_db()
+    db.create_user("bench")
+    db.set_quick_profile("bench", "Bench", "tester", "none", "speed")
+    db.set_profile("onboarding_complete", "true")
+    for i in range(entries):
+        entry_id = db.save_entry(f"Entrada de prueba número {i}", "nota")
+        db.save_tags(entry_id, [
+            {"type": "Entity", "value": f"persona {i % 40}"},
+            {"type": "Sentiment/Trigger", "value": f"emoción {i % 15}"},
+        ])
+
+
+def _rerun():
+    """The memories_db calls made by one journaling-page rerun."""
+    db.get_sidebar_summary()
+    db.get_quick_profile("bench")
+    db.get_profile()
+    db.get_knowledge_summary()
+
+
+def _measure(seconds: float) -> float:
+    runs = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        _rerun()
+        runs += 1
+    return runs / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--entries", type=int, default=500)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = Path(tmp) / "memories.db"
+        _seed(args.entries)
+
+        pooled_get_connection = db.get_connection
+        db.get_connection = _fresh_connection
+        before = _measure(args.seconds)
+        db.get_connection = pooled_get_connection
+        after = _measure(args.seconds)
+        db.close_connections()
+
+    print(f"entries seeded      : {args.entries}")
+    print(f"fresh connections   : {before:8.1f} reruns/s")
+    print(f"pooled WAL          : {after:8.1f} reruns/s")
+    print(f"speed-up            : {after / before:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+bench_e2e.py
+------------
+End-to-end latency benchmark for the journaling and Past Self flows.
+
+For each diary size a synthetic diary is seeded (memories_db.import_entries,
+with tags), then turns of both flows are replayed the way app.py runs them,
+against the offline fake backend. Reported per flow and stage, as p50/p95:
+
+  db_reads      profile, knowledge items, related / relevant entries
+  summary       sidebar aggregates, knowledge summary, entry date range
+  prompt        context budgeting and message assembly
+  model         the streamed reply, request to last chunk
+  tag_extract   the knowledge-tag extraction request (journaling only)
+  tag_persist   saving the entry and its tags (journaling only)
+
+The fake model answers instantly by default, so the numbers are this repo's
+own overhead; --latency/--chunk-delay add a simulated network, --failure-rate
+injects API errors (failed turns are counted, not timed).
+
+Run with:  python benchmarks/bench_e2e.py [--sizes 100,1000,10000] [--turns 30]
+           [--latency 0] [--chunk-delay 0] [--failure-rate 0] [--json results.json]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import ai_engine as ai  # noqa: E402
+import fake_gemini  # noqa: E402
+import memories_db as db  # noqa: E402
+import rate_limit  # noqa: E402
+
+API_KEY = "bench"
+USER = "bench"
+STAGES = ("db_reads", "summary", "prompt", "model", "tag_extract", "tag_persist")
+
+_WORDS = (
+    "hoy ayer mañana casa trabajo clase examen playa cena comida viaje tren lluvia sol "
+    "cansado contento triste nervioso tranquilo feliz agobiado hablar pensar escribir "
+    "recordar volver quedar salir dormir correr leer música película libro amigos familia"
+).split()
+_NAMES = "Marta Luis Santi Lucía Pedro Ana Jorge Elena Pablo Sara Valencia Madrid Lisboa".split()
+
+
+def _sentence(rng: random.Random) -> str:
+    words = [rng.choice(_WORDS) for _ in range(rng.randint(6, 14))]
+    words.insert(rng.randrange(1, len(words)), rng.choice(_NAMES))
+    return " ".join(words).capitalize() + "."
+
+
+def _entry_text(rng: random.Random) -> str:
+    return " ".join(_sentence(rng) for _ in range(rng.randint(2, 6)))
+
+
+def _seed(size: int, rng: random.Random):
+    db.init_db()
+    for key, value in (("name_and_life_stage", "Bench, probando"),
+                       ("foundational_memory", "Un verano en la playa"),
+                       ("linguistic_style", "Directo y cariñoso"),
+                       ("onboarding_complete", "true")):
+        db.set_profile(key, value, USER)
+    start = time.time() - size * 86400
+    batch = []
+    for i in range(size):
+        text = _entry_text(rng)
+        batch.append({
+            "content": text,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start + i * 86400)),
+            "tags": [{"type": "Entity", "value": n} for n in _NAMES if n in text][:3]
+                    + [{"type": "Sentiment/Trigger", "value": rng.choice(_WORDS[13:20])}],
+        })
+        if len(batch) == 1000:
+            db.import_entries(batch, username=USER)
+            batch = []
+    if batch:
+        db.import_entries(batch, username=USER)
+
+
+class _Turn:
+    """Stage timings of one turn (a stage entered twice accumulates)."""
+
+    def __init__(self):
+        self.times: dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start
+
+
+def _journaling_turn(rng, history, conversation_id) -> _Turn:
+    turn = _Turn()
+    text = _entry_text(rng)
+    with turn.stage("db_reads"):
+        profile = db.get_profile(USER)
+        knowledge_items = db.get_knowledge_items(username=USER)
+        related = db.get_related_entries(text, k=3, username=USER)
+    with turn.stage("summary"):
+        db.get_sidebar_summary(username=USER)
+        db.get_knowledge_summary(USER)
+    with turn.stage("prompt"):
+        live, message = ai._journaling_chat(
+            API_KEY, text, profile, history, knowledge_items, related, conversation_id
+        )
+    with turn.stage("model"):
+        reply = "".join(ai._send_stream(live, API_KEY, conversation_id, message, text))
+    with turn.stage("tag_persist"):
+        entry_id = db.save_entry(text, reply, username=USER)
+    with turn.stage("tag_extract"):
+        tags = ai.extract_knowledge_tags(API_KEY, text, raise_errors=True)
+    with turn.stage("tag_persist"):
+        db.save_tags(entry_id, tags, username=USER)
+    history += [{"role": "user", "content": text}, {"role": "model", "content": reply}]
+    return turn
+
+
+def _past_self_turn(rng, history, conversation_id) -> _Turn:
+    turn = _Turn()
+    question = f"¿Qué pensaba de {rng.choice(_NAMES)} cuando estaba {rng.choice(_WORDS[13:20])}?"
+    with turn.stage("db_reads"):
+        profile = db.get_profile(USER)
+        knowledge_items = db.get_knowledge_items_for(question, username=USER)
+        context_entries = db.get_relevant_entries(question, username=USER)
+        related = db.get_related_entries(
+            question, k=3, exclude_ids=[e["id"] for e in context_entries], username=USER
+        )
+    with turn.stage("summary"):
+        db.get_sidebar_summary(username=USER)
+        db.get_entry_date_range(USER)
+    with turn.stage("prompt"):
+        live, message = ai._past_self_chat(
+            API_KEY, question, profile, knowledge_items, context_entries, history, related,
+            conversation_id,
+        )
+    with turn.stage("model"):
+        reply = "".join(ai._send_stream(live, API_KEY, conversation_id, message, question))
+    history += [{"role": "user", "content": question}, {"role": "model", "content": reply}]
+    return turn
+
+
+def _percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def _run_size(size: int, turns: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = Path(tmp) / "memories.db"
+        started = time.perf_counter()
+        _seed(size, rng)
+        seed_s = time.perf_counter() - started
+
+        for flow, run_turn in (("journaling", _journaling_turn), ("past_self", _past_self_turn)):
+            history: list[dict] = []
+            samples: dict[str, list[float]] = {stage: [] for stage in STAGES}
+            failures = 0
+            for i in range(turns):
+                try:
+                    turn = run_turn(rng, history, f"{flow}-{size}")
+                except fake_gemini.FakeAPIError:
+                    failures += 1
+                    ai._forget_chat(API_KEY, f"{flow}-{size}")
+                    continue
+                for stage, seconds in turn.times.items():
+                    samples[stage].append(seconds)
+            results[flow] = {
+                "failures": failures,
+                "stages": {
+                    stage: {"p50_ms": 1000 * _percentile(v, 50), "p95_ms": 1000 * _percentile(v, 95)}
+                    for stage, v in samples.items() if v
+                },
+            }
+        db.close_connections()
+    return {"size": size, "seed_s": seed_s, "flows": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default="100,1000,10000",
+                        help="comma-separated diary sizes (e.g. 100,1000,10000,100000)")
+    parser.add_argument("--turns", type=int, default=30, help="turns per flow and size")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per model request")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of model requests that fail")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", type=Path, help="also write the results here")
+    args = parser.parse_args()
+
+    ai.register_backend("bench", lambda api_key, model_name, system_instruction: fake_gemini.FakeGenerativeModel(
+        model_name, latency=args.latency, chunk_delay=args.chunk_delay,
+        failure_rate=args.failure_rate, seed=args.seed,
+    ))
+    os.environ[ai.BACKEND_ENV] = "bench"
+    rate_limit.configure(API_KEY, rpm=0)     # measure the app, not the client-side quota
+
+    report = []
+    print(f"{'entries':>8}  {'flow':<11} {'stage':<12} {'p50 ms':>9} {'p95 ms':>9}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        result = _run_size(size, args.turns, args.seed)
+        report.append(result)
+        for flow, data in result["flows"].items():
+            for stage, t in data["stages"].items():
+                print(f"{size:>8}  {flow:<11} {stage:<12} {t['p50_ms']:>9.2f} {t['p95_ms']:>9.2f}")
+            if data["failures"]:
+                print(f"{size:>8}  {flow:<11} {'failed turns':<12} {data['failures']:>9}")
+        print(f"{size:>8}  (seeded in {result['seed_s']:.1f}s)")
+
+    if args.json:
+        args.json.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
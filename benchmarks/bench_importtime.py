@@ -0,0 +1,93 @@
+"""
+bench_importtime.py
+-------------------
+Cold-start import cost of the app's modules, measured with `python -X importtime`.
+
+Each module is imported in a fresh interpreter; the cumulative time Python
+reports for it is the cost app.py pays on a cold start. The run also checks
+which heavy dependencies came along, so a stray top-level import (e.g. of
+google.generativeai in ai_engine) shows up as a regression.
+
+Run with:  python benchmarks/bench_importtime.py [--runs 5] [--json out.json]
+           [--budget-ms 150]   exit with status 1 if the app's modules exceed it
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# What app.py imports itself, then the heavy third-party stacks for reference
+APP_MODULES = ("memories_db", "prompt_builder", "response_cache", "rate_limit", "telemetry", "ai_engine", "tag_worker")
+REFERENCE_MODULES = ("streamlit", "google.generativeai", "numpy")
+HEAVY = ("google.generativeai", "grpc", "google.protobuf", "numpy")
+
+
+def _import_once(modules: tuple[str, ...]) -> tuple[dict[str, float], set[str]]:
+    """Cumulative import time (ms) per requested module, and which HEAVY modules got loaded."""
+    code = f"import sys; import {', '.join(modules)}; print(' '.join(m for m in {HEAVY!r} if m in sys.modules))"
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        # "import time:   self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = (part.strip() for part in line.split("|"))
+        if name in modules and cumulative.isdigit():
+            times[name] = int(cumulative) / 1000
+    return times, set(proc.stdout.split())
+
+
+def _measure(modules: tuple[str, ...], runs: int) -> tuple[dict[str, float], set[str]]:
+    samples: dict[str, list[float]] = {m: [] for m in modules}
+    loaded: set[str] = set()
+    for _ in range(runs):
+        times, loaded = _import_once(modules)
+        for name, ms in times.items():
+            samples[name].append(ms)
+    return {m: statistics.median(v) for m, v in samples.items() if v}, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=None)
+    parser.add_argument("--json", type=Path)
+    args = parser.parse_args()
+
+    app_times, loaded = _measure(APP_MODULES, args.runs)
+    app_total = sum(app_times.values())
+    print(f"{'module':<22} {'median ms':>10}")
+    for name, ms in app_times.items():
+        print(f"{name:<22} {ms:>10.1f}")
+    print(f"{'app modules (sum)':<22} {app_total:>10.1f}")
+    print(f"heavy deps loaded      : {', '.join(sorted(loaded)) or 'none'}")
+
+    reference = {}
+    for name in REFERENCE_MODULES:
+        try:
+            times, _ = _measure((name,), args.runs)
+        except subprocess.CalledProcessError:
+            continue    # not installed here
+        reference.update(times)
+        print(f"{name:<22} {times.get(name, float('nan')):>10.1f}  (reference)")
+
+    if args.json:
+        args.json.write_text(json.dumps({
+            "app_modules_ms": app_times, "app_total_ms": app_total,
+            "heavy_loaded": sorted(loaded), "reference_ms": reference,
+        }, indent=2))
+    if args.budget_ms is not None and app_total > args.budget_ms:
+        print(f"over budget: {app_total:.1f} ms > {args.budget_ms:.1f} ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
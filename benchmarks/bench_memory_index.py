@@ -0,0 +1,106 @@
+"""
+bench_memory_index.py
+---------------------
+Benchmark for the related-memories vector index (memory_index.py).
+
+For each diary size it builds an index of synthetic entries in a temporary
+directory and reports:
+  - vectorize  : time to turn one entry into a vector
+  - append     : time to add one more entry incrementally (as save_entry does)
+  - search p50 / p95 : nearest-neighbour lookup latency over --queries lookups
+  - file size  : on-disk size of the memory-mapped matrix
+
+Large sizes are filled by vectorizing a pool of distinct synthetic entries once
+and appending those rows in bulk, so the run measures the index, not the text
+generator.
+
+Run with:  python benchmarks/bench_memory_index.py [--sizes 10000 100000 1000000]
+"""
+
+import argparse
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import memory_index  # noqa: E402
+
+WORDS = (
+    "hoy ayer mañana trabajo clase examen playa montaña casa mamá papá abuela "
+    "santi lucía amigos barrio bar café cena viaje tren coche perro gato "
+    "cansado contento triste nervioso tranquilo enfadado ilusionado "
+    "proyecto jefe equipo reunión libro película música concierto partido "
+    "lluvia sol frío calor verano invierno navidad cumpleaños boda mudanza"
+).split()
+
+POOL_SIZE = 5000
+BULK_CHUNK = 50_000
+
+
+def _entry(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 80)))
+
+
+def _bench(size: int, queries: int, rng: random.Random) -> dict:
+    pool = [_entry(rng) for _ in range(min(POOL_SIZE, size))]
+
+    start = time.perf_counter()
+    vectors = np.stack([memory_index.vectorize(t) for t in pool])
+    vectorize_ms = (time.perf_counter() - start) / len(pool) * 1000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index = memory_index.MemoryIndex(Path(tmp) / "bench")
+        next_id = 1
+        while next_id <= size:
+            n = min(BULK_CHUNK, size - next_id + 1)
+            rows = vectors[np.arange(n) % len(pool)]
+            index.add_vectors(np.arange(next_id, next_id + n), rows)
+            next_id += n
+
+        start = time.perf_counter()
+        index.add(next_id, _entry(rng))
+        append_ms = (time.perf_counter() - start) * 1000
+
+        timings = []
+        for _ in range(queries):
+            q = _entry(rng)
+            start = time.perf_counter()
+            index.search(q, k=5)
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+
+        size_mb = (Path(tmp) / "bench.vec").stat().st_size / 1e6
+
+    return {
+        "size": size,
+        "vectorize_ms": vectorize_ms,
+        "append_ms": append_ms,
+        "p50_ms": statistics.median(timings),
+        "p95_ms": timings[int(len(timings) * 0.95) - 1],
+        "file_mb": size_mb,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--queries", type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    print(f"{'entries':>10} {'vectorize':>10} {'append':>9} {'search p50':>11} "
+          f"{'search p95':>11} {'file':>9}")
+    for size in args.sizes:
+        r = _bench(size, args.queries, rng)
+        print(f"{r['size']:>10,} {r['vectorize_ms']:>8.3f}ms {r['append_ms']:>7.2f}ms "
+              f"{r['p50_ms']:>9.2f}ms {r['p95_ms']:>9.2f}ms {r['file_mb']:>7.0f}MB")
+
+
+if __name__ == "__main__":
+    main()
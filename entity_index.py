@@ -0,0 +1,128 @@
+"""
+entity_index.py
+---------------
+Name folding and fuzzy lookup for the knowledge graph's canonical entities.
+
+fold_key() maps a tag value to the key memories_db stores it under: Unicode
+NFKC, case folding, accents and punctuation removed, whitespace collapsed and
+a leading first-person possessive ("mi madre", "my mom") dropped. Spellings
+that fold to the same key are the same entity without any matching at all.
+Other people's relatives ("su madre", "her mom") keep their possessive.
+
+TrigramIndex catches typos ("Lucía Gómez" vs "Lucia Gomes"): every alias key is
+split into padded character trigrams held in an inverted index and scored by
+Dice coefficient. Only aliases sharing one of the query's rarest trigrams can
+reach the threshold, so only those are scored; a lookup typically takes a
+fraction of a millisecond with thousands of aliases. A high score is not
+enough: words_agree() must also accept the pair, so "Ana María" / "Ana Marina",
+"Mario" / "María" or "Calle Mayor 12" / "Calle Mayor 14" stay apart.
+"""
+
+import math
+import re
+import threading
+import unicodedata
+
+MATCH_THRESHOLD = 0.8
+MIN_FUZZY_LENGTH = 4        # keys shorter than this only ever match exactly
+MIN_TYPO_LENGTH = 5         # a word shorter than this must match exactly
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+# First person only: "su madre" is someone else's mother, not the user's
+_POSSESSIVES = frozenset("mi mis nuestro nuestra nuestros nuestras my our".split())
+_VOWELS = frozenset("aeiou")
+
+
+def fold_key(value: str) -> str:
+    """Key under which "Mamá", "mamá " and "MAMA" are the same entity."""
+    text = unicodedata.normalize("NFKC", value).casefold()
+    text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+    words = _PUNCTUATION.sub(" ", text).split()
+    if len(words) > 1 and words[0] in _POSSESSIVES:
+        words = words[1:]
+    return " ".join(words)
+
+
+def _one_typo(a: str, b: str) -> bool:
+    """Equal-length words one substitution or one adjacent swap apart, other than vowel for vowel."""
+    if len(a) != len(b) or len(a) < MIN_TYPO_LENGTH or any(c.isdigit() for c in a + b):
+        return False
+    diff = [i for i in range(len(a)) if a[i] != b[i]]
+    if len(diff) == 1:
+        # "mario" / "maria", "lucio" / "lucia": a different name, not a typo
+        return not (a[diff[0]] in _VOWELS and b[diff[0]] in _VOWELS)
+    return (len(diff) == 2 and diff[1] == diff[0] + 1
+            and a[diff[0]] == b[diff[1]] and a[diff[1]] == b[diff[0]])
+
+
+def words_agree(a: str, b: str) -> bool:
+    """Whether two folded keys have the same words in order, but for one word with a small typo."""
+    differing = [(x, y) for x, y in zip(a.split(), b.split()) if x != y]
+    return (len(a.split()) == len(b.split()) and len(differing) <= 1
+            and all(_one_typo(x, y) for x, y in differing))
+
+
+def trigrams(key: str) -> set[str]:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(a: str, b: str) -> float:
+    """Dice coefficient of two keys' trigrams, the score TrigramIndex ranks by."""
+    grams_a, grams_b = trigrams(a), trigrams(b)
+    return 2 * len(grams_a & grams_b) / (len(grams_a) + len(grams_b)) if grams_a or grams_b else 0.0
+
+
+class TrigramIndex:
+    """Inverted trigram index over alias keys of one tag type, mapping each key to an entity id."""
+
+    def __init__(self):
+        self._postings: dict[str, set[str]] = {}
+        self._grams: dict[str, frozenset[str]] = {}   # alias key -> its trigrams
+        self._entities: dict[str, int] = {}          # alias key -> entity id
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entities)
+
+    def add(self, key: str, entity_id: int):
+        grams = frozenset(trigrams(key))
+        with self._lock:
+            self._entities[key] = entity_id
+            self._grams[key] = grams
+            for gram in grams:
+                self._postings.setdefault(gram, set()).add(key)
+
+    def remap(self, old_id: int, new_id: int):
+        """Point every alias of entity `old_id` at `new_id` (after a merge)."""
+        with self._lock:
+            for key, entity_id in self._entities.items():
+                if entity_id == old_id:
+                    self._entities[key] = new_id
+
+    def best_match(self, key: str, threshold: float = MATCH_THRESHOLD) -> tuple[int, float] | None:
+        """(entity id, score) of the most similar alias key scoring at least `threshold`, or None."""
+        if len(key) < MIN_FUZZY_LENGTH:
+            return None
+        grams = trigrams(key)
+        size = len(grams)
+        # Dice = 2·shared / (size + other) ≥ t bounds the other key's trigram
+        # count, and the number of trigrams it must share with this one...
+        low = size * threshold / (2 - threshold)
+        high = size * (2 - threshold) / threshold
+        needed = math.ceil(threshold * (size + low) / 2 - 1e-9)
+        with self._lock:
+            # ...so it shares at least one of this key's (size - needed + 1) rarest trigrams
+            rare = sorted(grams, key=lambda g: len(self._postings.get(g, ())))[:size - needed + 1]
+            candidates = set().union(*(self._postings.get(g, ()) for g in rare))
+            best, best_score = None, threshold
+            for other in candidates:
+                other_grams = self._grams[other]
+                if not low <= len(other_grams) <= high:
+                    continue
+                score = 2 * len(grams & other_grams) / (size + len(other_grams))
+                if score < best_score or not words_agree(key, other):
+                    continue
+                if score > best_score or (score == best_score and (best is None or other < best)):
+                    best, best_score = other, score
+            return (self._entities[best], best_score) if best is not None else None
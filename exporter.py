@@ -0,0 +1,150 @@
+"""
+exporter.py
+-----------
+Streaming export and backups of an AI of Memories diary.
+
+  export    every entry (with its tags) as NDJSON, gzip-compressed when the
+            output name ends in .gz; one line per entry, in the same shape
+            importer.py reads, so an export can be imported elsewhere.
+  backup    incremental: writes only entries newer than the high-water mark
+            recorded in the backup directory's manifest.json.
+  snapshot  hot copy of the SQLite file (VACUUM INTO).
+
+Entries are read in pages (memories_db.iter_entries) and written one line at
+a time, so memory use does not grow with the diary and the app can keep
+writing while a backup runs. Files are written under a temporary name and
+renamed when complete.
+
+Run with:  python exporter.py export OUT.ndjson[.gz] [--user NAME]
+           python exporter.py backup DIR [--user NAME]
+           python exporter.py snapshot OUT.db [--user NAME]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+
+import memories_db as db
+
+MANIFEST = "manifest.json"
+
+
+@contextmanager
+def _atomic_output(path: Path, mode: str = "wt"):
+    """Open path.tmp for writing (through gzip for *.gz) and move it into place on success."""
+    tmp = path.with_name(path.name + ".tmp")
+    opener = gzip.open if path.suffix == ".gz" else open
+    try:
+        with opener(tmp, mode, encoding="utf-8") as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def _export_record(entry: dict) -> dict:
+    return {
+        "id": entry["id"],
+        "content": entry["content"],
+        "aiResponse": entry["ai_response"] or "",
+        "tags": entry["tags"],
+        "createdAt": entry["created_at"],
+    }
+
+
+def export_entries(
+    path,
+    username: str | None = None,
+    after_id: int = 0,
+    on_progress: Callable[[int], None] | None = None,
+) -> tuple[int, int]:
+    """Write entries with id > after_id to `path` as NDJSON. Returns (entries written, last id)."""
+    path = Path(path)
+    written, last_id = 0, after_id
+    with _atomic_output(path) as f:
+        for entry in db.iter_entries(after_id=after_id, username=username):
+            f.write(json.dumps(_export_record(entry), ensure_ascii=False))
+            f.write("\n")
+            written += 1
+            last_id = entry["id"]
+            if on_progress and written % db.EXPORT_CHUNK == 0:
+                on_progress(written)
+    return written, last_id
+
+
+def backup(directory, username: str | None = None) -> dict:
+    """
+    Incremental backup into `directory`: one compressed NDJSON file per run
+    holding the entries added since the previous run. Restoring is importing
+    the files in order with importer.py (entries whose tags were still being
+    extracted at backup time are re-queued for extraction on import).
+    Returns {"file", "entries", "last_id"}; "file" is None when nothing was new.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    manifest_path = directory / MANIFEST
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {"last_id": 0, "files": []}
+
+    hwm = manifest["last_id"]
+    name = f"entries-{hwm + 1:08d}-{datetime.now():%Y%m%d-%H%M%S}.ndjson.gz"
+    written, last_id = export_entries(directory / name, username, after_id=hwm)
+    if not written:
+        (directory / name).unlink()
+        return {"file": None, "entries": 0, "last_id": hwm}
+
+    manifest["last_id"] = last_id
+    manifest["files"].append({"file": name, "first_id": hwm + 1, "last_id": last_id, "entries": written})
+    tmp = manifest_path.with_name(MANIFEST + ".tmp")
+    tmp.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp, manifest_path)
+    return {"file": name, "entries": written, "last_id": last_id}
+
+
+def snapshot(path, username: str | None = None):
+    """Consistent copy of the diary database at `path` (see memories_db.snapshot_diary)."""
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.unlink(missing_ok=True)
+    try:
+        db.snapshot_diary(tmp, username)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", choices=("export", "backup", "snapshot"))
+    parser.add_argument("target", type=Path, help="output file (export, snapshot) or directory (backup)")
+    parser.add_argument("--user", help="diary to read (default: the shared memories.db diary)")
+    args = parser.parse_args()
+
+    db.init_db()
+    if args.command == "export":
+        written, _ = export_entries(
+            args.target, args.user,
+            on_progress=lambda n: print(f"\r{n} entries", end="", file=sys.stderr, flush=True),
+        )
+        print(f"\r{written} entries written to {args.target}", file=sys.stderr)
+    elif args.command == "backup":
+        result = backup(args.target, args.user)
+        if result["file"]:
+            print(f"{result['entries']} new entries in {result['file']} (up to id {result['last_id']})",
+                  file=sys.stderr)
+        else:
+            print(f"Nothing new since id {result['last_id']}", file=sys.stderr)
+    else:
+        snapshot(args.target, args.user)
+        print(f"snapshot written to {args.target}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+fake_gemini.py
+--------------
+Offline stand-in for google.generativeai.GenerativeModel.
+Implements the small surface ai_engine uses — generate_content, start_chat and
+ChatSession.send_message, with or without stream=True — and answers
+deterministically, so the app and its streaming UI can be exercised without an
+API key or network access.
+
+Enable it with AI_MEMORIES_FAKE_MODEL=1 (or AI_MEMORIES_MODEL_BACKEND=fake).
+Behaviour is tuned with environment variables, or per model with the
+FakeGenerativeModel keyword arguments of the same name:
+  AI_MEMORIES_FAKE_CHUNK_DELAY   seconds between streamed chunks (default 0.05)
+  AI_MEMORIES_FAKE_LATENCY       seconds before a response starts (default 0)
+  AI_MEMORIES_FAKE_JITTER        ± random share of that latency, 0–1 (default 0)
+  AI_MEMORIES_FAKE_FAILURE_RATE  probability that a request fails (default 0)
+  AI_MEMORIES_FAKE_SEED          seed for jitter and failures (default 0)
+Injected failures raise FakeAPIError, shaped like the API's quota errors.
+"""
+
+import json
+import os
+import random
+import re
+import threading
+import time
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, default))
+
+
+class FakeAPIError(Exception):
+    """Injected failure (stands in for 429 ResourceExhausted / 503 from the real API)."""
+
+    code = 429
+
+
+class _Behaviour:
+    """Latency, chunk pacing and failure injection shared by a model and its chats."""
+
+    def __init__(self, chunk_delay=None, latency=None, jitter=None, failure_rate=None, seed=None):
+        self.chunk_delay = _env_float("AI_MEMORIES_FAKE_CHUNK_DELAY", 0.05) if chunk_delay is None else chunk_delay
+        self.latency = _env_float("AI_MEMORIES_FAKE_LATENCY", 0.0) if latency is None else latency
+        self.jitter = _env_float("AI_MEMORIES_FAKE_JITTER", 0.0) if jitter is None else jitter
+        self.failure_rate = (_env_float("AI_MEMORIES_FAKE_FAILURE_RATE", 0.0)
+                             if failure_rate is None else failure_rate)
+        self._random = random.Random(int(_env_float("AI_MEMORIES_FAKE_SEED", 0)) if seed is None else seed)
+        self._lock = threading.Lock()
+
+    def request(self):
+        """Wait out the simulated round trip, then maybe fail."""
+        with self._lock:
+            spread = self._random.uniform(-self.jitter, self.jitter)
+            fail = self._random.random() < self.failure_rate
+        if self.latency:
+            time.sleep(max(0.0, self.latency * (1 + spread)))
+        if fail:
+            raise FakeAPIError("429 Resource has been exhausted (injected by fake_gemini). Please retry in 0.2s.")
+
+
+class FakeResponse:
+    """Mimics GenerateContentResponse: .text, and iteration over chunks when streamed."""
+
+    def __init__(self, text: str, stream: bool = False, chunk_words: int = 4, chunk_delay: float = 0.0):
+        self.text = text
+        self._stream = stream
+        self._chunk_words = chunk_words
+        self._chunk_delay = chunk_delay
+
+    def __iter__(self):
+        if not self._stream:
+            yield self
+            return
+        words = re.findall(r"\S+\s*", self.text)
+        for i in range(0, len(words), self._chunk_words):
+            time.sleep(self._chunk_delay)
+            yield FakeResponse("".join(words[i:i + self._chunk_words]))
+
+    def resolve(self):
+        return self
+
+
+def _last_text(contents) -> str:
+    """Pull the plain text out of the content shapes ai_engine sends."""
+    if isinstance(contents, str):
+        return contents
+    parts = []
+    for item in contents:
+        if isinstance(item, str):
+            parts.append(item)
+        elif isinstance(item, dict):
+            parts.append(item.get("text", ""))
+    return "\n".join(parts)
+
+
+def _fake_tags(entry: str) -> list[dict]:
+    """Capitalised words become entities; enough structure to fill the knowledge graph."""
+    names = []
+    for sentence in re.split(r"[.!?]+", entry):
+        words = re.findall(r"\w+", sentence)
+        names += [w for w in words[1:] if w[0].isupper()]
+    tags = [{"type": "Entity", "value": n} for n in dict.fromkeys(names)]
+    first_sentence = re.split(r"[.!?]", entry.strip(), maxsplit=1)[0]
+    if first_sentence:
+        tags.append({"type": "Event", "value": first_sentence[:80]})
+    return tags
+
+
+def _fake_reply(prompt: str) -> str:
+    tail = prompt.rsplit("---", 1)[-1].strip()
+    _, _, said = tail.partition(":")
+    said = " ".join(said.split())[:120] or "…"
+    return (
+        f"Leo lo que escribes — «{said}». "
+        "Me quedo con eso como nota al margen. "
+        "¿Qué fue lo que más te removió de todo ello?"
+    )
+
+
+def _fake_summary(prompt: str) -> str:
+    """Previous summary plus the first words of each new user message."""
+    previous = prompt.split("Previous summary:", 1)[-1].split("New messages:", 1)[0].strip()
+    said = [
+        " ".join(line[len("User:"):].split()[:8])
+        for line in prompt.rsplit("New messages:", 1)[-1].splitlines() if line.startswith("User:")
+    ]
+    summary = "" if previous == "(none yet)" else previous + " "
+    return summary + "El usuario habló de: " + "; ".join(said) + "."
+
+
+class FakeChatSession:
+    def __init__(self, model: "FakeGenerativeModel", history=None):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, stream: bool = False, **kwargs) -> FakeResponse:
+        self.model.behaviour.request()
+        prompt = _last_text(content)
+        reply = _fake_reply(prompt)
+        self.history.append({"role": "user", "parts": [{"text": prompt}]})
+        self.history.append({"role": "model", "parts": [{"text": reply}]})
+        return self.model._response(reply, stream)
+
+
+class FakeGenerativeModel:
+    def __init__(self, model_name: str = "fake", chunk_delay=None, latency=None, jitter=None,
+                 failure_rate=None, seed=None, **kwargs):
+        self.model_name = model_name
+        self.behaviour = _Behaviour(chunk_delay, latency, jitter, failure_rate, seed)
+
+    def _response(self, text: str, stream: bool) -> FakeResponse:
+        return FakeResponse(text, stream=stream, chunk_delay=self.behaviour.chunk_delay)
+
+    def start_chat(self, history=None, **kwargs) -> FakeChatSession:
+        return FakeChatSession(self, history)
+
+    def generate_content(self, contents, stream: bool = False, **kwargs) -> FakeResponse:
+        self.behaviour.request()
+        prompt = _last_text(contents)
+        if "Journal entries:" in prompt:
+            body = prompt.rsplit("Journal entries:", 1)[-1]
+            answer = {
+                entry_id: _fake_tags(text)
+                for entry_id, text in re.findall(r"### Entry (\d+)\n(.*?)(?=\n\n### Entry |\Z)", body, re.S)
+            }
+            return self._response(json.dumps(answer, ensure_ascii=False), stream)
+        if "New messages:" in prompt:
+            return self._response(_fake_summary(prompt), stream)
+        if "Journal entry:" in prompt:
+            entry = prompt.rsplit("Journal entry:", 1)[-1]
+            return self._response(json.dumps(_fake_tags(entry), ensure_ascii=False), stream)
+        return self._response(_fake_reply(prompt), stream)
@@ -0,0 +1,285 @@
+"""
+importer.py
+-----------
+Bulk import of existing diaries into AI of Memories.
+Input files are read as streams and handed to memories_db.import_entries in
+large batches (one transaction each), keeping original dates and any tags
+already present. Entries without tags are queued for extraction, which then
+runs on a bounded pool of worker threads (tag_worker.drain).
+
+Supported inputs:
+  .json            an array of entries, e.g. diary-app/data/entries.json
+                   ({"content", "aiResponse", "tags", "createdAt"})
+  .jsonl/.ndjson   one entry object per line (same fields)
+  .md/.markdown    entries start at a line or heading beginning with a date
+  .txt             (e.g. "## 2021-03-04" or "2021-03-04 21:30"); a file with
+                   no dated lines is one entry dated by its modification time
+Any of these may be gzip-compressed (name ending in .gz), e.g. exporter.py output.
+
+Imports are resumable: each file is identified by the hash of its contents and
+its progress is checkpointed with every batch, so re-running an interrupted
+import continues where it stopped and re-running a finished one does nothing.
+
+Run with:  python importer.py FILE [FILE ...] [--user NAME] [--api-key KEY]
+           [--batch 1000] [--workers 4] [--no-extract]
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Iterator
+
+from dotenv import load_dotenv
+
+import memories_db as db
+
+BATCH_SIZE = 1000
+EXTRACTION_WORKERS = 4
+READ_CHUNK = 1 << 16
+
+_DATED_LINE = re.compile(
+    r"^\s*(?:#{1,6}\s*)?(\d{4}-\d{2}-\d{2}(?:[ T]\d{2}:\d{2}(?::\d{2})?)?)\s*[-—:|]?\s*(.*)$"
+)
+
+
+# ── Records ───────────────────────────────────────────────────────────────────
+
+def _local_iso(value) -> str | None:
+    """Naive local ISO timestamp (the format memories_db stores) from an ISO string or epoch number."""
+    try:
+        if isinstance(value, (int, float)):
+            dt = datetime.fromtimestamp(value / 1000 if value > 1e11 else value)
+        else:
+            dt = datetime.fromisoformat(str(value).strip().replace("Z", "+00:00"))
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt.isoformat()
+
+
+def _record(obj: dict, default_created_at: str) -> dict | None:
+    """Map one source object onto import_entries' record shape; None if it has no text."""
+    content = str(obj.get("content") or obj.get("text") or "").strip()
+    if not content:
+        return None
+    created_at = None
+    for field in ("createdAt", "created_at", "date"):
+        if obj.get(field) is not None:
+            created_at = _local_iso(obj[field])
+            break
+    tags = [
+        {"type": str(t["type"]), "value": str(t["value"])}
+        for t in obj.get("tags") or ()
+        if isinstance(t, dict) and t.get("type") and t.get("value")
+    ]
+    return {
+        "content": content,
+        "created_at": created_at or default_created_at,
+        "ai_response": obj.get("aiResponse") or obj.get("ai_response") or "",
+        "tags": tags,
+    }
+
+
+# ── Readers ───────────────────────────────────────────────────────────────────
+
+def _iter_json_array(f) -> Iterator:
+    """Yield the elements of a top-level JSON array without loading the whole file."""
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = f.read(READ_CHUNK)
+        eof = not chunk
+        buf, pos = buf[pos:] + chunk, 0
+
+    def skip(chars: str):
+        nonlocal pos
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or buf[pos] in chars):
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            fill()
+
+    fill()
+    skip("")
+    if buf[pos:pos + 1] != "[":
+        raise ValueError("expected a JSON array of entries")
+    pos += 1
+    while True:
+        skip(",")
+        if pos >= len(buf) or buf[pos] == "]":
+            return
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+        # A number cut at the chunk boundary still decodes; make sure it ended
+        if end == len(buf) and not eof:
+            fill()
+            continue
+        pos = end
+        yield obj
+
+
+def _iter_dated_text(f, default_created_at: str) -> Iterator[dict]:
+    """Split Markdown or plain text into entries at lines that start with a date."""
+    created_at, lines = None, []
+
+    def entry():
+        # Text before the first date that is only headings is a document title, not an entry
+        if created_at is None and all(not l.strip() or l.lstrip().startswith("#") for l in lines):
+            return None
+        return _record({"content": "".join(lines), "createdAt": created_at}, default_created_at)
+
+    for line in f:
+        match = _DATED_LINE.match(line)
+        stamp = _local_iso(match.group(1)) if match else None
+        if stamp:
+            if record := entry():
+                yield record
+            created_at = stamp
+            lines = [match.group(2) + "\n"] if match.group(2) else []
+        else:
+            lines.append(line)
+    if record := entry():
+        yield record
+
+
+def read_records(path: Path) -> Iterator[dict]:
+    """Stream import records from a file, choosing the reader by extension."""
+    default_created_at = datetime.fromtimestamp(path.stat().st_mtime).isoformat()
+    compressed = path.suffix.lower() == ".gz"
+    suffix = (path.with_suffix("") if compressed else path).suffix.lower()
+    with (gzip.open if compressed else open)(path, "rt", encoding="utf-8") as f:
+        if suffix == ".json":
+            objects = _iter_json_array(f)
+        elif suffix in (".jsonl", ".ndjson"):
+            objects = (json.loads(line) for line in f if line.strip())
+        elif suffix in (".md", ".markdown", ".txt"):
+            yield from _iter_dated_text(f, default_created_at)
+            return
+        else:
+            raise ValueError(f"unsupported file type: {path.name}")
+        for obj in objects:
+            if isinstance(obj, dict):
+                record = _record(obj, default_created_at)
+                if record:
+                    yield record
+
+
+def _fingerprint(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# ── Pipeline ──────────────────────────────────────────────────────────────────
+
+def import_file(
+    path,
+    username: str | None = None,
+    batch_size: int = BATCH_SIZE,
+    on_progress: Callable[[int], None] | None = None,
+) -> dict:
+    """
+    Import one file, resuming from its checkpoint.
+    Returns {"imported", "skipped", "untagged"}; skipped counts records a previous run already stored.
+    """
+    path = Path(path)
+    source = _fingerprint(path)
+    checkpoint = db.get_import_checkpoint(source, username) or {"position": 0, "done": 0}
+    if checkpoint["done"]:
+        return {"imported": 0, "skipped": checkpoint["position"], "untagged": 0}
+
+    start = checkpoint["position"]
+    position = imported = untagged = 0
+    batch: list[dict] = []
+
+    def flush():
+        nonlocal imported, untagged, batch
+        db.import_entries(batch, source=source, name=path.name, position=position, username=username)
+        imported += len(batch)
+        untagged += sum(1 for r in batch if not r["tags"])
+        batch = []
+        if on_progress:
+            on_progress(imported)
+
+    for record in read_records(path):
+        position += 1
+        if position <= start:
+            continue
+        batch.append(record)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    db.finish_import(source, path.name, username)
+    return {"imported": imported, "skipped": start, "untagged": untagged}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("files", nargs="+", type=Path)
+    parser.add_argument("--user", help="diary to import into (default: the shared memories.db diary)")
+    parser.add_argument("--api-key", default=None, help="Gemini key for tag extraction (default: $GEMINI_API_KEY)")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="entries per transaction")
+    parser.add_argument("--workers", type=int, default=EXTRACTION_WORKERS, help="parallel extraction threads")
+    parser.add_argument("--no-extract", action="store_true", help="only queue untagged entries")
+    args = parser.parse_args()
+
+    load_dotenv()
+    db.init_db()
+    if args.user:
+        db.create_user(args.user)
+
+    started = time.perf_counter()
+    for path in args.files:
+        def progress(n, name=path.name):
+            rate = n / max(time.perf_counter() - started, 1e-9)
+            print(f"\r{name}: {n} entries ({rate:.0f}/s)", end="", file=sys.stderr, flush=True)
+
+        stats = import_file(path, args.user, args.batch, progress)
+        print(
+            f"\r{path.name}: {stats['imported']} imported, {stats['skipped']} already imported, "
+            f"{stats['untagged']} queued for tagging",
+            file=sys.stderr
+        )
+
+    api_key = args.api_key or os.getenv("GEMINI_API_KEY", "")
+    if args.no_extract or not api_key:
+        if not args.no_extract:
+            print("No API key: untagged entries stay queued for the app's workers.", file=sys.stderr)
+        return
+
+    import tag_worker
+    pending = db.get_extraction_status(args.user)["pending"]
+
+    def tagged(n):
+        print(f"\rtagging: {n}/{pending}", end="", file=sys.stderr, flush=True)
+
+    handled = tag_worker.drain(api_key, args.user, args.workers, tagged)
+    left = db.get_extraction_status(args.user)
+    print(
+        f"\rtagging: {handled} processed, {left['pending']} left for retry "
+        f"({time.perf_counter() - started:.1f}s total)",
+        file=sys.stderr
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,66 +3,611 @@ memories_db.py
 --------------
 SQLite persistence layer for AI of Memories.
 Stores: users, user profile, journal entries, and structured knowledge graph tags.
+Account tables live in memories.db; each user's diary lives in its own file.
 All data belongs to the user and stays on their local machine.
 """
 
 import sqlite3
 import json
-from datetime import datetime
+import os
+import re
+import threading
+import hashlib
+import heapq
+import math
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
 from pathlib import Path
+from typing import Callable, Iterator
+
+import entity_index
+import telemetry
 
 DB_PATH = Path(__file__).parent / "memories.db"
 
 
-def get_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# ── Connection pool ───────────────────────────────────────────────────────────
+#
+# Opening a SQLite connection costs a file open, a schema parse and a round of
+# pragmas, and a single Streamlit rerun calls half a dozen functions below.
+# Connections are therefore pooled per database file and reused; a thread that
+# is already inside get_connection() gets the same connection back so nested
+# calls share one transaction instead of fighting over the write lock.
+
+BUSY_TIMEOUT_MS = 5000
+POOL_SIZE = 8
+
+_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",        # readers never block the writer
+    "PRAGMA synchronous = NORMAL",      # durable at checkpoint, safe with WAL
+    "PRAGMA cache_size = -16000",       # 16 MB page cache per connection
+    "PRAGMA mmap_size = 268435456",     # map up to 256 MB of the file
+    "PRAGMA temp_store = MEMORY",
+    f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}",
+)
+
+
+def _register_functions(conn: sqlite3.Connection):
+    """
+    SQL functions the migrations and upserts call. Registered once per
+    connection: SQLite refuses to redefine one while a statement is running.
+    """
+    conn.create_function("iso_epoch", 1, _epoch, deterministic=True)
+    conn.create_function("edge_decay", 1, _edge_decay, deterministic=True)
+    conn.create_function("rollup_period", 2, _rollup_period, deterministic=True)
+
+
+class _ConnectionPool:
+    """A small LIFO pool of idle connections to one database file."""
+
+    def __init__(self, path: str, size: int = POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.closed = False
+        self._idle: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in _PRAGMAS:
+            conn.execute(pragma)
+        _register_functions(conn)
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._open()
+
+    def release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if not self.closed and len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close idle connections now; ones still borrowed are closed on release."""
+        with self._lock:
+            self.closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+# One pool per database file, least recently used first. With one diary file
+# per user, only the MAX_OPEN_DATABASES most recently used keep open handles.
+MAX_OPEN_DATABASES = 32
+
+_pools: OrderedDict[str, _ConnectionPool] = OrderedDict()
+_pools_lock = threading.Lock()
+_local = threading.local()
+
+
+def _get_pool(path) -> _ConnectionPool:
+    key = str(path)
+    evicted = []
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = _ConnectionPool(key)
+        _pools.move_to_end(key)
+        while len(_pools) > MAX_OPEN_DATABASES:
+            evicted.append(_pools.popitem(last=False)[1])
+    for old in evicted:
+        old.close()
+    return pool
+
+
+@contextmanager
+def get_connection(path=None):
+    """
+    Borrow a pooled connection for the duration of a `with` block.
+    The block runs as one transaction: committed on success, rolled back on error.
+    """
+    key = str(path or DB_PATH)
+    held = getattr(_local, "held", None)
+    if held is None:
+        held = _local.held = {}
+
+    if key in held:
+        # Re-entrant use from the same thread: join the outer transaction.
+        yield held[key]
+        return
+
+    pool = _get_pool(key)
+    conn = pool.acquire()
+    conn.set_trace_callback(telemetry.on_query if telemetry.enabled else None)
+    held[key] = conn
+    try:
+        with conn:
+            yield conn
+    except BaseException:
+        # Cached fuzzy indexes may name entities and aliases that were just rolled
+        # back, whose ids SQLite will hand out again; rollbacks are rare, drop them all
+        with _entity_indexes_lock:
+            _entity_indexes.clear()
+        raise
+    finally:
+        del held[key]
+        pool.release(conn)
+
+
+def close_connections():
+    """Close every idle pooled connection (tests, benchmarks, shutdown)."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+# ── Schema & migrations ───────────────────────────────────────────────────────
+#
+# The schema version lives in PRAGMA user_version. Each migration runs once, in
+# its own IMMEDIATE transaction together with the version bump, so an existing
+# memories.db is upgraded in place and a crash mid-upgrade leaves it untouched.
+
+def _migration_1(conn):
+    """Baseline schema (every statement is IF NOT EXISTS so pre-versioned files upgrade cleanly)."""
+    for statement in (
+        """CREATE TABLE IF NOT EXISTS users (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               username TEXT UNIQUE NOT NULL,
+               created_at TEXT NOT NULL
+           )""",
+        """CREATE TABLE IF NOT EXISTS profile (
+               id INTEGER PRIMARY KEY,
+               key TEXT UNIQUE NOT NULL,
+               value TEXT NOT NULL,
+               updated_at TEXT NOT NULL
+           )""",
+        """CREATE TABLE IF NOT EXISTS quick_profile (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               username TEXT UNIQUE NOT NULL,
+               alias TEXT,
+               ocupacion TEXT,
+               circulo TEXT,
+               foco TEXT,
+               created_at TEXT NOT NULL
+           )""",
+        """CREATE TABLE IF NOT EXISTS journal_entries (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               content TEXT NOT NULL,
+               ai_response TEXT,
+               created_at TEXT NOT NULL
+           )""",
+        """CREATE TABLE IF NOT EXISTS knowledge_graph (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               entry_id INTEGER,
+               tag_type TEXT NOT NULL,
+               tag_value TEXT NOT NULL,
+               created_at TEXT NOT NULL,
+               FOREIGN KEY (entry_id) REFERENCES journal_entries(id)
+           )""",
+        # One row per distinct (type, normalized value), maintained by save_tags.
+        """CREATE TABLE IF NOT EXISTS knowledge_summary (
+               tag_type TEXT NOT NULL,
+               normalized_value TEXT NOT NULL,
+               tag_value TEXT NOT NULL,
+               first_seen TEXT NOT NULL,
+               last_seen TEXT NOT NULL,
+               mention_count INTEGER NOT NULL DEFAULT 0,
+               PRIMARY KEY (tag_type, normalized_value)
+           )""",
+        """CREATE TABLE IF NOT EXISTS meta (
+               key TEXT PRIMARY KEY,
+               value TEXT NOT NULL
+           )""",
+        # Durable queue of pending knowledge-tag extractions, one per entry.
+        """CREATE TABLE IF NOT EXISTS extraction_jobs (
+               entry_id INTEGER PRIMARY KEY,
+               status TEXT NOT NULL DEFAULT 'pending',
+               attempts INTEGER NOT NULL DEFAULT 0,
+               next_attempt_at TEXT NOT NULL,
+               last_error TEXT,
+               updated_at TEXT NOT NULL,
+               FOREIGN KEY (entry_id) REFERENCES journal_entries(id)
+           )""",
+        # Full-text index for Past Self retrieval; rowid = journal_entries.id.
+        """CREATE VIRTUAL TABLE IF NOT EXISTS journal_fts USING fts5(
+               content, tags, tokenize = 'unicode61 remove_diacritics 2'
+           )""",
+    ):
+        conn.execute(statement)
+
+    if conn.execute("SELECT 1 FROM journal_fts LIMIT 1").fetchone() is None:
+        _rebuild_search_index(conn)
+    summary_empty = conn.execute("SELECT 1 FROM knowledge_summary LIMIT 1").fetchone() is None
+    graph_empty = conn.execute("SELECT 1 FROM knowledge_graph LIMIT 1").fetchone() is None
+    if summary_empty and not graph_empty:
+        _rebuild_knowledge_summary(conn)
+
+
+def _rebuild_knowledge_summary(conn):
+    """knowledge_summary as migration 1 shipped it (whitespace and case folded); migration 4 replaces it."""
+    conn.execute("DELETE FROM knowledge_summary")
+    cursor = conn.execute(
+        "SELECT tag_type, tag_value, created_at FROM knowledge_graph ORDER BY created_at ASC, id ASC"
+    )
+    while True:
+        chunk = cursor.fetchmany(1000)
+        if not chunk:
+            break
+        conn.executemany(
+            """INSERT INTO knowledge_summary
+                 (tag_type, normalized_value, tag_value, first_seen, last_seen, mention_count)
+               VALUES (?, ?, ?, ?, ?, 1)
+               ON CONFLICT(tag_type, normalized_value) DO UPDATE SET
+                 first_seen = MIN(first_seen, excluded.first_seen),
+                 last_seen = MAX(last_seen, excluded.last_seen),
+                 mention_count = mention_count + 1""",
+            [(row["tag_type"], " ".join(row["tag_value"].split()).casefold(), row["tag_value"].strip(),
+              row["created_at"], row["created_at"])
+             for row in chunk if row["tag_value"].strip()]
+        )
+    _bump_knowledge_version(conn)
+
+
+def _migration_2(conn):
+    """Numeric timestamps and the indexes behind ordered listings, range scans and per-type queries."""
+    # Backfill through the same function new rows use (iso_epoch), so old and new values agree
+    for table in ("journal_entries", "knowledge_graph"):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN created_ts REAL")
+        conn.execute(f"UPDATE {table} SET created_ts = iso_epoch(created_at)")
+    for statement in (
+        "CREATE INDEX IF NOT EXISTS idx_entries_created_ts ON journal_entries(created_ts, id)",
+        "CREATE INDEX IF NOT EXISTS idx_kg_entry ON knowledge_graph(entry_id)",
+        "CREATE INDEX IF NOT EXISTS idx_kg_created_ts ON knowledge_graph(created_ts)",
+        # Covering index: per-type listings never touch the table rows
+        "CREATE INDEX IF NOT EXISTS idx_kg_type_ts ON knowledge_graph(tag_type, created_ts, tag_value)",
+        "CREATE INDEX IF NOT EXISTS idx_summary_mentions ON knowledge_summary(mention_count, last_seen)",
+        "CREATE INDEX IF NOT EXISTS idx_summary_last_seen ON knowledge_summary(last_seen)",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_due ON extraction_jobs(status, next_attempt_at)",
+    ):
+        conn.execute(statement)
+
+
+def _migration_3(conn):
+    """Checkpoints for resumable bulk imports (see import_entries)."""
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS imports (
+               source TEXT PRIMARY KEY,
+               name TEXT NOT NULL,
+               position INTEGER NOT NULL DEFAULT 0,
+               done INTEGER NOT NULL DEFAULT 0,
+               updated_at TEXT NOT NULL
+           )"""
+    )
+
+
+def _migration_4(conn):
+    """Canonical entities and their aliases replace knowledge_summary."""
+    for statement in (
+        # One row per canonical entity; name is the first spelling seen.
+        """CREATE TABLE IF NOT EXISTS entities (
+               id INTEGER PRIMARY KEY,
+               tag_type TEXT NOT NULL,
+               name TEXT NOT NULL,
+               first_seen TEXT NOT NULL,
+               last_seen TEXT NOT NULL,
+               mention_count INTEGER NOT NULL DEFAULT 0
+           )""",
+        # Every folded spelling (entity_index.fold_key) known to mean an entity.
+        """CREATE TABLE IF NOT EXISTS entity_aliases (
+               tag_type TEXT NOT NULL,
+               alias_key TEXT NOT NULL,
+               entity_id INTEGER NOT NULL,
+               alias TEXT NOT NULL,
+               PRIMARY KEY (tag_type, alias_key),
+               FOREIGN KEY (entity_id) REFERENCES entities(id)
+           )""",
+        "ALTER TABLE knowledge_graph ADD COLUMN entity_id INTEGER REFERENCES entities(id)",
+        "CREATE INDEX IF NOT EXISTS idx_kg_entity ON knowledge_graph(entity_id)",
+        "CREATE INDEX IF NOT EXISTS idx_aliases_entity ON entity_aliases(entity_id)",
+        "CREATE INDEX IF NOT EXISTS idx_entities_mentions ON entities(mention_count, last_seen)",
+        "CREATE INDEX IF NOT EXISTS idx_entities_last_seen ON entities(last_seen)",
+        "DROP TABLE IF EXISTS knowledge_summary",
+    ):
+        conn.execute(statement)
+    _rebuild_entities(conn)
+
+
+def _migration_5(conn):
+    """Co-occurrence edges between entities, backfilled from the existing mentions."""
+    # Both directions are stored, so an entity's neighbours are one primary-key range.
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS entity_edges (
+               source_id INTEGER NOT NULL,
+               target_id INTEGER NOT NULL,
+               weight REAL NOT NULL,
+               mentions INTEGER NOT NULL,
+               updated_ts REAL NOT NULL,
+               PRIMARY KEY (source_id, target_id)
+           ) WITHOUT ROWID"""
+    )
+    _rebuild_entity_edges(conn)
+
 
+def _migration_6(conn):
+    """Mentions dated by their entry, and the per-period rollups behind as-of-date queries."""
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS entity_periods (
+               grain TEXT NOT NULL,
+               period TEXT NOT NULL,
+               entity_id INTEGER NOT NULL,
+               mentions INTEGER NOT NULL,
+               first_seen TEXT NOT NULL,
+               last_seen TEXT NOT NULL,
+               PRIMARY KEY (grain, period, entity_id)
+           ) WITHOUT ROWID"""
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_periods_entity ON entity_periods(entity_id)")
+    # Tags extracted after the fact were stamped with the extraction time
+    conn.execute(
+        """UPDATE knowledge_graph SET
+             created_at = (SELECT e.created_at FROM journal_entries e WHERE e.id = knowledge_graph.entry_id),
+             created_ts = (SELECT e.created_ts FROM journal_entries e WHERE e.id = knowledge_graph.entry_id)
+           WHERE created_at != (SELECT e.created_at FROM journal_entries e
+                                WHERE e.id = knowledge_graph.entry_id)"""
+    )
+    _rebuild_entities(conn)
+    _rebuild_entity_edges(conn)
+    _rebuild_entity_periods(conn)
 
-def init_db():
-    """Create all tables if they don't exist."""
+
+def _migration_7(conn):
+    """Day and week entity rollups, and mentions per tag type per period, for the timeline."""
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS tag_periods (
+               grain TEXT NOT NULL,
+               period TEXT NOT NULL,
+               tag_type TEXT NOT NULL,
+               mentions INTEGER NOT NULL,
+               PRIMARY KEY (grain, period, tag_type)
+           ) WITHOUT ROWID"""
+    )
+    # Per-entity series read one grain at a time (get_entity_timeline)
+    conn.execute("DROP INDEX IF EXISTS idx_periods_entity")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_periods_entity ON entity_periods(entity_id, grain, period)")
+    _rebuild_entity_periods(conn)
+    _rebuild_tag_periods(conn)
+
+
+def _migration_8(conn):
+    """
+    Re-key aliases for the stricter matching: only first-person possessives are
+    dropped and fuzzy matches need their words to agree. Aliases the old rules
+    merged by similarity alone are detached, and mentions whose spelling no
+    longer leads to their entity are resolved again.
+    """
+    names = {row["id"]: normalize_tag_value(row["name"]) for row in conn.execute("SELECT id, name FROM entities")}
+    kept: dict[tuple[str, str], tuple[int, str]] = {}
+    by_entity: dict[int, list[str]] = {}
+    rows = conn.execute("SELECT tag_type, alias_key, entity_id, alias FROM entity_aliases ORDER BY rowid")
+    for row in rows:
+        key = normalize_tag_value(row["alias"])
+        accepted = by_entity.setdefault(row["entity_id"], [])
+        similar = [other for other in accepted
+                   if entity_index.similarity(key, other) >= entity_index.MATCH_THRESHOLD]
+        if not key or key != names.get(row["entity_id"]) and similar and not any(
+            entity_index.words_agree(key, other) for other in similar
+        ):
+            continue        # joined by a fuzzy match the new rules reject
+        spellings = {key: row["alias"]}
+        # "su madre" was stored as "madre": that key still means this entity
+        if normalize_tag_value(row["alias_key"]) == row["alias_key"]:
+            spellings.setdefault(row["alias_key"], row["alias_key"])
+        for alias_key, alias in spellings.items():
+            if (row["tag_type"], alias_key) not in kept:
+                kept[(row["tag_type"], alias_key)] = (row["entity_id"], alias)
+                accepted.append(alias_key)
+    conn.execute("DELETE FROM entity_aliases")
+    conn.executemany(
+        "INSERT INTO entity_aliases (tag_type, alias_key, entity_id, alias) VALUES (?, ?, ?, ?)",
+        [(tag_type, key, entity_id, alias) for (tag_type, key), (entity_id, alias) in kept.items()]
+    )
+    entity_of = {alias: entity_id for alias, (entity_id, _) in kept.items()}
+    last_id = 0
+    while True:
+        chunk = conn.execute(
+            "SELECT id, tag_type, tag_value, entity_id FROM knowledge_graph "
+            "WHERE id > ? AND entity_id IS NOT NULL ORDER BY id LIMIT 1000",
+            (last_id,)
+        ).fetchall()
+        if not chunk:
+            break
+        last_id = chunk[-1]["id"]
+        # NULL when the spelling lost its alias: _rebuild_entities resolves it afresh
+        moved = [(entity_of.get((row["tag_type"], normalize_tag_value(row["tag_value"]))), row)
+                 for row in chunk]
+        conn.executemany(
+            "UPDATE knowledge_graph SET entity_id = ? WHERE id = ?",
+            [(entity_id, row["id"]) for entity_id, row in moved if entity_id != row["entity_id"]]
+        )
+    _bump_knowledge_version(conn)       # cached fuzzy indexes hold the old keys
+    _rebuild_entities(conn)
+    _rebuild_entity_edges(conn)
+    _rebuild_entity_periods(conn)
+
+
+MIGRATIONS = (
+    (1, _migration_1),
+    (2, _migration_2),
+    (3, _migration_3),
+    (4, _migration_4),
+    (5, _migration_5),
+    (6, _migration_6),
+    (7, _migration_7),
+    (8, _migration_8),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _epoch(iso: str) -> float:
+    """Unix seconds of an ISO timestamp; naive (local wall-clock) times are read as UTC."""
+    dt = datetime.fromisoformat(iso)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def _as_of_end(as_of: str) -> str:
+    """Last instant covered by an as-of date: a bare date ("2010-01-31") includes that whole day."""
+    return f"{as_of}T23:59:59.999999" if len(as_of) == 10 else as_of
+
+
+def _as_of_ts(as_of: str | None) -> float:
+    """created_ts bound for `as_of` (no bound when it is None)."""
+    return math.inf if as_of is None else _epoch(_as_of_end(as_of))
+
+
+def get_schema_version(path=None) -> int:
+    with get_connection(path) as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+# Files already at SCHEMA_VERSION in this process: init_db is a set lookup for
+# them, so calling it on every Streamlit rerun costs nothing.
+_ready_paths: set[str] = set()
+_ready_lock = threading.Lock()
+
+
+def init_db(path=None):
+    """Create the schema or upgrade an existing database (DB_PATH by default) to SCHEMA_VERSION."""
+    key = str(path or DB_PATH)
+    if key in _ready_paths:
+        return
+    with _ready_lock:
+        if key in _ready_paths:
+            return
+        Path(key).parent.mkdir(parents=True, exist_ok=True)
+        with get_connection(key) as conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                _migrate(conn)
+        _ready_paths.add(key)
+
+
+def _migrate(conn):
+    for version, migrate in MIGRATIONS:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Re-check under the write lock: another process may have won the race
+            if conn.execute("PRAGMA user_version").fetchone()[0] < version:
+                migrate(conn)
+                conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+# ── Per-user diaries ──────────────────────────────────────────────────────────
+#
+# Every user's diary (profile, entries, tags, jobs, indexes) lives in its own
+# SQLite file under diaries/, so users are isolated and queries only ever see
+# one person's data. DB_PATH keeps the account tables (users, quick_profile).
+# username=None addresses the diary inside DB_PATH itself, which is where all
+# entries lived before diaries were split per user.
+
+DIARY_DIR_NAME = "diaries"
+LEGACY_OWNER_KEY = "legacy_diary_owner"
+LEGACY_OWNER_ENV = "AI_MEMORIES_LEGACY_OWNER"   # the user the pre-split diary belongs to
+GUEST_USERNAME = "invitado"
+
+
+def diary_path(username: str | None) -> Path:
+    if username is None:
+        return Path(DB_PATH)
+    slug = re.sub(r"[^\w-]+", "_", username.strip().casefold())[:40] or "user"
+    digest = hashlib.sha1(username.encode("utf-8")).hexdigest()[:8]
+    return Path(DB_PATH).parent / DIARY_DIR_NAME / f"{slug}-{digest}.db"
+
+
+def _diary(username: str | None):
+    """get_connection() for a user's diary, creating/upgrading the file on first use."""
+    path = diary_path(username)
+    init_db(path)
+    return get_connection(path)
+
+
+def adopt_legacy_diary(username: str) -> bool:
+    """
+    Hand the pre-split shared diary in DB_PATH to the user named in
+    AI_MEMORIES_LEGACY_OWNER when they log in. Nobody else, and never the guest
+    account, gets it; it is handed over at most once. Returns True if a diary
+    was copied.
+    """
+    owner = os.getenv(LEGACY_OWNER_ENV, "").strip()
+    if not owner or username != owner or username == GUEST_USERNAME:
+        return False
+    target = diary_path(username)
+    if target.exists():
+        return False
     with get_connection() as conn:
-        conn.executescript("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                created_at TEXT NOT NULL
-            );
-
-            CREATE TABLE IF NOT EXISTS profile (
-                id INTEGER PRIMARY KEY,
-                key TEXT UNIQUE NOT NULL,
-                value TEXT NOT NULL,
-                updated_at TEXT NOT NULL
-            );
-
-            CREATE TABLE IF NOT EXISTS quick_profile (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                alias TEXT,
-                ocupacion TEXT,
-                circulo TEXT,
-                foco TEXT,
-                created_at TEXT NOT NULL
-            );
-
-            CREATE TABLE IF NOT EXISTS journal_entries (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                content TEXT NOT NULL,
-                ai_response TEXT,
-                created_at TEXT NOT NULL
-            );
-
-            CREATE TABLE IF NOT EXISTS knowledge_graph (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                entry_id INTEGER,
-                tag_type TEXT NOT NULL,
-                tag_value TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY (entry_id) REFERENCES journal_entries(id)
-            );
-        """)
+        if conn.execute("SELECT 1 FROM meta WHERE key = ?", (LEGACY_OWNER_KEY,)).fetchone():
+            return False
+        has_data = bool(
+            conn.execute("SELECT 1 FROM journal_entries LIMIT 1").fetchone()
+            or conn.execute("SELECT 1 FROM profile LIMIT 1").fetchone()
+        )
+    # Copy first (VACUUM INTO cannot run inside a transaction), then claim
+    copy = target.with_name(f"{target.name}.{os.getpid()}-{threading.get_ident()}.adopting")
+    if has_data:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        copy.unlink(missing_ok=True)
+        with get_connection() as conn:
+            conn.execute("VACUUM INTO ?", (str(copy),))
+        dest = sqlite3.connect(copy)
+        try:
+            with dest:
+                dest.execute("DELETE FROM users")
+                dest.execute("DELETE FROM quick_profile")
+        finally:
+            dest.close()
+    try:
+        with get_connection() as conn:
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            claimed = conn.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)", (LEGACY_OWNER_KEY, username)
+            ).rowcount
+            if claimed and has_data:
+                os.replace(copy, target)
+    finally:
+        copy.unlink(missing_ok=True)
+    return bool(claimed and has_data)
 
 
 # ── Users ─────────────────────────────────────────────────────────────────────
@@ -130,9 +675,9 @@ def get_quick_profile(username: str) -> dict:
 
 # ── Profile ───────────────────────────────────────────────────────────────────
 
-def set_profile(key: str, value: str):
+def set_profile(key: str, value: str, username: str | None = None):
     now = datetime.now().isoformat()
-    with get_connection() as conn:
+    with _diary(username) as conn:
         conn.execute(
             "INSERT INTO profile (key, value, updated_at) VALUES (?, ?, ?) "
             "ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at",
@@ -140,84 +685,1429 @@ def set_profile(key: str, value: str):
         )
 
 
-def get_profile() -> dict:
-    with get_connection() as conn:
+def get_profile(username: str | None = None) -> dict:
+    with _diary(username) as conn:
         rows = conn.execute("SELECT key, value FROM profile").fetchall()
     return {row["key"]: row["value"] for row in rows}
 
 
-def profile_is_complete() -> bool:
+def profile_is_complete(username: str | None = None) -> bool:
     """Returns True if the user has completed onboarding."""
-    p = get_profile()
+    p = get_profile(username)
     return p.get("onboarding_complete") == "true"
 
 
 # ── Journal Entries ───────────────────────────────────────────────────────────
 
-def save_entry(content: str, ai_response: str = "") -> int:
+def save_entry(content: str, ai_response: str = "", username: str | None = None) -> int:
     now = datetime.now().isoformat()
-    with get_connection() as conn:
+    with _diary(username) as conn:
         cursor = conn.execute(
-            "INSERT INTO journal_entries (content, ai_response, created_at) VALUES (?, ?, ?)",
-            (content, ai_response, now)
+            "INSERT INTO journal_entries (content, ai_response, created_at, created_ts) VALUES (?, ?, ?, ?)",
+            (content, ai_response, now, _epoch(now))
         )
-        return cursor.lastrowid
+        conn.execute(
+            "INSERT INTO journal_fts (rowid, content, tags) VALUES (?, ?, '')",
+            (cursor.lastrowid, content)
+        )
+        entry_id = cursor.lastrowid
+    _related_index(username)    # catching up appends the new entry's vector
+    return entry_id
 
 
-def get_all_entries() -> list[dict]:
-    with get_connection() as conn:
+def update_entry_response(entry_id: int, ai_response: str, username: str | None = None):
+    with _diary(username) as conn:
+        conn.execute(
+            "UPDATE journal_entries SET ai_response = ? WHERE id = ?",
+            (ai_response, entry_id)
+        )
+
+
+def get_all_entries(username: str | None = None) -> list[dict]:
+    with _diary(username) as conn:
         rows = conn.execute(
-            "SELECT * FROM journal_entries ORDER BY created_at ASC"
+            "SELECT * FROM journal_entries ORDER BY created_ts ASC, id ASC"
         ).fetchall()
     return [dict(row) for row in rows]
 
 
-def get_entry_count() -> int:
-    with get_connection() as conn:
+def get_entry_count(username: str | None = None) -> int:
+    with _diary(username) as conn:
         row = conn.execute("SELECT COUNT(*) as cnt FROM journal_entries").fetchone()
     return row["cnt"]
 
 
+def get_entry_date_range(username: str | None = None) -> tuple[str, str] | None:
+    """(first, last) created_at of the diary, or None if it is empty."""
+    with _diary(username) as conn:
+        first = conn.execute(
+            "SELECT created_at FROM journal_entries ORDER BY created_ts ASC, id ASC LIMIT 1"
+        ).fetchone()
+        last = conn.execute(
+            "SELECT created_at FROM journal_entries ORDER BY created_ts DESC, id DESC LIMIT 1"
+        ).fetchone()
+    return (first["created_at"], last["created_at"]) if first else None
+
+
+def get_recent_entries(
+    limit: int = 20, username: str | None = None, as_of: str | None = None
+) -> list[dict]:
+    """The newest `limit` entries (written on or before `as_of`, if given), oldest first."""
+    with _diary(username) as conn:
+        rows = conn.execute(
+            "SELECT * FROM journal_entries WHERE created_ts <= ? "
+            "ORDER BY created_ts DESC, id DESC LIMIT ?",
+            (_as_of_ts(as_of), limit)
+        ).fetchall()
+    return [dict(row) for row in reversed(rows)]
+
+
+# ── Bulk import ───────────────────────────────────────────────────────────────
+#
+# importer.py streams existing diaries in and hands them over in large batches.
+# Each batch is one transaction that also advances the source's checkpoint in
+# `imports`, so an interrupted import resumes right after the last batch that
+# made it to disk and never duplicates entries.
+
+def get_import_checkpoint(source: str, username: str | None = None) -> dict | None:
+    """{"position", "done"} for a source (a content hash), or None if never imported."""
+    with _diary(username) as conn:
+        row = conn.execute(
+            "SELECT position, done FROM imports WHERE source = ?", (source,)
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def import_entries(
+    records: list[dict],
+    source: str | None = None,
+    name: str = "",
+    position: int = 0,
+    username: str | None = None,
+) -> list[int]:
+    """
+    Insert many entries at once, keeping their original timestamps and tags.
+    Each record: {"content", "created_at", "ai_response"?, "tags"?}, with
+    created_at a naive local ISO timestamp. Entries without tags are queued for
+    extraction. With a `source`, its checkpoint moves to `position` in the same
+    transaction. Returns the new entry ids, in record order.
+    """
+    now = datetime.now().isoformat()
+    with _diary(username) as conn:
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")     # ids are assigned below, under the write lock
+        last_id = conn.execute(
+            """SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'journal_entries'), 0),
+                          COALESCE((SELECT MAX(id) FROM journal_entries), 0))"""
+        ).fetchone()[0]
+        ids = list(range(last_id + 1, last_id + 1 + len(records)))
+        conn.executemany(
+            "INSERT INTO journal_entries (id, content, ai_response, created_at, created_ts) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(entry_id, r["content"], r.get("ai_response") or "", r["created_at"], _epoch(r["created_at"]))
+             for entry_id, r in zip(ids, records)]
+        )
+        tag_rows = [
+            (entry_id, t.get("type", "Unknown"), t.get("value", ""), r["created_at"])
+            for entry_id, r in zip(ids, records)
+            for t in r.get("tags") or ()
+        ]
+        conn.executemany(
+            "INSERT INTO journal_fts (rowid, content, tags) VALUES (?, ?, ?)",
+            [(entry_id, r["content"], " ".join(t.get("value", "") for t in r.get("tags") or ()))
+             for entry_id, r in zip(ids, records)]
+        )
+        if tag_rows:
+            _store_tags(conn, tag_rows)
+        conn.executemany(
+            "INSERT OR IGNORE INTO extraction_jobs (entry_id, status, next_attempt_at, updated_at) "
+            "VALUES (?, 'pending', ?, ?)",
+            [(entry_id, now, now) for entry_id, r in zip(ids, records) if not r.get("tags")]
+        )
+        if source is not None:
+            conn.execute(
+                "INSERT INTO imports (source, name, position, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(source) DO UPDATE SET position = excluded.position, "
+                "updated_at = excluded.updated_at",
+                (source, name, position, now)
+            )
+    _related_index(username)
+    return ids
+
+
+def finish_import(source: str, name: str = "", username: str | None = None):
+    """Mark a source as fully imported, so importing it again is a no-op."""
+    now = datetime.now().isoformat()
+    with _diary(username) as conn:
+        conn.execute(
+            "INSERT INTO imports (source, name, done, updated_at) VALUES (?, ?, 1, ?) "
+            "ON CONFLICT(source) DO UPDATE SET done = 1, updated_at = excluded.updated_at",
+            (source, name, now)
+        )
+
+
+# ── Export & backup ───────────────────────────────────────────────────────────
+#
+# Readers for exporter.py that never hold a whole diary in memory or a long
+# transaction: entries are paged by id (keyset pagination), each page a short
+# read, so writers are never blocked and memory stays flat for any diary size.
+
+EXPORT_CHUNK = 1000
+
+
+def iter_entries(
+    after_id: int = 0,
+    upto_id: int | None = None,
+    chunk_size: int = EXPORT_CHUNK,
+    username: str | None = None,
+) -> Iterator[dict]:
+    """Entries with id in (after_id, upto_id], oldest id first, each with its "tags" list."""
+    last_id = after_id
+    while True:
+        with _diary(username) as conn:
+            rows = conn.execute(
+                "SELECT * FROM journal_entries WHERE id > ? AND id <= ? ORDER BY id ASC LIMIT ?",
+                (last_id, upto_id if upto_id is not None else 2**63 - 1, chunk_size)
+            ).fetchall()
+            if not rows:
+                return
+            tags: dict[int, list[dict]] = {}
+            for tag in conn.execute(
+                "SELECT entry_id, tag_type, tag_value FROM knowledge_graph "
+                "WHERE entry_id BETWEEN ? AND ? ORDER BY id ASC",
+                (rows[0]["id"], rows[-1]["id"])
+            ):
+                tags.setdefault(tag["entry_id"], []).append(
+                    {"type": tag["tag_type"], "value": tag["tag_value"]}
+                )
+        for row in rows:
+            yield {**dict(row), "tags": tags.get(row["id"], [])}
+        last_id = rows[-1]["id"]
+
+
+def snapshot_diary(dest, username: str | None = None):
+    """
+    Hot copy of a diary into `dest` (which must not exist) with VACUUM INTO.
+    The copy is taken in one read transaction, so it is consistent and, unlike
+    the online backup API, never restarts when the tag workers write meanwhile;
+    with WAL those writers are not blocked either.
+    """
+    with _diary(username) as conn:
+        conn.execute("VACUUM INTO ?", (str(dest),))
+
+
+# ── Retrieval ─────────────────────────────────────────────────────────────────
+#
+# Past Self grounding: instead of "the last 20 entries", pick the entries that
+# best match the user's question with FTS5/BM25 over entry text and its tags,
+# within a character budget so the prompt stays bounded however old the diary.
+
+SEARCH_MAX_TERMS = 32
+TAG_COLUMN_WEIGHT = 0.5     # bm25 weight of tag matches relative to entry text
+
+
+def _rebuild_search_index(conn):
+    conn.execute("DELETE FROM journal_fts")
+    conn.execute(
+        """INSERT INTO journal_fts (rowid, content, tags)
+           SELECT e.id, e.content,
+                  COALESCE((SELECT group_concat(k.tag_value, ' ')
+                            FROM knowledge_graph k WHERE k.entry_id = e.id), '')
+           FROM journal_entries e"""
+    )
+
+
+def rebuild_search_index(username: str | None = None):
+    """Repopulate journal_fts from journal_entries and knowledge_graph."""
+    with _diary(username) as conn:
+        _rebuild_search_index(conn)
+
+
+def _fts_query(text: str) -> str:
+    """Turn free text into an FTS5 OR-query of quoted terms (no syntax injection)."""
+    terms = list(dict.fromkeys(t.lower() for t in re.findall(r"\w+", text) if len(t) > 1))
+    return " OR ".join(f'"{t}"' for t in terms[:SEARCH_MAX_TERMS])
+
+
+def search_entries(
+    query: str, limit: int = 20, username: str | None = None, as_of: str | None = None
+) -> list[dict]:
+    """Entries matching `query` (written on or before `as_of`, if given), best BM25 score first."""
+    match = _fts_query(query)
+    if not match:
+        return []
+    with _diary(username) as conn:
+        rows = conn.execute(
+            """SELECT e.*
+               FROM journal_fts f JOIN journal_entries e ON e.id = f.rowid
+               WHERE journal_fts MATCH ? AND e.created_ts <= ?
+               ORDER BY bm25(journal_fts, 1.0, ?)
+               LIMIT ?""",
+            (match, _as_of_ts(as_of), TAG_COLUMN_WEIGHT, limit)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_relevant_entries(
+    query: str,
+    limit: int = 12,
+    char_budget: int = 8000,
+    username: str | None = None,
+    as_of: str | None = None,
+) -> list[dict]:
+    """
+    Context entries for a Past Self question: best matches first, topped up with
+    the most recent entries, capped at `limit` entries and `char_budget`
+    characters of content. With `as_of`, only entries written by then count
+    and "most recent" means the last ones before it. Returned oldest first.
+    """
+    picked: dict[int, dict] = {}
+    used = 0
+    candidates = (search_entries(query, limit, username, as_of)
+                  + get_recent_entries(limit, username, as_of))
+    for entry in candidates:
+        if len(picked) >= limit:
+            break
+        if entry["id"] in picked:
+            continue
+        size = len(entry["content"])
+        if used + size > char_budget:
+            continue
+        picked[entry["id"]] = entry
+        used += size
+    return sorted(picked.values(), key=lambda e: (e["created_ts"], e["id"]))
+
+
+# ── Related Memories ──────────────────────────────────────────────────────────
+#
+# Vector similarity over entries (memory_index.py), stored beside the database
+# file. Optional: without NumPy these functions degrade to "no related entries".
+
+_related_lock = threading.Lock()
+
+
+def _related_index(username: str | None = None):
+    """The MemoryIndex for a diary, caught up with any entries it has not seen."""
+    try:
+        import memory_index
+    except ImportError:
+        return None
+    index = memory_index.open_index(diary_path(username).with_suffix(".index"))
+    index.refresh()     # another process (e.g. the importer) may have appended rows
+    with _related_lock, _diary(username) as conn:
+        # Entries saved before the index existed (or by another process)
+        cursor = conn.execute(
+            "SELECT id, content FROM journal_entries WHERE id > ? ORDER BY id ASC",
+            (index.last_id,)
+        )
+        while True:
+            chunk = cursor.fetchmany(1000)
+            if not chunk:
+                break
+            index.add_many([(row["id"], row["content"]) for row in chunk])
+    return index
+
+
+def get_related_entries(
+    text: str, k: int = 3, exclude_ids=(), username: str | None = None, as_of: str | None = None
+) -> list[dict]:
+    """Up to k past entries (written on or before `as_of`, if given) most similar to `text`, most similar first."""
+    index = _related_index(username)
+    if index is None:
+        return []
+    only_ids = None
+    if as_of is not None:
+        with _diary(username) as conn:
+            only_ids = [row[0] for row in conn.execute(
+                "SELECT id FROM journal_entries WHERE created_ts <= ?", (_as_of_ts(as_of),)
+            )]
+    hits = index.search(text, k=k, exclude_ids=set(exclude_ids), only_ids=only_ids)
+    if not hits:
+        return []
+    with _diary(username) as conn:
+        rows = conn.execute(
+            f"SELECT * FROM journal_entries WHERE id IN ({','.join('?' * len(hits))})",
+            [entry_id for entry_id, _ in hits]
+        ).fetchall()
+    by_id = {row["id"]: dict(row) for row in rows}
+    return [by_id[entry_id] for entry_id, _ in hits if entry_id in by_id]
+
+
 # ── Knowledge Graph ───────────────────────────────────────────────────────────
+#
+# knowledge_graph keeps every raw tag the model returned, one row per mention.
+# Each mention is also resolved to a canonical entity: by its folded key in
+# entity_aliases, else by a trigram fuzzy match against the aliases of the same
+# tag type (entity_index.py), else it becomes a new entity. Summaries, the
+# sidebar and prompt context read `entities`, so "Mamá", "mamá" and "mi mamá"
+# are one memory. Spellings no matcher can pair ("mi madre" and "mamá") are
+# joined with add_entity_alias or merge_entities.
+
+KNOWLEDGE_VERSION_KEY = "knowledge_version"
+
+# Rendered summary per database file: {path: (knowledge_version, text)}
+_summary_cache: dict[str, tuple[str, str]] = {}
+
+# Fuzzy indexes per database file: {path: (knowledge_version, {tag_type: TrigramIndex})}
+_entity_indexes: dict[str, tuple[str, dict[str, entity_index.TrigramIndex]]] = {}
+_entity_indexes_lock = threading.Lock()
+
+
+def normalize_tag_value(value: str) -> str:
+    """Key used to treat "Mamá", "mamá " and "MAMA" as the same memory (see entity_index.fold_key)."""
+    return entity_index.fold_key(value)
+
+
+def _bump_knowledge_version(conn):
+    conn.execute(
+        "INSERT INTO meta (key, value) VALUES (?, '1') "
+        "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+        (KNOWLEDGE_VERSION_KEY,)
+    )
+
+
+def _knowledge_version(conn) -> str:
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (KNOWLEDGE_VERSION_KEY,)).fetchone()
+    return row["value"] if row else "0"
+
+
+def _database_file(conn) -> str:
+    return conn.execute("PRAGMA database_list").fetchone()["file"]
+
+
+def _take_entity_indexes(conn) -> dict[str, entity_index.TrigramIndex]:
+    """
+    The diary's fuzzy indexes, checked out of the cache: a writer puts them back
+    with _return_entity_indexes once its changes are in, so a failed write
+    leaves nothing half-updated behind.
+    """
+    path = _database_file(conn)
+    version = _knowledge_version(conn)
+    with _entity_indexes_lock:
+        cached = _entity_indexes.pop(path, None)
+    if cached and cached[0] == version:
+        return cached[1]
+    indexes: dict[str, entity_index.TrigramIndex] = {}
+    for row in conn.execute("SELECT tag_type, alias_key, entity_id FROM entity_aliases"):
+        indexes.setdefault(row["tag_type"], entity_index.TrigramIndex()).add(
+            row["alias_key"], row["entity_id"]
+        )
+    return indexes
+
+
+def _return_entity_indexes(conn, indexes: dict[str, entity_index.TrigramIndex]):
+    with _entity_indexes_lock:
+        _entity_indexes[_database_file(conn)] = (_knowledge_version(conn), indexes)
+
 
-def save_tags(entry_id: int, tags: list[dict]):
+def _forget_entity_indexes(conn):
+    with _entity_indexes_lock:
+        _entity_indexes.pop(_database_file(conn), None)
+
+
+def _alias_entity_id(conn, tag_type: str, key: str) -> int | None:
+    row = conn.execute(
+        "SELECT entity_id FROM entity_aliases WHERE tag_type = ? AND alias_key = ?", (tag_type, key)
+    ).fetchone()
+    return row["entity_id"] if row else None
+
+
+def _fuzzy_entity_id(conn, indexes, tag_type: str, key: str) -> int | None:
+    index = indexes.get(tag_type)
+    match = index.best_match(key) if index is not None else None
+    # The index may lag behind a merge made by another process; trust only live ids
+    if match and conn.execute("SELECT 1 FROM entities WHERE id = ?", (match[0],)).fetchone():
+        return match[0]
+    return None
+
+
+def _resolve_entity(conn, indexes, tag_type: str, value: str, seen_at: str) -> int:
+    """Entity id for a tag value; a new spelling is recorded as an alias (of a new entity if unmatched)."""
+    key = normalize_tag_value(value)
+    entity_id = _alias_entity_id(conn, tag_type, key)
+    if entity_id is not None:
+        return entity_id
+    spelling = " ".join(value.split())
+    entity_id = _fuzzy_entity_id(conn, indexes, tag_type, key)
+    if entity_id is None:
+        entity_id = conn.execute(
+            "INSERT INTO entities (tag_type, name, first_seen, last_seen) VALUES (?, ?, ?, ?)",
+            (tag_type, spelling, seen_at, seen_at)
+        ).lastrowid
+    conn.execute(
+        "INSERT INTO entity_aliases (tag_type, alias_key, entity_id, alias) VALUES (?, ?, ?, ?)",
+        (tag_type, key, entity_id, spelling)
+    )
+    indexes.setdefault(tag_type, entity_index.TrigramIndex()).add(key, entity_id)
+    return entity_id
+
+
+def _store_tags(conn, rows: list[tuple[int, str, str, str]]):
+    """Insert mentions (entry_id, tag_type, tag_value, created_at), resolved to entities."""
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")     # aliases are looked up and added under the write lock
+    indexes = _take_entity_indexes(conn)
+    resolved: dict[tuple[str, str], int] = {}
+    graph_rows = []
+    entry_ids = list({row[0] for row in rows})
+    known = _entry_entities(conn, entry_ids)
+    mentions: dict[int, list] = {}       # entity id -> [count, first seen, last seen]
+    for entry_id, tag_type, value, created_at in rows:
+        entity_id = None
+        key = normalize_tag_value(value)
+        if key:
+            entity_id = resolved.get((tag_type, key))
+            if entity_id is None:
+                entity_id = resolved[(tag_type, key)] = _resolve_entity(
+                    conn, indexes, tag_type, value, created_at
+                )
+            seen = mentions.setdefault(entity_id, [0, created_at, created_at])
+            seen[0] += 1
+            seen[1] = min(seen[1], created_at)
+            seen[2] = max(seen[2], created_at)
+        graph_rows.append((entry_id, tag_type, value, created_at, _epoch(created_at), entity_id))
+    conn.executemany(
+        "INSERT INTO knowledge_graph (entry_id, tag_type, tag_value, created_at, created_ts, entity_id) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        graph_rows
+    )
+    conn.executemany(
+        "UPDATE entities SET mention_count = mention_count + ?, "
+        "first_seen = MIN(first_seen, ?), last_seen = MAX(last_seen, ?) WHERE id = ?",
+        [(count, first, last, entity_id) for entity_id, (count, first, last) in mentions.items()]
+    )
+    _add_cooccurrences(conn, known, graph_rows)
+    _add_period_mentions(conn, graph_rows)
+    _bump_knowledge_version(conn)
+    _return_entity_indexes(conn, indexes)
+
+
+def save_tags(entry_id: int, tags: list[dict], username: str | None = None):
     """
     Save structured tags extracted from a journal entry.
     Each tag: {"type": "Event"|"Entity"|..., "value": "..."}
     """
+    save_tags_many({entry_id: tags}, username)
+
+
+def save_tags_many(tags_by_entry: dict[int, list[dict]], username: str | None = None):
+    """save_tags for many entries in one transaction. Mentions are dated by their entry."""
     now = datetime.now().isoformat()
-    with get_connection() as conn:
+    rows_by_entry = {
+        entry_id: [(str(t["type"]), str(t["value"])) for t in tags
+                   if isinstance(t, dict) and t.get("type") and t.get("value")]
+        for entry_id, tags in tags_by_entry.items()
+        if isinstance(tags, list)
+    }
+    rows_by_entry = {entry_id: rows for entry_id, rows in rows_by_entry.items() if rows}
+    if not rows_by_entry:
+        return
+    with _diary(username) as conn:
+        written: dict[int, str] = {}
+        entry_ids = list(rows_by_entry)
+        for i in range(0, len(entry_ids), 500):
+            chunk = entry_ids[i:i + 500]
+            for row in conn.execute(
+                f"SELECT id, created_at FROM journal_entries WHERE id IN ({','.join('?' * len(chunk))})",
+                chunk
+            ):
+                written[row["id"]] = row["created_at"]
+        _store_tags(conn, [
+            (entry_id, tag_type, value, written.get(entry_id, now))
+            for entry_id, rows in rows_by_entry.items()
+            for tag_type, value in rows
+        ])
         conn.executemany(
-            "INSERT INTO knowledge_graph (entry_id, tag_type, tag_value, created_at) VALUES (?, ?, ?, ?)",
-            [(entry_id, t.get("type", "Unknown"), t.get("value", ""), now) for t in tags]
+            "UPDATE journal_fts SET tags = tags || ' ' || ? WHERE rowid = ?",
+            [(" ".join(value for _, value in rows), entry_id)
+             for entry_id, rows in rows_by_entry.items()]
         )
 
 
-def get_all_tags() -> list[dict]:
-    with get_connection() as conn:
+def get_all_tags(username: str | None = None) -> list[dict]:
+    with _diary(username) as conn:
+        rows = conn.execute(
+            "SELECT tag_type, tag_value, created_at FROM knowledge_graph ORDER BY created_ts ASC, id ASC"
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def _rebuild_entities(conn):
+    """Resolve mentions that have no entity yet, then recount every entity from knowledge_graph."""
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    indexes = _take_entity_indexes(conn)
+    last_id = 0
+    while True:
+        chunk = conn.execute(
+            "SELECT id, tag_type, tag_value, created_at FROM knowledge_graph "
+            "WHERE id > ? AND entity_id IS NULL ORDER BY id LIMIT 1000",
+            (last_id,)
+        ).fetchall()
+        if not chunk:
+            break
+        last_id = chunk[-1]["id"]
+        conn.executemany(
+            "UPDATE knowledge_graph SET entity_id = ? WHERE id = ?",
+            [(_resolve_entity(conn, indexes, row["tag_type"], row["tag_value"], row["created_at"]), row["id"])
+             for row in chunk if normalize_tag_value(row["tag_value"])]
+        )
+    conn.execute(
+        """UPDATE entities SET
+             mention_count = (SELECT COUNT(*) FROM knowledge_graph k WHERE k.entity_id = entities.id),
+             first_seen = COALESCE((SELECT MIN(created_at) FROM knowledge_graph k
+                                    WHERE k.entity_id = entities.id), first_seen),
+             last_seen = COALESCE((SELECT MAX(created_at) FROM knowledge_graph k
+                                   WHERE k.entity_id = entities.id), last_seen)"""
+    )
+    conn.execute(
+        "DELETE FROM entity_aliases WHERE entity_id IN (SELECT id FROM entities WHERE mention_count = 0)"
+    )
+    conn.execute("DELETE FROM entities WHERE mention_count = 0")
+    _bump_knowledge_version(conn)
+    _forget_entity_indexes(conn)        # aliases may have been dropped
+
+
+def rebuild_knowledge_summary(username: str | None = None):
+    """Recompute the entities, their mention counts, edges and period rollups from the raw knowledge_graph rows."""
+    with _diary(username) as conn:
+        _rebuild_entities(conn)
+        _rebuild_entity_edges(conn)
+        _rebuild_entity_periods(conn)
+        _rebuild_tag_periods(conn)
+
+
+def find_entity(value: str, tag_type: str = "Entity", username: str | None = None) -> dict | None:
+    """The canonical entity a tag value resolves to (exact alias or fuzzy match), or None."""
+    key = normalize_tag_value(value)
+    if not key:
+        return None
+    with _diary(username) as conn:
+        entity_id = _alias_entity_id(conn, tag_type, key)
+        if entity_id is None:
+            indexes = _take_entity_indexes(conn)
+            try:
+                entity_id = _fuzzy_entity_id(conn, indexes, tag_type, key)
+            finally:
+                _return_entity_indexes(conn, indexes)
+        if entity_id is None:
+            return None
+        row = conn.execute("SELECT * FROM entities WHERE id = ?", (entity_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def get_entity_aliases(entity_id: int, username: str | None = None) -> list[str]:
+    """Every spelling recorded for an entity."""
+    with _diary(username) as conn:
+        rows = conn.execute(
+            "SELECT alias FROM entity_aliases WHERE entity_id = ? ORDER BY rowid", (entity_id,)
+        ).fetchall()
+    return [row["alias"] for row in rows]
+
+
+def merge_entities(source_id: int, target_id: int, username: str | None = None):
+    """Fold entity `source_id` into `target_id`: its aliases and mentions now count for the target."""
+    if source_id == target_id:
+        return
+    with _diary(username) as conn:
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        source = conn.execute("SELECT * FROM entities WHERE id = ?", (source_id,)).fetchone()
+        target = conn.execute("SELECT tag_type FROM entities WHERE id = ?", (target_id,)).fetchone()
+        if source is None or target is None:
+            raise ValueError(f"Unknown entity: {source_id if source is None else target_id}")
+        if source["tag_type"] != target["tag_type"]:
+            raise ValueError(f"Cannot merge a {source['tag_type']} into a {target['tag_type']}")
+        conn.execute("UPDATE entity_aliases SET entity_id = ? WHERE entity_id = ?", (target_id, source_id))
+        conn.execute("UPDATE knowledge_graph SET entity_id = ? WHERE entity_id = ?", (target_id, source_id))
+        _merge_entity_edges(conn, source_id, target_id)
+        _merge_entity_periods(conn, source_id, target_id)
+        conn.execute(
+            "UPDATE entities SET mention_count = mention_count + ?, first_seen = MIN(first_seen, ?), "
+            "last_seen = MAX(last_seen, ?) WHERE id = ?",
+            (source["mention_count"], source["first_seen"], source["last_seen"], target_id)
+        )
+        conn.execute("DELETE FROM entities WHERE id = ?", (source_id,))
+        _bump_knowledge_version(conn)
+        indexes = _take_entity_indexes(conn)
+        for index in indexes.values():
+            index.remap(source_id, target_id)
+        _return_entity_indexes(conn, indexes)
+
+
+def add_entity_alias(entity_id: int, alias: str, username: str | None = None):
+    """
+    Record that `alias` means entity `entity_id` (e.g. "mi madre" for "Mamá").
+    If the alias already names another entity, that entity is merged into this one.
+    """
+    key = normalize_tag_value(alias)
+    if not key:
+        return
+    with _diary(username) as conn:
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        entity = conn.execute("SELECT tag_type FROM entities WHERE id = ?", (entity_id,)).fetchone()
+        if entity is None:
+            raise ValueError(f"Unknown entity: {entity_id}")
+        row = conn.execute(
+            "SELECT entity_id FROM entity_aliases WHERE tag_type = ? AND alias_key = ?",
+            (entity["tag_type"], key)
+        ).fetchone()
+        if row:
+            merge_entities(row["entity_id"], entity_id, username)
+            return
+        conn.execute(
+            "INSERT INTO entity_aliases (tag_type, alias_key, entity_id, alias) VALUES (?, ?, ?, ?)",
+            (entity["tag_type"], key, entity_id, " ".join(alias.split()))
+        )
+        _bump_knowledge_version(conn)
+        indexes = _take_entity_indexes(conn)
+        indexes.setdefault(entity["tag_type"], entity_index.TrigramIndex()).add(key, entity_id)
+        _return_entity_indexes(conn, indexes)
+
+
+def get_knowledge_items(
+    candidates: int = 300, username: str | None = None, as_of: str | None = None
+) -> list[dict]:
+    """
+    Canonical entities with mention counts and first/last-seen dates, for
+    prompt_builder to rank. Only the `candidates` most mentioned plus the
+    `candidates` most recent are returned, so the cost stays bounded. With
+    `as_of`, counts and dates are what the diary held on that date, and
+    entities first mentioned later are left out (see _knowledge_as_of).
+    """
+    if as_of is not None:
+        with _diary(username) as conn:
+            return _top_knowledge(list(_knowledge_as_of(conn, as_of).values()), candidates)
+    with _diary(username) as conn:
         rows = conn.execute(
-            "SELECT tag_type, tag_value, created_at FROM knowledge_graph ORDER BY created_at ASC"
+            """SELECT id AS entity_id, tag_type, name AS tag_value, mention_count, first_seen, last_seen
+               FROM entities
+               WHERE id IN (SELECT id FROM entities
+                            ORDER BY mention_count DESC, last_seen DESC LIMIT ?)
+                  OR id IN (SELECT id FROM entities
+                            ORDER BY last_seen DESC LIMIT ?)""",
+            (candidates, candidates)
         ).fetchall()
     return [dict(row) for row in rows]
 
 
-def get_knowledge_summary() -> str:
-    """Returns a formatted summary of all knowledge graph tags for AI context."""
-    tags = get_all_tags()
-    if not tags:
-        return "No memories recorded yet."
+def get_knowledge_summary(username: str | None = None) -> str:
+    """
+    Returns a formatted summary of all canonical entities for AI context.
+    Cached until the knowledge graph changes.
+    """
+    key = str(diary_path(username))
+    with _diary(username) as conn:
+        row = conn.execute(
+            "SELECT value FROM meta WHERE key = ?", (KNOWLEDGE_VERSION_KEY,)
+        ).fetchone()
+        version = row["value"] if row else "0"
+        cached = _summary_cache.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        # ids follow first appearance, so types and values keep diary order
+        rows = conn.execute(
+            "SELECT tag_type, name AS tag_value FROM entities ORDER BY id ASC"
+        ).fetchall()
+
+    if not rows:
+        summary = "No memories recorded yet."
+    else:
+        grouped: dict[str, list] = {}
+        for r in rows:
+            grouped.setdefault(r["tag_type"], []).append(r["tag_value"])
+        summary = "\n".join(
+            f"[{tag_type}]: {' | '.join(values)}" for tag_type, values in grouped.items()
+        )
+
+    _summary_cache[key] = (version, summary)
+    return summary
+
+
+# ── Entity graph ──────────────────────────────────────────────────────────────
+#
+# Two entities mentioned in the same entry are joined by an edge in
+# entity_edges. An edge's weight counts its co-occurrences, each one decaying
+# with EDGE_HALF_LIFE_DAYS from the date of its entry: `weight` is the value as
+# of `updated_ts`, and readers decay it the rest of the way to now. Edges are
+# added by save_tags/import_entries in the same transaction as the mentions.
+
+EDGE_HALF_LIFE_DAYS = 180
+NEIGHBOURS_PER_NODE = 8
+FOCUS_HOP_FACTOR = 0.5      # a neighbour's focus relative to the node it was reached from
+
+
+def _edge_decay(seconds: float) -> float:
+    return 0.5 ** (max(seconds, 0.0) / (EDGE_HALF_LIFE_DAYS * 86400))
+
+
+def _now_ts() -> float:
+    return _epoch(datetime.now().isoformat())
+
+
+def _entry_entities(conn, entry_ids: list[int]) -> dict[int, set[int]]:
+    """Entities already linked to each entry."""
+    known: dict[int, set[int]] = {}
+    for i in range(0, len(entry_ids), 500):
+        chunk = entry_ids[i:i + 500]
+        for row in conn.execute(
+            f"SELECT entry_id, entity_id FROM knowledge_graph "
+            f"WHERE entity_id IS NOT NULL AND entry_id IN ({','.join('?' * len(chunk))})",
+            chunk
+        ):
+            known.setdefault(row["entry_id"], set()).add(row["entity_id"])
+    return known
+
+
+def _add_cooccurrences(conn, known: dict[int, set[int]], graph_rows: list[tuple]):
+    """Edges for the entities new to each entry, with each other and with the entry's earlier ones."""
+    added: dict[int, tuple[set[int], float]] = {}
+    for entry_id, _, _, _, created_ts, entity_id in graph_rows:
+        if entity_id is not None and entity_id not in known.get(entry_id, ()):
+            added.setdefault(entry_id, (set(), created_ts))[0].add(entity_id)
+    pairs = []
+    for entry_id, (new, created_ts) in added.items():
+        old = known.get(entry_id, set())
+        for a in new:
+            for b in new | old:
+                if a != b and (b in old or a < b):
+                    pairs += [(a, b, created_ts), (b, a, created_ts)]
+    if not pairs:
+        return
+    conn.executemany(
+        """INSERT INTO entity_edges (source_id, target_id, weight, mentions, updated_ts)
+           VALUES (?, ?, 1.0, 1, ?)
+           ON CONFLICT(source_id, target_id) DO UPDATE SET
+             weight = CASE WHEN excluded.updated_ts >= updated_ts
+                           THEN weight * edge_decay(excluded.updated_ts - updated_ts) + 1
+                           ELSE weight + edge_decay(updated_ts - excluded.updated_ts) END,
+             mentions = mentions + 1,
+             updated_ts = MAX(updated_ts, excluded.updated_ts)""",
+        pairs
+    )
+
+
+def _rebuild_entity_edges(conn):
+    conn.execute("DELETE FROM entity_edges")
+    batch, current = [], None
+    for row in conn.execute(
+        "SELECT entry_id, entity_id, MIN(created_ts) AS created_ts FROM knowledge_graph "
+        "WHERE entity_id IS NOT NULL AND entry_id IS NOT NULL "
+        "GROUP BY entry_id, entity_id ORDER BY entry_id"
+    ):
+        # Flush only between entries, so every entry's pairs are in one batch
+        if row["entry_id"] != current and len(batch) >= 1000:
+            _add_cooccurrences(conn, {}, batch)
+            batch = []
+        current = row["entry_id"]
+        batch.append((row["entry_id"], None, None, None, row["created_ts"], row["entity_id"]))
+    if batch:
+        _add_cooccurrences(conn, {}, batch)
+
+
+def _merge_entity_edges(conn, source_id: int, target_id: int):
+    """Move entity `source_id`'s edges onto `target_id`, adding weights where both had one."""
+    now = _now_ts()
+    merged: dict[int, tuple[float, int, float]] = {}
+    for row in conn.execute(
+        "SELECT target_id, weight, mentions, updated_ts FROM entity_edges WHERE source_id IN (?, ?)",
+        (source_id, target_id)
+    ):
+        other = row["target_id"]
+        if other in (source_id, target_id):
+            continue
+        weight = row["weight"] * _edge_decay(now - row["updated_ts"])
+        total, mentions, _ = merged.get(other, (0.0, 0, now))
+        merged[other] = (total + weight, mentions + row["mentions"], now)
+    conn.execute(
+        "DELETE FROM entity_edges WHERE source_id IN (?, ?) OR target_id IN (?, ?)",
+        (source_id, target_id, source_id, target_id)
+    )
+    conn.executemany(
+        "INSERT INTO entity_edges (source_id, target_id, weight, mentions, updated_ts) VALUES (?, ?, ?, ?, ?)",
+        [edge for other, (weight, mentions, ts) in merged.items()
+         for edge in ((target_id, other, weight, mentions, ts), (other, target_id, weight, mentions, ts))]
+    )
+
+
+def _neighbours(conn, entity_id: int, limit: int, now: float, tag_type: str | None = None) -> list[dict]:
+    rows = conn.execute(
+        "SELECT e.id AS entity_id, e.tag_type, e.name, e.mention_count, g.weight, g.mentions, g.updated_ts "
+        "FROM entity_edges g JOIN entities e ON e.id = g.target_id "
+        "WHERE g.source_id = ?" + (" AND e.tag_type = ?" if tag_type else ""),
+        (entity_id, tag_type) if tag_type else (entity_id,)
+    ).fetchall()
+    found = []
+    for row in rows:
+        item = dict(row)
+        item["weight"] = row["weight"] * _edge_decay(now - item.pop("updated_ts"))
+        found.append(item)
+    found.sort(key=lambda it: (-it["weight"], it["entity_id"]))
+    return found[:limit]
+
+
+def get_related_entities(
+    entity_id: int, limit: int = 10, tag_type: str | None = None, username: str | None = None
+) -> list[dict]:
+    """
+    The entities most often mentioned together with `entity_id` (e.g. the people
+    around a place), strongest first: [{"entity_id", "tag_type", "name",
+    "mention_count", "weight", "mentions"}], weight decayed to today.
+    """
+    with _diary(username) as conn:
+        return _neighbours(conn, entity_id, limit, _now_ts(), tag_type)
+
+
+def get_entity_neighbourhood(
+    entity_ids: list[int],
+    hops: int = 2,
+    per_node: int = NEIGHBOURS_PER_NODE,
+    max_nodes: int = 40,
+    username: str | None = None,
+) -> dict:
+    """
+    The subgraph within `hops` edges of the seed entities, following each
+    node's `per_node` strongest edges. Returns {"nodes": [...], "edges": [...]}:
+    nodes carry "hops" and a "focus" score (1 for seeds, FOCUS_HOP_FACTOR × the
+    edge's share of its node's strongest edge per hop), highest focus first;
+    edges are {"source", "target", "weight"}.
+    """
+    now = _now_ts()
+    nodes: dict[int, dict] = {}
+    edges = []
+    with _diary(username) as conn:
+        if entity_ids:
+            for row in conn.execute(
+                f"SELECT id AS entity_id, tag_type, name, mention_count FROM entities "
+                f"WHERE id IN ({','.join('?' * len(entity_ids))})",
+                list(entity_ids)
+            ):
+                nodes[row["entity_id"]] = {**dict(row), "hops": 0, "focus": 1.0}
+        frontier = list(nodes)
+        for hop in range(1, hops + 1):
+            reached = []
+            for node_id in frontier:
+                neighbours = _neighbours(conn, node_id, per_node, now)
+                if not neighbours:
+                    continue
+                strongest = neighbours[0]["weight"] or 1.0
+                for n in neighbours:
+                    edges.append({"source": node_id, "target": n["entity_id"], "weight": n["weight"]})
+                    focus = nodes[node_id]["focus"] * FOCUS_HOP_FACTOR * n["weight"] / strongest
+                    known = nodes.get(n["entity_id"])
+                    if known is None:
+                        if len(nodes) >= max_nodes:
+                            continue
+                        nodes[n["entity_id"]] = {
+                            "entity_id": n["entity_id"], "tag_type": n["tag_type"], "name": n["name"],
+                            "mention_count": n["mention_count"], "hops": hop, "focus": focus,
+                        }
+                        reached.append(n["entity_id"])
+                    elif focus > known["focus"]:
+                        known["focus"] = focus
+            frontier = reached
+    pairs: dict[tuple[int, int], dict] = {}
+    for edge in edges:
+        if edge["target"] in nodes:
+            pairs.setdefault(tuple(sorted((edge["source"], edge["target"]))), edge)
+    return {
+        "nodes": sorted(nodes.values(), key=lambda n: (-n["focus"], n["entity_id"])),
+        "edges": list(pairs.values()),
+    }
+
+
+def find_entities_in_text(text: str, max_words: int = 4, username: str | None = None) -> list[dict]:
+    """Entities whose alias appears in `text` as a run of up to `max_words` words."""
+    words = normalize_tag_value(text).split()[:SEARCH_MAX_TERMS * 4]
+    keys = list({
+        " ".join(words[i:i + n])
+        for n in range(1, max_words + 1)
+        for i in range(len(words) - n + 1)
+    })
+    found: dict[int, dict] = {}
+    with _diary(username) as conn:
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            for row in conn.execute(
+                f"SELECT DISTINCT e.* FROM entity_aliases a JOIN entities e ON e.id = a.entity_id "
+                f"WHERE a.alias_key IN ({','.join('?' * len(chunk))})",
+                chunk
+            ):
+                found[row["id"]] = dict(row)
+    return sorted(found.values(), key=lambda e: (-e["mention_count"], e["id"]))
+
+
+def get_knowledge_items_for(
+    text: str,
+    candidates: int = 300,
+    hops: int = 2,
+    username: str | None = None,
+    as_of: str | None = None,
+) -> list[dict]:
+    """
+    get_knowledge_items focused on `text` (a Past Self question): the entities
+    it mentions and their neighbourhood are included and carry a "focus" score
+    that prompt_builder ranks first; the usual candidates fill the rest. With
+    `as_of`, entities not yet mentioned by then are dropped from the
+    neighbourhood (whose edge weights are still today's).
+    """
+    known = None
+    if as_of is not None:
+        with _diary(username) as conn:
+            known = _knowledge_as_of(conn, as_of)
+        items = {item["entity_id"]: item for item in _top_knowledge(list(known.values()), candidates)}
+    else:
+        items = {item["entity_id"]: item for item in get_knowledge_items(candidates, username)}
+    seeds = [e["id"] for e in find_entities_in_text(text, username=username)
+             if known is None or e["id"] in known]
+    if not seeds:
+        return list(items.values())
+    hood = get_entity_neighbourhood(seeds, hops=hops, username=username)
+    focus = {node["entity_id"]: node["focus"] for node in hood["nodes"]
+             if known is None or node["entity_id"] in known}
+    missing = [entity_id for entity_id in focus if entity_id not in items]
+    if known is not None:
+        items.update((entity_id, known[entity_id]) for entity_id in missing)
+    elif missing:
+        with _diary(username) as conn:
+            for row in conn.execute(
+                f"SELECT id AS entity_id, tag_type, name AS tag_value, mention_count, first_seen, last_seen "
+                f"FROM entities WHERE id IN ({','.join('?' * len(missing))})",
+                missing
+            ):
+                items[row["entity_id"]] = dict(row)
+    for entity_id, score in focus.items():
+        if entity_id in items:
+            items[entity_id]["focus"] = score
+    return list(items.values())
+
+
+# ── Knowledge over time ───────────────────────────────────────────────────────
+#
+# entity_periods holds each entity's mention count and first/last mention per
+# calendar year, month, ISO week and day of its entries; tag_periods holds the
+# mentions of each tag type per period. Both are kept up to date by
+# save_tags/import_entries in the same transaction as the mentions.
+#
+# What the diary knew on any date is the yearly rows before that year, the
+# monthly rows of that year before that month and the raw mentions of the month
+# so far: a bounded number of rows per entity however many years the diary
+# spans. The timeline reads one tag_periods row per bucket and tag type.
 
-    grouped: dict[str, list] = {}
-    for t in tags:
-        grouped.setdefault(t["tag_type"], []).append(t["tag_value"])
+def _iso_week(created_at: str) -> str:
+    year, week, _ = date.fromisoformat(created_at[:10]).isocalendar()
+    return f"{year}-W{week:02d}"
 
-    lines = []
-    for tag_type, values in grouped.items():
-        # Deduplicate while preserving order
-        seen = []
-        for v in values:
-            if v not in seen:
-                seen.append(v)
-        lines.append(f"[{tag_type}]: {' | '.join(seen)}")
 
-    return "\n".join(lines)
+ROLLUP_GRAINS: dict[str, Callable[[str], str]] = {
+    "year": lambda created_at: created_at[:4],
+    "month": lambda created_at: created_at[:7],
+    "week": _iso_week,
+    "day": lambda created_at: created_at[:10],
+}
+
+
+def _rollup_period(grain: str, created_at: str) -> str:
+    return ROLLUP_GRAINS[grain](created_at)
+
+_PERIOD_UPSERT = """
+    ON CONFLICT(grain, period, entity_id) DO UPDATE SET
+      mentions = mentions + excluded.mentions,
+      first_seen = MIN(first_seen, excluded.first_seen),
+      last_seen = MAX(last_seen, excluded.last_seen)"""
+
+
+def _add_period_mentions(conn, graph_rows: list[tuple]):
+    """Count new knowledge_graph rows into the period rollups of their entity and tag type."""
+    rollups: dict[tuple[str, str, int], list] = {}      # -> [mentions, first seen, last seen]
+    per_type: dict[tuple[str, str, str], int] = {}
+    for _, tag_type, _, created_at, _, entity_id in graph_rows:
+        if entity_id is None:
+            continue
+        for grain, period_of in ROLLUP_GRAINS.items():
+            period = period_of(created_at)
+            per_type[(grain, period, tag_type)] = per_type.get((grain, period, tag_type), 0) + 1
+            seen = rollups.setdefault((grain, period, entity_id), [0, created_at, created_at])
+            seen[0] += 1
+            seen[1] = min(seen[1], created_at)
+            seen[2] = max(seen[2], created_at)
+    conn.executemany(
+        "INSERT INTO entity_periods (grain, period, entity_id, mentions, first_seen, last_seen) "
+        "VALUES (?, ?, ?, ?, ?, ?)" + _PERIOD_UPSERT,
+        [(grain, period, entity_id, count, first, last)
+         for (grain, period, entity_id), (count, first, last) in rollups.items()]
+    )
+    conn.executemany(
+        "INSERT INTO tag_periods (grain, period, tag_type, mentions) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(grain, period, tag_type) DO UPDATE SET mentions = mentions + excluded.mentions",
+        [(grain, period, tag_type, count) for (grain, period, tag_type), count in per_type.items()]
+    )
+
+
+def _rebuild_entity_periods(conn):
+    conn.execute("DELETE FROM entity_periods")
+    for grain in ROLLUP_GRAINS:
+        conn.execute(
+            """INSERT INTO entity_periods (grain, period, entity_id, mentions, first_seen, last_seen)
+               SELECT ?, rollup_period(?, created_at) AS period, entity_id,
+                      COUNT(*), MIN(created_at), MAX(created_at)
+               FROM knowledge_graph WHERE entity_id IS NOT NULL
+               GROUP BY period, entity_id""",
+            (grain, grain)
+        )
+
+
+def _rebuild_tag_periods(conn):
+    conn.execute("DELETE FROM tag_periods")
+    for grain in ROLLUP_GRAINS:
+        conn.execute(
+            """INSERT INTO tag_periods (grain, period, tag_type, mentions)
+               SELECT ?, rollup_period(?, created_at) AS period, tag_type, COUNT(*)
+               FROM knowledge_graph WHERE entity_id IS NOT NULL
+               GROUP BY period, tag_type""",
+            (grain, grain)
+        )
+
+
+def _merge_entity_periods(conn, source_id: int, target_id: int):
+    conn.execute(
+        "INSERT INTO entity_periods (grain, period, entity_id, mentions, first_seen, last_seen) "
+        "SELECT grain, period, ?, mentions, first_seen, last_seen FROM entity_periods "
+        "WHERE entity_id = ?" + _PERIOD_UPSERT,
+        (target_id, source_id)
+    )
+    conn.execute("DELETE FROM entity_periods WHERE entity_id = ?", (source_id,))
+
+
+def _knowledge_as_of(conn, as_of: str) -> dict[int, dict]:
+    """Every entity mentioned on or before `as_of`, as get_knowledge_items rows counted up to then."""
+    end = _as_of_end(as_of)
+    year, month = end[:4], end[:7]
+    rows = conn.execute(
+        """SELECT e.id AS entity_id, e.tag_type, e.name AS tag_value, SUM(p.mentions) AS mention_count,
+                  MIN(p.first_seen) AS first_seen, MAX(p.last_seen) AS last_seen
+           FROM (SELECT entity_id, mentions, first_seen, last_seen FROM entity_periods
+                 WHERE grain = 'year' AND period < ?
+                 UNION ALL
+                 SELECT entity_id, mentions, first_seen, last_seen FROM entity_periods
+                 WHERE grain = 'month' AND period >= ? AND period < ?
+                 UNION ALL
+                 SELECT entity_id, 1, created_at, created_at FROM knowledge_graph
+                 WHERE created_ts >= ? AND created_ts <= ? AND entity_id IS NOT NULL) p
+           JOIN entities e ON e.id = p.entity_id
+           GROUP BY p.entity_id""",
+        (year, year, month, _epoch(f"{month}-01T00:00:00"), _epoch(end))
+    ).fetchall()
+    return {row["entity_id"]: dict(row) for row in rows}
+
+
+def _top_knowledge(items: list[dict], candidates: int) -> list[dict]:
+    """The `candidates` most mentioned plus the `candidates` most recent items."""
+    top = heapq.nlargest(candidates, items, key=lambda it: (it["mention_count"], it["last_seen"]))
+    recent = heapq.nlargest(candidates, items, key=lambda it: it["last_seen"])
+    return list({it["entity_id"]: it for it in top + recent}.values())
+
+
+# ── Timeline ──────────────────────────────────────────────────────────────────
+#
+# Tag activity over time, read from the period rollups above and never from
+# knowledge_graph itself, so a decade of daily entries costs what ten rows do.
+
+TIMELINE_TOP = 3
+
+
+def _period_range(grain: str, start: str | None, end: str | None) -> tuple[str, str]:
+    """First and last period keys of `grain` covering the ISO dates start..end (open ends if None)."""
+    period_of = ROLLUP_GRAINS.get(grain)
+    if period_of is None:
+        raise ValueError(f"Unknown grain: {grain} (expected one of {', '.join(ROLLUP_GRAINS)})")
+    return (period_of(start) if start else "", period_of(end) if end else "\uffff")
+
+
+def get_timeline(
+    grain: str = "month",
+    start: str | None = None,
+    end: str | None = None,
+    top: int = TIMELINE_TOP,
+    username: str | None = None,
+) -> list[dict]:
+    """
+    Tag activity per `grain` bucket ("day", "week", "month" or "year") between
+    the ISO dates `start` and `end`, both inclusive, oldest first. Buckets with
+    no mentions are left out.
+    [{"period", "total", "mentions": {tag_type: int},
+      "top": {tag_type: [{"entity_id", "name", "mentions"}]}}]
+    "top" lists the `top` most mentioned entities of each type in the bucket
+    (e.g. its people and its Sentiment/Trigger values).
+    """
+    low, high = _period_range(grain, start, end)
+    timeline: dict[str, dict] = {}
+    with _diary(username) as conn:
+        for row in conn.execute(
+            "SELECT period, tag_type, mentions FROM tag_periods "
+            "WHERE grain = ? AND period BETWEEN ? AND ? ORDER BY period",
+            (grain, low, high)
+        ):
+            bucket = timeline.setdefault(
+                row["period"], {"period": row["period"], "total": 0, "mentions": {}, "top": {}}
+            )
+            bucket["mentions"][row["tag_type"]] = row["mentions"]
+            bucket["total"] += row["mentions"]
+        if top > 0 and timeline:
+            for row in conn.execute(
+                """SELECT period, tag_type, entity_id, name, mentions FROM (
+                       SELECT p.period, e.tag_type, e.id AS entity_id, e.name, p.mentions,
+                              ROW_NUMBER() OVER (PARTITION BY p.period, e.tag_type
+                                                 ORDER BY p.mentions DESC, e.id) AS place
+                       FROM entity_periods p JOIN entities e ON e.id = p.entity_id
+                       WHERE p.grain = ? AND p.period BETWEEN ? AND ?)
+                   WHERE place <= ? ORDER BY period, tag_type, place""",
+                (grain, low, high, top)
+            ):
+                bucket = timeline.get(row["period"])
+                if bucket is not None:
+                    bucket["top"].setdefault(row["tag_type"], []).append(
+                        {"entity_id": row["entity_id"], "name": row["name"], "mentions": row["mentions"]}
+                    )
+    return list(timeline.values())
+
+
+def get_entity_timeline(
+    entity_id: int,
+    grain: str = "month",
+    start: str | None = None,
+    end: str | None = None,
+    username: str | None = None,
+) -> list[dict]:
+    """Mentions of one entity (e.g. a feeling) per `grain` bucket: [{"period", "mentions"}], oldest first."""
+    low, high = _period_range(grain, start, end)
+    with _diary(username) as conn:
+        rows = conn.execute(
+            "SELECT period, mentions FROM entity_periods "
+            "WHERE entity_id = ? AND grain = ? AND period BETWEEN ? AND ? ORDER BY period",
+            (entity_id, grain, low, high)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+# ── Sidebar aggregates ────────────────────────────────────────────────────────
+#
+# The sidebar is redrawn on every Streamlit rerun. Its numbers come from two
+# O(1) probes (knowledge version, newest entry id); the aggregate query behind
+# them only runs again after a write changed one of the two.
+
+_sidebar_cache: dict[str, tuple[tuple, dict]] = {}
+
+
+def get_sidebar_summary(preview: int = 3, username: str | None = None) -> dict:
+    """
+    {"entries": int, "tag_types": [{"tag_type", "values", "mentions", "preview": [...]}]}
+    Tag types in order of first appearance, each with its number of distinct
+    values, total mentions and its first `preview` values.
+    """
+    key = str(diary_path(username))
+    with _diary(username) as conn:
+        row = conn.execute(
+            """SELECT (SELECT value FROM meta WHERE key = ?) AS version,
+                      (SELECT MAX(id) FROM journal_entries) AS last_id""",
+            (KNOWLEDGE_VERSION_KEY,)
+        ).fetchone()
+        state = (row["version"], row["last_id"], preview)
+        cached = _sidebar_cache.get(key)
+        if cached and cached[0] == state:
+            return cached[1]
+
+        entries = conn.execute("SELECT COUNT(*) FROM journal_entries").fetchone()[0]
+        rows = conn.execute(
+            """SELECT tag_type, tag_value, type_values, type_mentions FROM (
+                   SELECT tag_type, name AS tag_value,
+                          ROW_NUMBER() OVER (PARTITION BY tag_type ORDER BY id) AS n,
+                          COUNT(*) OVER (PARTITION BY tag_type) AS type_values,
+                          SUM(mention_count) OVER (PARTITION BY tag_type) AS type_mentions,
+                          MIN(id) OVER (PARTITION BY tag_type) AS first_id
+                   FROM entities)
+               WHERE n <= ?
+               ORDER BY first_id, n""",
+            (preview,)
+        ).fetchall()
+
+    types: dict[str, dict] = {}
+    for r in rows:
+        item = types.setdefault(r["tag_type"], {
+            "tag_type": r["tag_type"],
+            "values": r["type_values"],
+            "mentions": r["type_mentions"],
+            "preview": [],
+        })
+        item["preview"].append(r["tag_value"])
+    summary = {"entries": entries, "tag_types": list(types.values())}
+    _sidebar_cache[key] = (state, summary)
+    return summary
+
+
+# ── Extraction Jobs ───────────────────────────────────────────────────────────
+#
+# status: pending → running → done. A failed attempt goes back to pending with
+# an exponentially growing next_attempt_at, so transient API errors heal on
+# their own. Jobs are keyed by entry_id, which makes enqueueing idempotent.
+
+JOB_BACKOFF_BASE_S = 10
+JOB_BACKOFF_MAX_S = 3600
+JOB_LEASE_S = 600   # a "running" job older than this is assumed abandoned
+
+
+def enqueue_extraction(entry_id: int, username: str | None = None):
+    """Queue tag extraction for an entry. Does nothing if it is already queued or done."""
+    now = datetime.now().isoformat()
+    with _diary(username) as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO extraction_jobs (entry_id, status, next_attempt_at, updated_at) "
+            "VALUES (?, 'pending', ?, ?)",
+            (entry_id, now, now)
+        )
+
+
+def claim_extraction_jobs(limit: int = 1, username: str | None = None) -> list[dict]:
+    """
+    Mark up to `limit` due jobs as running and return them with the entry text.
+    Each job is claimed with a conditional UPDATE, so two workers never get the same one.
+    """
+    now = datetime.now()
+    stale = (now - timedelta(seconds=JOB_LEASE_S)).isoformat()
+    now = now.isoformat()
+    claimed = []
+    with _diary(username) as conn:
+        candidates = conn.execute(
+            """SELECT j.entry_id, j.status, j.attempts, j.updated_at, e.content
+               FROM extraction_jobs j JOIN journal_entries e ON e.id = j.entry_id
+               WHERE (j.status = 'pending' AND j.next_attempt_at <= ?)
+                  OR (j.status = 'running' AND j.updated_at <= ?)
+               ORDER BY j.next_attempt_at ASC
+               LIMIT ?""",
+            (now, stale, limit)
+        ).fetchall()
+        for row in candidates:
+            cursor = conn.execute(
+                "UPDATE extraction_jobs SET status = 'running', updated_at = ? "
+                "WHERE entry_id = ? AND status = ? AND updated_at = ?",
+                (now, row["entry_id"], row["status"], row["updated_at"])
+            )
+            if cursor.rowcount:
+                claimed.append({
+                    "entry_id": row["entry_id"],
+                    "attempts": row["attempts"],
+                    "content": row["content"],
+                })
+    return claimed
+
+
+def complete_extraction_job(entry_id: int, tags: list[dict], username: str | None = None):
+    """Store the extracted tags and mark the job done, exactly once per entry."""
+    complete_extraction_jobs({entry_id: tags}, username)
+
+
+def complete_extraction_jobs(tags_by_entry: dict[int, list[dict]], username: str | None = None) -> dict[int, str]:
+    """
+    complete_extraction_job for a batch of entries, in one transaction.
+    An entry whose tags cannot be stored is left as it was and returned with
+    its error message, for the caller to pass on to fail_extraction_job.
+    """
+    if not tags_by_entry:
+        return {}
+    now = datetime.now().isoformat()
+    failed: dict[int, str] = {}
+    with _diary(username) as conn:
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        done = {
+            row["entry_id"] for row in conn.execute(
+                f"SELECT entry_id FROM extraction_jobs WHERE status = 'done' "
+                f"AND entry_id IN ({','.join('?' * len(tags_by_entry))})",
+                list(tags_by_entry)
+            )
+        }
+        fresh = {entry_id: tags for entry_id, tags in tags_by_entry.items() if entry_id not in done}
+        if _save_tags_savepoint(conn, fresh, username) is not None:
+            # Entry by entry, so an answer that cannot be stored fails only its own job
+            for entry_id in list(fresh):
+                error = _save_tags_savepoint(conn, {entry_id: fresh[entry_id]}, username)
+                if error is not None:
+                    failed[entry_id] = error
+                    del fresh[entry_id]
+        conn.executemany(
+            "INSERT INTO extraction_jobs (entry_id, status, next_attempt_at, updated_at) "
+            "VALUES (?, 'done', ?, ?) "
+            "ON CONFLICT(entry_id) DO UPDATE SET status = 'done', last_error = NULL, "
+            "updated_at = excluded.updated_at",
+            [(entry_id, now, now) for entry_id in fresh]
+        )
+    return failed
+
+
+def _save_tags_savepoint(conn, tags_by_entry: dict[int, list[dict]], username: str | None) -> str | None:
+    """save_tags_many under a savepoint: None once stored, else the error, with nothing written."""
+    conn.execute("SAVEPOINT save_tags")
+    try:
+        save_tags_many(tags_by_entry, username)
+    except Exception as e:
+        conn.execute("ROLLBACK TO save_tags")
+        _forget_entity_indexes(conn)        # may hold rolled-back aliases
+        return f"{type(e).__name__}: {e}"
+    finally:
+        conn.execute("RELEASE save_tags")
+    return None
+
+
+def fail_extraction_job(entry_id: int, error: str, username: str | None = None):
+    """Record a failed attempt and schedule the retry with exponential backoff."""
+    now = datetime.now()
+    with _diary(username) as conn:
+        row = conn.execute(
+            "SELECT attempts FROM extraction_jobs WHERE entry_id = ?", (entry_id,)
+        ).fetchone()
+        attempts = (row["attempts"] if row else 0) + 1
+        delay = min(JOB_BACKOFF_BASE_S * 2 ** (attempts - 1), JOB_BACKOFF_MAX_S)
+        conn.execute(
+            "UPDATE extraction_jobs SET status = 'pending', attempts = ?, last_error = ?, "
+            "next_attempt_at = ?, updated_at = ? WHERE entry_id = ?",
+            (attempts, error[:500], (now + timedelta(seconds=delay)).isoformat(),
+             now.isoformat(), entry_id)
+        )
+
+
+def retry_extraction_jobs_now(username: str | None = None):
+    """Make every job waiting on a retry backoff due now (e.g. after the API key was replaced)."""
+    now = datetime.now().isoformat()
+    with _diary(username) as conn:
+        conn.execute(
+            "UPDATE extraction_jobs SET next_attempt_at = ? "
+            "WHERE status = 'pending' AND attempts > 0 AND next_attempt_at > ?",
+            (now, now)
+        )
+
+
+def seconds_until_next_extraction(username: str | None = None) -> float | None:
+    """How long until the earliest pending job is due (0 if overdue, None if the queue is empty)."""
+    with _diary(username) as conn:
+        row = conn.execute(
+            "SELECT MIN(next_attempt_at) AS due FROM extraction_jobs WHERE status = 'pending'"
+        ).fetchone()
+    if not row["due"]:
+        return None
+    return max(0.0, (datetime.fromisoformat(row["due"]) - datetime.now()).total_seconds())
+
+
+def get_extraction_status(username: str | None = None) -> dict:
+    """Counts for the sidebar: pending, running, retrying (pending after ≥1 failure), done."""
+    with _diary(username) as conn:
+        row = conn.execute(
+            """SELECT
+                 SUM(status = 'pending')                  AS pending,
+                 SUM(status = 'running')                  AS running,
+                 SUM(status = 'pending' AND attempts > 0) AS retrying,
+                 SUM(status = 'done')                     AS done
+               FROM extraction_jobs"""
+        ).fetchone()
+    return {k: row[k] or 0 for k in ("pending", "running", "retrying", "done")}
@@ -0,0 +1,258 @@
+"""
+memory_index.py
+---------------
+Local "related memories" index for AI of Memories.
+Each journal entry becomes a hashed TF-IDF vector (signed feature hashing of
+accent-folded words into DIM buckets) stored as one row of a memory-mapped
+float32 matrix next to memories.db. Lookups are a single matrix-vector product,
+so finding the nearest past entries takes milliseconds without touching SQLite.
+
+Nothing leaves the machine: there is no embedding model, only word statistics.
+Requires NumPy; memories_db treats the index as optional when it is missing.
+
+Files, for an index at <prefix>:
+  <prefix>.vec       float32 matrix, `capacity` rows × DIM (rows past `count` are unused)
+  <prefix>.ids       int64 entry id of each row
+  <prefix>.df.npy    document frequency per bucket (for IDF)
+  <prefix>.json      {"dim", "count", "capacity", "last_id"}
+  <prefix>.lock      held while appending, so two processes (the app and the
+                     importer CLI) never write rows from stale offsets
+"""
+
+import json
+import math
+import os
+import re
+import threading
+import unicodedata
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Callable
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+    import msvcrt
+
+DIM = 256
+INITIAL_CAPACITY = 1024
+
+_WORD = re.compile(r"\w+")
+
+
+def _tokens(text: str) -> list[str]:
+    folded = unicodedata.normalize("NFKD", text.casefold())
+    folded = "".join(c for c in folded if not unicodedata.combining(c))
+    return [t for t in _WORD.findall(folded) if len(t) > 2]
+
+
+@contextmanager
+def _file_lock(path: Path):
+    """Exclusive lock on `path` across processes, held for the `with` block."""
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def vectorize(text: str, dim: int = DIM) -> np.ndarray:
+    """
+    Signed hashed term-frequency vector with sublinear tf, L2-normalised.
+    IDF is applied at query time so stored rows never need rewriting.
+    """
+    counts: dict[str, int] = {}
+    for tok in _tokens(text):
+        counts[tok] = counts.get(tok, 0) + 1
+    vec = np.zeros(dim, dtype=np.float32)
+    for tok, n in counts.items():
+        h = zlib.crc32(tok.encode("utf-8"))
+        sign = 1.0 if h & 0x80000000 else -1.0
+        vec[h % dim] += sign * (1.0 + math.log(n))
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm else vec
+
+
+class MemoryIndex:
+    """Append-only nearest-neighbour index over entry vectors."""
+
+    def __init__(self, prefix, dim: int = DIM):
+        self.prefix = Path(prefix)
+        self._lock = threading.Lock()
+        meta_path = self._path(".json")
+        if meta_path.exists():
+            meta = json.loads(meta_path.read_text())
+            self.dim = meta["dim"]
+            self.count = meta["count"]
+            self.capacity = meta["capacity"]
+            self.last_id = meta["last_id"]
+            self.df = np.load(self._path(".df.npy"))
+        else:
+            self.dim = dim
+            self.count = 0
+            self.capacity = 0
+            self.last_id = 0
+            self.df = np.zeros(dim, dtype=np.float64)
+        self._open(max(self.capacity, INITIAL_CAPACITY))
+
+    def _path(self, suffix: str) -> Path:
+        return self.prefix.with_name(self.prefix.name + suffix)
+
+    def _open(self, capacity: int):
+        """(Re)map the matrix and id files, growing them to `capacity` rows."""
+        for suffix, itemsize in ((".vec", 4 * self.dim), (".ids", 8)):
+            path = self._path(suffix)
+            path.touch(exist_ok=True)
+            with open(path, "r+b") as f:
+                # Never shrink: another process may already have grown and filled it
+                if f.seek(0, os.SEEK_END) < capacity * itemsize:
+                    f.truncate(capacity * itemsize)
+        self.capacity = capacity
+        self.matrix = np.memmap(self._path(".vec"), dtype=np.float32, mode="r+",
+                                shape=(capacity, self.dim))
+        self.ids = np.memmap(self._path(".ids"), dtype=np.int64, mode="r+",
+                             shape=(capacity,))
+
+    def _replace(self, suffix: str, write: Callable[[BinaryIO], None]):
+        """Write a metadata file beside the index and swap it in atomically."""
+        path = self._path(suffix)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+
+    def _save_meta(self):
+        # The .json is written last: until it is replaced, a reader (or a
+        # restart after a crash) still sees the previous, consistent count.
+        self.matrix.flush()
+        self.ids.flush()
+        self._replace(".df.npy", lambda f: np.save(f, self.df))
+        meta = json.dumps({
+            "dim": self.dim, "count": self.count,
+            "capacity": self.capacity, "last_id": self.last_id,
+        })
+        self._replace(".json", lambda f: f.write(meta.encode()))
+
+    def _reload(self):
+        """Pick up rows another process appended since this one last read the metadata."""
+        meta_path = self._path(".json")
+        if not meta_path.exists():
+            return
+        meta = json.loads(meta_path.read_text())
+        if (meta["count"], meta["last_id"]) == (self.count, self.last_id):
+            return
+        self.df = np.load(self._path(".df.npy"))
+        if meta["capacity"] > self.capacity:
+            del self.matrix, self.ids
+            self._open(meta["capacity"])
+        self.count = meta["count"]
+        self.last_id = meta["last_id"]
+
+    def refresh(self):
+        """Reload the metadata, in case another process has added entries."""
+        with self._lock:
+            self._reload()
+
+    def add_vectors(self, entry_ids, vectors: np.ndarray):
+        """
+        Append pre-computed rows (entry ids must be increasing). Ids another
+        process has already appended are skipped.
+        """
+        if not len(entry_ids):
+            return
+        with self._lock, _file_lock(self._path(".lock")):
+            self._reload()
+            fresh = [i for i, entry_id in enumerate(entry_ids) if entry_id > self.last_id]
+            if not fresh:
+                return
+            entry_ids = [entry_ids[i] for i in fresh]
+            vectors = vectors[fresh]
+            n = len(entry_ids)
+            needed = self.count + n
+            if needed > self.capacity:
+                capacity = self.capacity
+                while capacity < needed:
+                    capacity *= 2
+                del self.matrix, self.ids
+                self._open(capacity)
+            self.matrix[self.count:needed] = vectors
+            self.ids[self.count:needed] = entry_ids
+            self.df += (vectors != 0).sum(axis=0)
+            self.count = needed
+            self.last_id = int(entry_ids[-1])
+            self._save_meta()
+
+    def add(self, entry_id: int, text: str):
+        self.add_many([(entry_id, text)])
+
+    def add_many(self, items: list[tuple[int, str]]):
+        """Vectorize and append (entry_id, text) pairs."""
+        if not items:
+            return
+        vectors = np.stack([vectorize(text, self.dim) for _, text in items])
+        self.add_vectors([entry_id for entry_id, _ in items], vectors)
+
+    def search(self, text: str, k: int = 5, exclude_ids=(), only_ids=None) -> list[tuple[int, float]]:
+        """Top-k (entry_id, score) by TF-IDF similarity, best first; `only_ids` restricts the candidates."""
+        query = vectorize(text, self.dim)
+        if not self.count or not query.any():
+            return []
+        with self._lock:
+            count = self.count
+            idf = np.log((1.0 + count) / (1.0 + self.df)).astype(np.float32) + 1.0
+            weights = query * idf
+            weights *= idf / (np.linalg.norm(weights) or 1.0)
+            scores = self.matrix[:count] @ weights
+            ids = self.ids[:count]
+            if only_ids is not None:
+                scores = np.where(np.isin(ids, np.asarray(list(only_ids), dtype=np.int64)), scores, 0.0)
+
+            want = min(k + len(exclude_ids), count)
+            top = np.argpartition(-scores, want - 1)[:want]
+            top = top[np.argsort(-scores[top])]
+            results = []
+            for i in top:
+                entry_id = int(ids[i])
+                if entry_id in exclude_ids or scores[i] <= 0:
+                    continue
+                results.append((entry_id, float(scores[i])))
+                if len(results) == k:
+                    break
+        return results
+
+
+MAX_OPEN_INDEXES = 32
+
+_indexes: OrderedDict[str, MemoryIndex] = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def open_index(prefix) -> MemoryIndex:
+    """
+    Shared MemoryIndex per file prefix (one mapping per process). Only the
+    MAX_OPEN_INDEXES most recently used stay mapped; evicted ones are unmapped
+    once the last caller drops them and reopen from disk on the next use.
+    """
+    key = str(prefix)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = MemoryIndex(prefix)
+        _indexes.move_to_end(key)
+        while len(_indexes) > MAX_OPEN_INDEXES:
+            _indexes.popitem(last=False)
+    return index
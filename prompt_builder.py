@@ -0,0 +1,199 @@
+"""
+prompt_builder.py
+-----------------
+Token-budgeted prompt assembly for ai_engine.
+A prompt is built from four sections — profile, knowledge graph, diary entries
+and conversation history — that share one token budget. Each section gets a
+fixed share; whatever a section does not need is handed, in priority order, to
+the sections that want more. Knowledge items are ranked by how often and how
+recently they were mentioned, entries keep their retrieval order, and history
+keeps the newest turns (older ones arrive as a running summary, see
+ai_engine.ConversationMemory). Every cut is deterministic, so the same diary state
+always yields the same prompt.
+
+Tokens are estimated (≈4 characters per token), which is close enough for
+budgeting and needs no tokenizer download.
+"""
+
+import math
+from datetime import datetime
+
+import telemetry
+
+CHARS_PER_TOKEN = 4
+CONTEXT_TOKEN_BUDGET = 6000
+
+# Share of the budget reserved for each section, highest priority first.
+SECTION_SHARES = (
+    ("profile", 0.10),
+    ("entries", 0.35),
+    ("knowledge", 0.30),
+    ("history", 0.25),
+)
+
+RECENCY_HALF_LIFE_DAYS = 90
+FOCUS_WEIGHT = 4.0          # boost for items near the entities a question mentions (item["focus"], 0–1)
+TAG_TYPE_ORDER = ("Entity", "Event", "Sentiment/Trigger", "Core Belief", "Syntax")
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to roughly max_tokens, on a word boundary, marking the cut with …"""
+    limit = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    if limit <= 1:
+        return ""
+    cut = text[:limit - 1]
+    space = cut.rfind(" ")
+    if space > limit // 2:
+        cut = cut[:space]
+    return cut.rstrip() + "…"
+
+
+# ── Sections ──────────────────────────────────────────────────────────────────
+
+def _knowledge_score(item: dict, now: datetime) -> float:
+    """Frequency (log of mentions) weighted by an exponential recency decay and the item's focus."""
+    try:
+        age_days = (now - datetime.fromisoformat(item["last_seen"])).total_seconds() / 86400
+    except (KeyError, TypeError, ValueError):
+        age_days = 0.0
+    recency = 0.5 ** (max(age_days, 0.0) / RECENCY_HALF_LIFE_DAYS)
+    focus = 1.0 + FOCUS_WEIGHT * item.get("focus", 0.0)
+    return math.log1p(item.get("mention_count", 1)) * (0.5 + recency) * focus
+
+
+def rank_knowledge(items: list[dict], now: datetime | None = None) -> list[dict]:
+    """Most relevant first; ties broken by type and value so the order is stable."""
+    now = now or datetime.now()
+    return sorted(
+        items,
+        key=lambda it: (-_knowledge_score(it, now), it["tag_type"], it["tag_value"]),
+    )
+
+
+def render_knowledge(ranked: list[dict], max_tokens: int) -> str:
+    """Greedily keep top-ranked items that fit, then group them by tag type."""
+    kept: dict[str, list[str]] = {}
+    used = 0
+    for item in ranked:
+        cost = estimate_tokens(item["tag_value"]) + 1     # + separator
+        header = 0 if item["tag_type"] in kept else estimate_tokens(f"[{item['tag_type']}]: ")
+        if used + cost + header > max_tokens:
+            continue
+        kept.setdefault(item["tag_type"], []).append(item["tag_value"])
+        used += cost + header
+    order = {t: i for i, t in enumerate(TAG_TYPE_ORDER)}
+    return "\n".join(
+        f"[{tag_type}]: {' | '.join(values)}"
+        for tag_type, values in sorted(kept.items(), key=lambda kv: (order.get(kv[0], len(order)), kv[0]))
+    )
+
+
+def format_entry(entry: dict) -> str:
+    return f"[{entry['created_at'][:10]}]: {entry['content']}"
+
+
+def render_entries(entries: list[dict], max_tokens: int) -> str:
+    """Keep entries in the given (relevance) order while they fit; never split one
+    except the first, which is truncated rather than dropped."""
+    parts = []
+    used = 0
+    for entry in entries:
+        text = format_entry(entry)
+        cost = estimate_tokens(text) + 1
+        if used + cost > max_tokens:
+            if not parts:
+                parts.append(truncate_to_tokens(text, max_tokens))
+            continue
+        parts.append(text)
+        used += cost
+    return "\n\n".join(parts)
+
+
+def fit_history(history: list[dict], max_tokens: int) -> list[dict]:
+    """The newest turns whose combined size fits; older turns are dropped whole."""
+    kept = []
+    used = 0
+    for msg in reversed(history):
+        cost = estimate_tokens(msg["content"]) + 4     # role/turn overhead
+        if used + cost > max_tokens:
+            break
+        kept.append(msg)
+        used += cost
+    kept.reverse()
+    return kept
+
+
+# ── Budget allocation ─────────────────────────────────────────────────────────
+
+def allocate(wanted: dict[str, int], total: int = CONTEXT_TOKEN_BUDGET) -> dict[str, int]:
+    """
+    Split `total` tokens across sections. Each section first gets
+    min(wanted, share × total); leftover tokens then go to sections that still
+    want more, in SECTION_SHARES priority order.
+    """
+    budget = {}
+    for name, share in SECTION_SHARES:
+        budget[name] = min(wanted.get(name, 0), int(total * share))
+    spare = total - sum(budget.values())
+    for name, _ in SECTION_SHARES:
+        if spare <= 0:
+            break
+        extra = min(wanted.get(name, 0) - budget[name], spare)
+        if extra > 0:
+            budget[name] += extra
+            spare -= extra
+    return budget
+
+
+def build_context(
+    profile_text: str,
+    knowledge_items: list[dict],
+    entries: list[dict],
+    history: list[dict],
+    total_tokens: int = CONTEXT_TOKEN_BUDGET,
+    history_summary: str = "",
+    now: datetime | None = None,
+) -> dict:
+    """
+    Fit every section into total_tokens. `history_summary` (the running summary
+    of turns older than `history`) shares the history budget, taking at most half.
+    Knowledge recency is measured from `now` (a Past Self date; today by default).
+    Returns {"profile", "knowledge", "entries", "history_summary": str,
+    "history": list[dict], "tokens": dict}.
+    """
+    ranked = rank_knowledge(knowledge_items, now)
+    wanted = {
+        "profile": estimate_tokens(profile_text),
+        "knowledge": sum(estimate_tokens(it["tag_value"]) + 1 for it in ranked)
+                     + 8 * len({it["tag_type"] for it in ranked}),
+        "entries": sum(estimate_tokens(format_entry(e)) + 1 for e in entries),
+        "history": sum(estimate_tokens(m["content"]) + 4 for m in history)
+                   + estimate_tokens(history_summary),
+    }
+    budget = allocate(wanted, total_tokens)
+    summary = truncate_to_tokens(
+        history_summary, min(estimate_tokens(history_summary), budget["history"] // 2)
+    )
+
+    sections = {
+        "profile": truncate_to_tokens(profile_text, budget["profile"]),
+        "knowledge": render_knowledge(ranked, budget["knowledge"]),
+        "entries": render_entries(entries, budget["entries"]),
+        "history_summary": summary,
+        "history": fit_history(history, budget["history"] - estimate_tokens(summary)),
+    }
+    sections["tokens"] = {
+        "profile": estimate_tokens(sections["profile"]),
+        "knowledge": estimate_tokens(sections["knowledge"]),
+        "entries": estimate_tokens(sections["entries"]),
+        "history": sum(estimate_tokens(m["content"]) + 4 for m in sections["history"])
+                   + estimate_tokens(summary),
+    }
+    telemetry.note("prompt_tokens", {**sections["tokens"], "budget": total_tokens})
+    return sections
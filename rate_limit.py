@@ -0,0 +1,234 @@
+"""
+rate_limit.py
+-------------
+Client-side rate limiting for model requests, shared by every thread of the
+process (Streamlit sessions, tag workers, importer drains).
+
+Each API key gets one Limiter: a token bucket (requests per minute, with a
+burst allowance) and a cap on requests in flight. Waiting requests are served
+by priority, then arrival order, so an interactive call (a margin note, a Past
+Self reply) overtakes queued background work (tag extraction, summaries,
+backfills); background work may also never take the last RESERVED_SLOTS
+concurrency slots.
+
+When the API answers with a quota error (429) or an overload (503) the whole
+key pauses for the retry-after delay the error carries, or an exponential
+backoff when it carries none, and its refill rate is halved; every success
+gives back a share of the configured rate. Bursts therefore settle near the
+quota the key actually has instead of turning into error storms.
+
+Environment (defaults for every key; configure() overrides one key):
+  AI_MEMORIES_RPM          requests per minute (default 60; 0 = unlimited)
+  AI_MEMORIES_BURST        requests allowed back to back (default 10)
+  AI_MEMORIES_CONCURRENCY  requests in flight per key (default 4)
+"""
+
+import heapq
+import itertools
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+DEFAULT_RPM = 60
+DEFAULT_BURST = 10
+DEFAULT_CONCURRENCY = 4
+RESERVED_SLOTS = 1          # concurrency slots only interactive requests may use
+MIN_RATE_SHARE = 1 / 8      # the refill rate never drops below this share of the configured one
+RECOVERY_SHARE = 0.05       # share of the configured rate regained per successful request
+MAX_BACKOFF_S = 60.0
+
+_RETRY_PATTERNS = (
+    re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)"),
+    re.compile(r"retry in\s+([\d.]+)\s*s", re.IGNORECASE),
+    re.compile(r"retry[- ]after:?\s+([\d.]+)", re.IGNORECASE),
+)
+
+
+# ── Error classification ──────────────────────────────────────────────────────
+
+def is_rate_limited(exc: BaseException) -> bool:
+    """True for quota (429) and overload (503) errors, from the real API or fake_gemini."""
+    code = getattr(exc, "code", None)
+    code = getattr(code, "value", code)     # grpc.StatusCode / HTTPStatus
+    if code in (429, 503):
+        return True
+    return type(exc).__name__ in ("ResourceExhausted", "TooManyRequests", "ServiceUnavailable")
+
+
+def retry_after(exc: BaseException) -> float | None:
+    """The retry delay a rate-limit error asks for, in seconds; None when it gives none."""
+    for detail in getattr(exc, "details", None) or ():
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None and hasattr(delay, "seconds"):
+            return delay.seconds + getattr(delay, "nanos", 0) / 1e9
+    text = str(exc)
+    for pattern in _RETRY_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+# ── Limiter ───────────────────────────────────────────────────────────────────
+
+class Limiter:
+    """Token bucket plus bounded concurrency for one API key, served in priority order."""
+
+    def __init__(self, rpm: float = DEFAULT_RPM, burst: int = DEFAULT_BURST,
+                 concurrency: int = DEFAULT_CONCURRENCY, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock         # injectable so tests can move time by hand
+        self._cond = threading.Condition()
+        self._waiting: list[tuple[int, int]] = []    # heap of (priority, arrival)
+        self._arrivals = itertools.count()
+        self._active = 0
+        self._blocked_until = 0.0
+        self._failures = 0          # consecutive rate-limit errors
+        self.throttled = 0          # rate-limit errors seen
+        self.configure(rpm, burst, concurrency)
+
+    def configure(self, rpm: float, burst: int, concurrency: int):
+        with self._cond:
+            self.rpm = rpm
+            self.burst = max(1, burst)
+            self.concurrency = max(1, concurrency)
+            self._rate = rpm / 60
+            self._tokens = float(self.burst)
+            self._refilled_at = self._clock()
+            self._cond.notify_all()
+
+    def _refill(self, now: float):
+        if self.rpm:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self._rate)
+        self._refilled_at = now
+
+    def _wait_time(self, ticket: tuple[int, int], now: float) -> float | None:
+        """0 if `ticket` may go now; else seconds to wait (None: until notified)."""
+        if self._waiting[0] != ticket:
+            return None
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        slots = self.concurrency if ticket[0] == INTERACTIVE else max(1, self.concurrency - RESERVED_SLOTS)
+        if self._active >= slots:
+            return None
+        if self.rpm and self._tokens < 1:
+            return (1 - self._tokens) / self._rate
+        return 0
+
+    def acquire(self, priority: int = BACKGROUND):
+        """Block until this request may be sent; pair with release()."""
+        with self._cond:
+            ticket = (priority, next(self._arrivals))
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    now = self._clock()
+                    self._refill(now)
+                    wait = self._wait_time(ticket, now)
+                    if wait == 0:
+                        break
+                    self._cond.wait(wait)
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            if self.rpm:
+                self._tokens -= 1
+            self._active += 1
+            self._cond.notify_all()
+
+    def release(self, error: BaseException | None = None):
+        """Free the slot; a rate-limit `error` pauses the key and slows its refill."""
+        with self._cond:
+            self._active -= 1
+            base = self.rpm / 60
+            if error is not None and is_rate_limited(error):
+                self.throttled += 1
+                self._failures += 1
+                delay = retry_after(error)
+                if delay is None:
+                    delay = min(MAX_BACKOFF_S, 2 ** (self._failures - 1))
+                self._blocked_until = max(self._blocked_until, self._clock() + delay)
+                self._tokens = min(self._tokens, 0.0)
+                if base:
+                    self._rate = max(base * MIN_RATE_SHARE, self._rate / 2)
+            elif error is None:
+                self._failures = 0
+                if base:
+                    self._rate = min(base, self._rate + base * RECOVERY_SHARE)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority: int = BACKGROUND):
+        """Hold one request slot for the body of the with-block."""
+        self.acquire(priority)
+        try:
+            yield
+        except Exception as e:
+            self.release(e)
+            raise
+        except BaseException:
+            self.release(RuntimeError("cancelled"))    # e.g. a stream closed early: not a quota signal
+            raise
+        else:
+            self.release()
+
+    def blocked_for(self) -> float:
+        """Seconds until the key may send again after a rate-limit error (0: not paused)."""
+        with self._cond:
+            return max(0.0, self._blocked_until - self._clock())
+
+    def stats(self) -> dict:
+        with self._cond:
+            self._refill(self._clock())
+            return {
+                "rpm": self.rpm,
+                "current_rpm": round(self._rate * 60, 1),
+                "tokens": round(self._tokens, 2),
+                "active": self._active,
+                "waiting": len(self._waiting),
+                "blocked_for": round(max(0.0, self._blocked_until - self._clock()), 2),
+                "throttled": self.throttled,
+            }
+
+
+# ── Per-key registry ──────────────────────────────────────────────────────────
+
+_limiters: dict[str, Limiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def _defaults() -> dict:
+    return {
+        "rpm": float(os.getenv("AI_MEMORIES_RPM", DEFAULT_RPM)),
+        "burst": int(os.getenv("AI_MEMORIES_BURST", DEFAULT_BURST)),
+        "concurrency": int(os.getenv("AI_MEMORIES_CONCURRENCY", DEFAULT_CONCURRENCY)),
+    }
+
+
+def limiter(api_key: str) -> Limiter:
+    """The shared limiter for an API key, created with the environment defaults on first use."""
+    with _limiters_lock:
+        found = _limiters.get(api_key)
+        if found is None:
+            found = _limiters[api_key] = Limiter(**_defaults())
+    return found
+
+
+def configure(api_key: str, rpm: float | None = None, burst: int | None = None,
+              concurrency: int | None = None) -> Limiter:
+    """Set one key's quota (e.g. a paid key next to free ones); omitted values keep their setting."""
+    found = limiter(api_key)
+    found.configure(
+        found.rpm if rpm is None else rpm,
+        found.burst if burst is None else burst,
+        found.concurrency if concurrency is None else concurrency,
+    )
+    return found
@@ -0,0 +1,141 @@
+"""
+response_cache.py
+-----------------
+Content-addressed cache for deterministic AI calls (knowledge-tag extraction).
+A response is stored under sha256(model, prompt version, input), so
+re-extracting an entry after a crash, a retry or during a backfill costs a
+lookup instead of a model call. The responses are derived from a user's
+entries, so each diary has its own cache file beside it
+(diaries/<slug>-<sha1>.cache.db), and it goes wherever the diary's files go.
+
+Entries expire after TTL_DAYS; when the cache grows past MAX_BYTES the least
+recently used responses are evicted. Hit/miss counters are kept per process.
+"""
+
+import hashlib
+import threading
+import time
+from pathlib import Path
+
+import memories_db as db
+
+CACHE_SUFFIX = ".cache.db"
+LEGACY_CACHE_FILENAME = "ai_cache.db"     # one cache shared by every user, before per-diary caches
+TTL_DAYS = 90
+MAX_BYTES = 50 * 1024 * 1024
+PRUNE_EVERY = 200       # puts between eviction passes
+
+_initialized: set[str] = set()
+_lock = threading.Lock()
+_counters = {"hits": 0, "misses": 0, "puts": 0}
+
+
+def cache_path(username: str | None = None) -> Path:
+    return db.diary_path(username).with_suffix(CACHE_SUFFIX)
+
+
+def _drop_legacy_cache():
+    """The old shared cache mixes every user's responses; it is only a cache, so delete it."""
+    legacy = Path(db.DB_PATH).with_name(LEGACY_CACHE_FILENAME)
+    for path in (legacy, legacy.with_name(legacy.name + "-wal"), legacy.with_name(legacy.name + "-shm")):
+        path.unlink(missing_ok=True)
+
+
+def _connection(username: str | None = None):
+    path = cache_path(username)
+    if str(path) not in _initialized:
+        if not _initialized:
+            _drop_legacy_cache()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with db.get_connection(path) as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_hit_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_responses_last_hit ON responses(last_hit_at);
+            """)
+        _initialized.add(str(path))
+    return db.get_connection(path)
+
+
+def make_key(model: str, prompt_version: str, payload: str) -> str:
+    h = hashlib.sha256()
+    for part in (model, prompt_version, payload):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def prompt_version(template: str) -> str:
+    """Version tag derived from the template text, so editing a prompt invalidates its entries."""
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()[:12]
+
+
+def get(key: str, username: str | None = None) -> str | None:
+    now = time.time()
+    with _connection(username) as conn:
+        row = conn.execute(
+            "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row and now - row["created_at"] <= TTL_DAYS * 86400:
+            conn.execute("UPDATE responses SET last_hit_at = ? WHERE key = ?", (now, key))
+            value = row["value"]
+        else:
+            value = None
+    with _lock:
+        _counters["hits" if value is not None else "misses"] += 1
+    return value
+
+
+def put(key: str, value: str, username: str | None = None):
+    now = time.time()
+    with _connection(username) as conn:
+        conn.execute(
+            "INSERT INTO responses (key, value, size, created_at, last_hit_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value, size = excluded.size, "
+            "created_at = excluded.created_at, last_hit_at = excluded.last_hit_at",
+            (key, value, len(value.encode("utf-8")), now, now)
+        )
+    with _lock:
+        _counters["puts"] += 1
+        due = _counters["puts"] % PRUNE_EVERY == 0
+    if due:
+        prune(username=username)
+
+
+def prune(max_bytes: int = MAX_BYTES, ttl_days: float = TTL_DAYS, username: str | None = None) -> int:
+    """Drop a diary's expired entries, then least recently used ones until under max_bytes."""
+    removed = 0
+    with _connection(username) as conn:
+        removed += conn.execute(
+            "DELETE FROM responses WHERE created_at < ?", (time.time() - ttl_days * 86400,)
+        ).rowcount
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) AS total FROM responses").fetchone()["total"]
+        if total > max_bytes:
+            cursor = conn.execute("SELECT key, size FROM responses ORDER BY last_hit_at ASC")
+            doomed = []
+            for row in cursor:
+                if total <= max_bytes:
+                    break
+                doomed.append((row["key"],))
+                total -= row["size"]
+            conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+            removed += len(doomed)
+    return removed
+
+
+def stats(username: str | None = None) -> dict:
+    """Process counters plus the current number and size of a diary's cached responses."""
+    with _connection(username) as conn:
+        row = conn.execute(
+            "SELECT COUNT(*) AS entries, COALESCE(SUM(size), 0) AS bytes FROM responses"
+        ).fetchone()
+    with _lock:
+        counters = dict(_counters)
+    lookups = counters["hits"] + counters["misses"]
+    counters["hit_rate"] = counters["hits"] / lookups if lookups else 0.0
+    return {**counters, "entries": row["entries"], "bytes": row["bytes"]}
@@ -0,0 +1,171 @@
+"""
+tag_worker.py
+-------------
+Background worker pool that drains the extraction_jobs queue in memories_db.
+Workers claim several jobs at once and ask Gemini for their knowledge graph
+tags in one batched request (ai_engine.extract_knowledge_tags_batch); failed
+attempts are rescheduled with exponential backoff by memories_db, so an entry
+whose extraction hit a timeout or rate limit is picked up again later instead
+of losing its tags.
+
+Workers outlive a Streamlit rerun (imported modules are kept), so saving an
+entry only enqueues a job and wakes them up. Each user's diary has its own
+queue, so there is one pool per diary; it uses the API key it was last given,
+read afresh for every batch. A pool that finds nothing to do for POOL_IDLE_S
+stops, and at most MAX_POOLS run at once (the least recently used is stopped
+first); the next ensure_started for that diary starts a new one.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import memories_db as db
+import ai_engine as ai
+
+WORKER_COUNT = 2
+IDLE_POLL_S = 30.0
+POOL_IDLE_S = 600.0     # a pool with nothing to do for this long stops
+MAX_POOLS = 16
+CLAIM_BATCH = ai.BATCH_MAX_ENTRIES     # jobs per claim, extracted with one model call
+
+
+def process_due_jobs(api_key: str, username: str | None = None, limit: int = CLAIM_BATCH) -> int:
+    """
+    Claim up to `limit` due jobs, extract their tags with one batched request
+    and store the outcome; an entry that could not be extracted or stored is
+    rescheduled with fail_extraction_job. Returns the number of jobs handled (0: none due).
+    """
+    jobs = db.claim_extraction_jobs(limit=limit, username=username)
+    if not jobs:
+        return 0
+    tags, errors = ai.extract_knowledge_tags_batch(
+        api_key, [(job["entry_id"], job["content"]) for job in jobs], username
+    )
+    errors.update(db.complete_extraction_jobs(tags, username=username))
+    for entry_id, error in errors.items():
+        db.fail_extraction_job(entry_id, error, username=username)
+    return len(jobs)
+
+
+class ExtractionWorkerPool:
+    """A fixed set of daemon threads extracting tags for one diary with its current API key."""
+
+    def __init__(self, api_key: str, username: str | None = None, workers: int = WORKER_COUNT):
+        self.api_key = api_key
+        self.username = username
+        self.stopped = False
+        self._last_active = time.monotonic()
+        self._wake = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._run, name=f"tag-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def wake(self):
+        """Tell idle workers that a new job was enqueued."""
+        self._wake.set()
+
+    def stop(self):
+        """Let the workers exit once their current batch is stored."""
+        self.stopped = True
+        self._wake.set()
+
+    def _touch(self):
+        self._last_active = time.monotonic()
+
+    def _run(self):
+        while not self.stopped:
+            try:
+                handled = process_due_jobs(self.api_key, self.username)
+            except Exception:
+                handled = 0     # e.g. database busy; try again after a pause
+            if handled:
+                self._touch()
+            elif not self._stop_if_idle():
+                self._sleep()
+
+    def _stop_if_idle(self) -> bool:
+        with _pools_lock:
+            if time.monotonic() - self._last_active < POOL_IDLE_S:
+                return self.stopped
+            self.stop()
+            if _pools.get(self.username) is self:
+                del _pools[self.username]
+        return True
+
+    def _sleep(self):
+        try:
+            due_in = db.seconds_until_next_extraction(username=self.username)
+        except Exception:
+            due_in = None
+        timeout = IDLE_POLL_S if due_in is None else min(due_in, IDLE_POLL_S)
+        self._wake.wait(timeout=max(timeout, 0.1))
+        if not self.stopped:
+            self._wake.clear()
+
+
+_pools: OrderedDict[str | None, ExtractionWorkerPool] = OrderedDict()
+_pools_lock = threading.Lock()
+
+
+def ensure_started(api_key: str, username: str | None = None) -> ExtractionWorkerPool:
+    """
+    Return the worker pool for this diary, starting it on first use. A new API
+    key replaces the pool's old one, and jobs the old key failed are retried now.
+    """
+    with _pools_lock:
+        pool = _pools.get(username)
+        if pool is None or pool.stopped:
+            pool = _pools[username] = ExtractionWorkerPool(api_key, username)
+            while len(_pools) > MAX_POOLS:
+                _pools.popitem(last=False)[1].stop()
+            replaced = False
+        else:
+            replaced = pool.api_key != api_key
+            pool.api_key = api_key
+        _pools.move_to_end(username)
+        pool._touch()
+    if replaced:
+        db.retry_extraction_jobs_now(username=username)
+        pool.wake()
+    return pool
+
+
+def submit(api_key: str, entry_id: int, username: str | None = None):
+    """Queue extraction for a saved entry and wake the workers."""
+    db.enqueue_extraction(entry_id, username=username)
+    ensure_started(api_key, username).wake()
+
+
+def drain(
+    api_key: str,
+    username: str | None = None,
+    workers: int = WORKER_COUNT,
+    on_progress: Callable[[int], None] | None = None,
+) -> int:
+    """
+    Work through every job that is due now with `workers` threads and return
+    how many were handled. Used by one-off runs such as importer.py; jobs left
+    waiting on a retry backoff are picked up later by the background pool.
+    """
+    handled = 0
+    lock = threading.Lock()
+
+    def work():
+        nonlocal handled
+        while n := process_due_jobs(api_key, username):
+            with lock:
+                handled += n
+                total = handled
+            if on_progress:
+                on_progress(total)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(work) for _ in range(workers)]:
+            future.result()
+    return handled
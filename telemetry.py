@@ -0,0 +1,266 @@
+"""
+telemetry.py
+------------
+Opt-in timing spans for AI of Memories.
+
+When enabled, every function defined in the instrumented modules (memories_db,
+ai_engine, prompt_builder, response_cache, tag_worker) is wrapped in a span,
+except a few per-row helpers. Generators, such as the streamed replies, are
+timed until they are exhausted. SQL statements are counted through SQLite's
+trace hook. Spans feed three outputs:
+
+  - per-process aggregates (count, sum and histogram buckets per span), which
+    write_prometheus() dumps in the Prometheus text format;
+  - one JSON log line per span on the "ai_memories.telemetry" logger;
+  - the Rerun record of the current thread, which app.py shows in its debug
+    panel: a breakdown of one Streamlit rerun, its query count and prompt
+    token sizes.
+
+When disabled nothing is wrapped, so the only cost left is a flag check when
+a connection is borrowed and when a prompt is built.
+
+Environment:
+  AI_MEMORIES_TELEMETRY=1          enable via enable_from_env() (app.py calls it)
+  AI_MEMORIES_TELEMETRY_LOG=path   also append the JSON log lines to this file
+  AI_MEMORIES_TELEMETRY_PROM=path  rewrite this Prometheus text file after each rerun
+"""
+
+import functools
+import importlib
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+ENABLE_ENV = "AI_MEMORIES_TELEMETRY"
+INSTRUMENTED_MODULES = ("memories_db", "ai_engine", "prompt_builder", "response_cache", "tag_worker")
+# Called once per row or item; a span each would cost more than the work
+HOT_HELPERS = {
+    "memories_db._epoch",
+    "memories_db.normalize_tag_value",
+    "memories_db.diary_path",
+    "memories_db._alias_entity_id",
+    "memories_db._fuzzy_entity_id",
+    "memories_db._resolve_entity",
+    "memories_db._edge_decay",
+    "memories_db._iso_week",
+    "memories_db._rollup_period",
+    "prompt_builder.estimate_tokens",
+    "prompt_builder.format_entry",
+    "prompt_builder._knowledge_score",
+}
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger("ai_memories.telemetry")
+
+enabled = False
+_originals: dict[tuple[str, str], object] = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+# span name -> [count, sum_seconds, bucket counts...]
+_metrics: dict[str, list] = {}
+_queries_total = 0
+
+
+# ── Per-rerun records ─────────────────────────────────────────────────────────
+
+class Rerun:
+    """Spans, SQL statement count and notes collected on one thread between begin_rerun calls."""
+
+    def __init__(self, label: str = ""):
+        self.label = label
+        self.started = time.time()
+        self.spans: list[tuple[str, float, int]] = []     # (name, seconds, depth)
+        self.queries = 0
+        self.notes: dict[str, object] = {}
+
+    def breakdown(self, top_level_only: bool = False) -> list[dict]:
+        """Calls and total milliseconds per span name, slowest first."""
+        rows: dict[str, dict] = {}
+        for name, seconds, depth in self.spans:
+            if top_level_only and depth:
+                continue
+            row = rows.setdefault(name, {"span": name, "calls": 0, "ms": 0.0})
+            row["calls"] += 1
+            row["ms"] += seconds * 1000
+        return sorted(rows.values(), key=lambda r: -r["ms"])
+
+    def total_ms(self) -> float:
+        return sum(seconds for _, seconds, depth in self.spans if depth == 0) * 1000
+
+
+def begin_rerun(label: str = "") -> Rerun:
+    """Start collecting this thread's spans into a fresh Rerun (and flush the Prometheus file)."""
+    run = Rerun(label)
+    _local.run = run
+    _local.depth = 0
+    path = os.getenv("AI_MEMORIES_TELEMETRY_PROM")
+    if enabled and path:
+        write_prometheus(path)
+    return run
+
+
+def note(key: str, value):
+    """Attach a value (e.g. prompt token sizes) to the current thread's Rerun."""
+    if enabled:
+        run = getattr(_local, "run", None)
+        if run is not None:
+            run.notes[key] = value
+
+
+def on_query(statement: str):
+    """sqlite3 trace callback: count one executed statement."""
+    global _queries_total
+    with _lock:
+        _queries_total += 1
+    run = getattr(_local, "run", None)
+    if run is not None:
+        run.queries += 1
+
+
+# ── Spans ─────────────────────────────────────────────────────────────────────
+
+def _record(name: str, seconds: float, depth: int):
+    with _lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = [0, 0.0] + [0] * len(BUCKETS)
+        metric[0] += 1
+        metric[1] += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                metric[2 + i] += 1
+    run = getattr(_local, "run", None)
+    if run is not None:
+        run.spans.append((name, seconds, depth))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps({"span": name, "ms": round(seconds * 1000, 3), "depth": depth,
+                                 "thread": threading.current_thread().name}))
+
+
+def _wrap(name: str, fn):
+    if inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def generator_wrapper(*args, **kwargs):
+            # Only the time spent producing items counts as nested work; while
+            # the consumer holds a chunk, the depth is back to the caller's.
+            gen = fn(*args, **kwargs)
+            depth = getattr(_local, "depth", 0)
+            start = time.perf_counter()
+            try:
+                while True:
+                    _local.depth = depth + 1
+                    try:
+                        item = next(gen)
+                    except StopIteration as stop:
+                        return stop.value
+                    finally:
+                        _local.depth = depth
+                    yield item
+            finally:
+                gen.close()
+                _record(name, time.perf_counter() - start, depth)
+        return generator_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        depth = getattr(_local, "depth", 0)
+        _local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.depth = depth
+            _record(name, time.perf_counter() - start, depth)
+    return wrapper
+
+
+def _instrumentable(module_name: str, attr: str, value) -> bool:
+    if not inspect.isfunction(value) or value.__module__ != module_name:
+        return False
+    if f"{module_name}.{attr}" in HOT_HELPERS:
+        return False
+    # @contextmanager functions: a span would only time building the manager
+    return not inspect.isgeneratorfunction(getattr(value, "__wrapped__", None))
+
+
+def enable():
+    """Wrap the instrumented modules' functions in spans."""
+    global enabled
+    with _lock:
+        if enabled:
+            return
+        enabled = True
+    log_path = os.getenv("AI_MEMORIES_TELEMETRY_LOG")
+    if log_path and not any(getattr(h, "_telemetry", False) for h in logger.handlers):
+        handler = logging.FileHandler(log_path, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        handler._telemetry = True
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+    for module_name in INSTRUMENTED_MODULES:
+        module = importlib.import_module(module_name)
+        for attr, value in list(vars(module).items()):
+            if _instrumentable(module_name, attr, value):
+                _originals[(module_name, attr)] = value
+                setattr(module, attr, _wrap(f"{module_name}.{attr}", value))
+
+
+def disable():
+    """Put the original functions back."""
+    global enabled
+    with _lock:
+        if not enabled:
+            return
+        enabled = False
+    for (module_name, attr), fn in _originals.items():
+        setattr(importlib.import_module(module_name), attr, fn)
+    _originals.clear()
+
+
+def enable_from_env():
+    if os.getenv(ENABLE_ENV, "").lower() in ("1", "true", "yes"):
+        enable()
+
+
+# ── Prometheus export ─────────────────────────────────────────────────────────
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def prometheus_text() -> str:
+    """All span aggregates and the SQL statement counter in the Prometheus text format."""
+    with _lock:
+        metrics = {name: list(values) for name, values in _metrics.items()}
+        queries = _queries_total
+    lines = [
+        "# HELP ai_memories_span_seconds Time spent in instrumented functions.",
+        "# TYPE ai_memories_span_seconds histogram",
+    ]
+    for name in sorted(metrics):
+        count, total, *buckets = metrics[name]
+        span = _label(name)
+        for bound, n in zip(BUCKETS, buckets):
+            lines.append(f'ai_memories_span_seconds_bucket{{span="{span}",le="{bound}"}} {n}')
+        lines.append(f'ai_memories_span_seconds_bucket{{span="{span}",le="+Inf"}} {count}')
+        lines.append(f'ai_memories_span_seconds_sum{{span="{span}"}} {total:.6f}')
+        lines.append(f'ai_memories_span_seconds_count{{span="{span}"}} {count}')
+    lines += [
+        "# HELP ai_memories_sql_queries_total SQL statements executed.",
+        "# TYPE ai_memories_sql_queries_total counter",
+        f"ai_memories_sql_queries_total {queries}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path):
+    """Atomically rewrite `path` with prometheus_text() (for a node_exporter textfile collector)."""
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(prometheus_text(), encoding="utf-8")
+    os.replace(tmp, path)
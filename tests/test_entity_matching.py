@@ -0,0 +1,160 @@
+"""
+test_entity_matching.py
+-----------------------
+Which spellings become one canonical entity: fold_key, the fuzzy match
+(Dice score plus words_agree) and migration 8, which re-keys diaries written
+under the older, looser rules.
+
+Run with:  python -m pytest -q tests
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import entity_index  # noqa: E402
+import memories_db as db  # noqa: E402
+
+
+def _best_match(known: str, query: str):
+    index = entity_index.TrigramIndex()
+    index.add(entity_index.fold_key(known), 1)
+    return index.best_match(entity_index.fold_key(query))
+
+
+@pytest.mark.parametrize("a, b", [
+    ("Lucía Gómez", "lucia gomez"),
+    ("  MAMÁ ", "mamá"),
+    ("mi madre", "Madre"),
+    ("my mom", "mom"),
+    ("Nuestra casa", "casa"),
+])
+def test_same_key(a, b):
+    assert entity_index.fold_key(a) == entity_index.fold_key(b)
+
+
+@pytest.mark.parametrize("a, b", [
+    ("su madre", "madre"),
+    ("her mom", "mom"),
+    ("tu hermano", "hermano"),
+])
+def test_other_peoples_relatives_keep_their_possessive(a, b):
+    assert entity_index.fold_key(a) != entity_index.fold_key(b)
+
+
+@pytest.mark.parametrize("known, typo", [
+    ("Lucía Gómez", "Lucia Gomes"),         # accents and one letter
+    ("Pedro Sánchez", "Pedro Sanchex"),
+    ("Universidad Complutense", "Universidad Compultense"),     # adjacent letters swapped
+])
+def test_one_letter_typo_matches(known, typo):
+    assert _best_match(known, typo)[0] == 1
+
+
+@pytest.mark.parametrize("known, other", [
+    ("Ana María", "Ana"),                   # a different word count is a different name
+    ("Jorge Pérez", "Jorge Pérez Gil"),
+    ("Ana María", "Ana Marina"),
+    ("Colegio San José", "Colegio San Jorge"),
+    ("Calle Mayor 12", "Calle Mayor 14"),   # numbers must match exactly
+    ("Mario Ruiz", "María Ruiz"),           # vowel for vowel: another name
+    ("Pedro Sánchez", "Pablo Sánchez"),     # shared surname, different people
+    ("Ana Gómez", "Eva Gómez"),
+    ("Lucía Gómez", "Lucía Gómez Pérez"),
+])
+def test_different_names_do_not_match(known, other):
+    assert _best_match(known, other) is None
+
+
+# ── Migration 8 ───────────────────────────────────────────────────────────────
+
+@pytest.fixture
+def v7_diary(tmp_path, monkeypatch):
+    """A diary at schema version 7, before the stricter matching."""
+    path = tmp_path / "memories.db"
+    monkeypatch.setattr(db, "DB_PATH", path)
+    with monkeypatch.context() as m:
+        m.setattr(db, "MIGRATIONS", db.MIGRATIONS[:7])
+        with db.get_connection(path) as conn:
+            db._migrate(conn)
+    return path
+
+
+def _write_v7(path, entries: list[list[tuple[str, int]]], entities: dict[int, str], aliases: list[tuple]):
+    """Entries as (tag value, entity id) mentions, plus the entities and aliases the old rules produced."""
+    with db.get_connection(path) as conn:
+        conn.executemany(
+            "INSERT INTO entities (id, tag_type, name, first_seen, last_seen) VALUES (?, 'Entity', ?, ?, ?)",
+            [(entity_id, name, "2024-01-01T10:00:00", "2024-01-01T10:00:00") for entity_id, name in entities.items()]
+        )
+        conn.executemany(
+            "INSERT INTO entity_aliases (tag_type, alias_key, entity_id, alias) VALUES ('Entity', ?, ?, ?)",
+            aliases
+        )
+        for day, mentions in enumerate(entries, start=1):
+            created_at = f"2024-01-{day:02d}T10:00:00"
+            entry_id = conn.execute(
+                "INSERT INTO journal_entries (content, created_at, created_ts) VALUES ('x', ?, iso_epoch(?))",
+                (created_at, created_at)
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO knowledge_graph (entry_id, tag_type, tag_value, created_at, created_ts, entity_id) "
+                "VALUES (?, 'Entity', ?, ?, iso_epoch(?), ?)",
+                [(entry_id, value, created_at, created_at, entity_id) for value, entity_id in mentions]
+            )
+
+
+def test_upgrade_splits_names_merged_by_the_old_rules(v7_diary):
+    _write_v7(
+        v7_diary,
+        entries=[
+            [("Ana María", 1), ("Mamá", 2), ("Calle Mayor 12", 3), ("Lucía Gómez", 4)],
+            [("Ana Marina", 1), ("su madre", 2), ("Calle Mayor 14", 3), ("Lucia Gomes", 4)],
+            [("mi madre", 2), ("Ana María", 1)],
+        ],
+        entities={1: "Ana María", 2: "Mamá", 3: "Calle Mayor 12", 4: "Lucía Gómez"},
+        aliases=[
+            ("ana maria", 1, "Ana María"), ("mama", 2, "Mamá"), ("calle mayor 12", 3, "Calle Mayor 12"),
+            ("lucia gomez", 4, "Lucía Gómez"),
+            ("ana marina", 1, "Ana Marina"),        # fuzzy match the new rules reject
+            ("madre", 2, "su madre"),               # possessive dropped, then merged by hand
+            ("calle mayor 14", 3, "Calle Mayor 14"),
+            ("lucia gomes", 4, "Lucia Gomes"),      # a real typo
+        ],
+    )
+    db.init_db(v7_diary)
+
+    with db.get_connection() as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == db.SCHEMA_VERSION
+        counts = {row["name"]: row["mention_count"] for row in conn.execute("SELECT * FROM entities")}
+        unresolved = conn.execute("SELECT COUNT(*) FROM knowledge_graph WHERE entity_id IS NULL").fetchone()[0]
+        month = conn.execute(
+            "SELECT SUM(mentions) FROM entity_periods WHERE grain = 'month' AND period = '2024-01'"
+        ).fetchone()[0]
+    assert counts == {
+        "Ana María": 2, "Ana Marina": 1,
+        "Calle Mayor 12": 1, "Calle Mayor 14": 1,
+        "Lucía Gómez": 2,
+        "Mamá": 3,
+    }
+    assert unresolved == 0
+    assert month == 10
+    assert db.find_entity("Lucia Gomes")["name"] == "Lucía Gómez"
+    assert db.find_entity("mi madre")["name"] == "Mamá"        # the user's own link survives
+
+
+def test_upgrade_leaves_a_diary_without_near_duplicates_alone(v7_diary):
+    _write_v7(
+        v7_diary,
+        entries=[[("Marta", 1), ("Lisboa", 2)], [("marta", 1)]],
+        entities={1: "Marta", 2: "Lisboa"},
+        aliases=[("marta", 1, "Marta"), ("lisboa", 2, "Lisboa")],
+    )
+    db.init_db(v7_diary)
+
+    with db.get_connection() as conn:
+        rows = [tuple(row) for row in conn.execute("SELECT id, name, mention_count FROM entities ORDER BY id")]
+    assert rows == [(1, "Marta", 2), (2, "Lisboa", 1)]
@@ -0,0 +1,125 @@
+"""
+test_knowledge_rollups.py
+-------------------------
+get_knowledge_items(as_of=...) and the timeline read the year/month/week/day
+rollups (entity_periods, tag_periods) instead of knowledge_graph. These tests
+build a diary spanning several years, change it the ways the app does (new
+tags, merges, a full rebuild) and check every answer against a direct query
+over the raw mentions.
+
+Run with:  python -m pytest -q tests
+"""
+
+import random
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import memories_db as db  # noqa: E402
+
+TAGS = [
+    ("Entity", "Marta"), ("Entity", "Marta Ruiz"), ("Entity", "Mamá"),
+    ("Place", "Lisboa"), ("Place", "Oporto"), ("Emotion", "cansancio"), ("Event", "mudanza"),
+]
+AS_OF = ["2022-01-01", "2023-11-30", "2023-12-31", "2024-01-01", "2024-02-29", "2024-12-30", "2025-03-01"]
+
+
+@pytest.fixture
+def diary(tmp_path, monkeypatch):
+    """About 200 entries from late 2023 to early 2025, across year and ISO-week boundaries."""
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "memories.db")
+    rng = random.Random(7)
+    day = datetime(2023, 11, 20, 9, 30)
+    records = []
+    while day < datetime(2025, 2, 10):
+        records.append({
+            "content": f"Entrada del {day:%d/%m/%Y}",
+            "created_at": day.isoformat(),
+            "tags": [{"type": t, "value": v} for t, v in rng.sample(TAGS, rng.randint(1, 3))],
+        })
+        day += timedelta(days=rng.randint(1, 3), hours=rng.randint(0, 5))
+    db.import_entries(records)
+    return tmp_path
+
+
+def _expected_items(as_of: str) -> dict[int, tuple]:
+    """(mentions, first seen, last seen) per entity, counted straight from knowledge_graph."""
+    end = f"{as_of}T23:59:59.999999"
+    with db.get_connection() as conn:
+        rows = conn.execute(
+            """SELECT entity_id, COUNT(*), MIN(created_at), MAX(created_at) FROM knowledge_graph
+               WHERE created_at <= ? AND entity_id IS NOT NULL GROUP BY entity_id""",
+            (end,)
+        ).fetchall()
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+
+def _check_as_of():
+    for as_of in AS_OF:
+        items = db.get_knowledge_items(candidates=1000, as_of=as_of)
+        got = {it["entity_id"]: (it["mention_count"], it["first_seen"], it["last_seen"]) for it in items}
+        assert got == _expected_items(as_of), as_of
+
+
+def _check_periods():
+    with db.get_connection() as conn:
+        mentions = conn.execute(
+            "SELECT entity_id, tag_type, created_at FROM knowledge_graph WHERE entity_id IS NOT NULL"
+        ).fetchall()
+        for grain, period_of in db.ROLLUP_GRAINS.items():
+            expected_entities: dict[tuple, int] = {}
+            expected_types: dict[tuple, int] = {}
+            for row in mentions:
+                period = period_of(row["created_at"])
+                expected_entities[(period, row["entity_id"])] = expected_entities.get((period, row["entity_id"]), 0) + 1
+                expected_types[(period, row["tag_type"])] = expected_types.get((period, row["tag_type"]), 0) + 1
+            entities = {(r[0], r[1]): r[2] for r in conn.execute(
+                "SELECT period, entity_id, mentions FROM entity_periods WHERE grain = ?", (grain,)
+            )}
+            types = {(r[0], r[1]): r[2] for r in conn.execute(
+                "SELECT period, tag_type, mentions FROM tag_periods WHERE grain = ?", (grain,)
+            )}
+            assert entities == expected_entities, grain
+            assert types == expected_types, grain
+
+
+def test_rollups_match_the_raw_mentions(diary):
+    _check_as_of()
+    _check_periods()
+
+
+def test_rollups_follow_new_tags_and_merges(diary):
+    _, last = db.import_entries([
+        {"content": "Fin de año", "created_at": "2024-12-31T23:30:00",
+         "tags": [{"type": "Place", "value": "Oporto"}]},
+        {"content": "Año nuevo", "created_at": "2025-01-01T00:15:00", "tags": []},
+    ])
+    db.save_tags(last, [{"type": "Place", "value": "Lisboa"}, {"type": "Entity", "value": "Marta"}])
+    _check_as_of()
+    _check_periods()
+
+    lisboa, oporto = db.find_entity("Lisboa", "Place"), db.find_entity("Oporto", "Place")
+    marta, marta_ruiz = db.find_entity("Marta"), db.find_entity("Marta Ruiz")
+    db.merge_entities(oporto["id"], lisboa["id"])
+    db.merge_entities(marta_ruiz["id"], marta["id"])
+    assert db.find_entity("Oporto", "Place")["id"] == lisboa["id"]
+    _check_as_of()
+    _check_periods()
+
+    db.rebuild_knowledge_summary()
+    _check_as_of()
+    _check_periods()
+
+
+def test_timeline_totals_match_the_raw_mentions(diary):
+    with db.get_connection() as conn:
+        expected = {row[0]: row[1] for row in conn.execute(
+            "SELECT substr(created_at, 1, 7), COUNT(*) FROM knowledge_graph "
+            "WHERE entity_id IS NOT NULL GROUP BY 1"
+        )}
+    timeline = db.get_timeline("month", start="2023-01-01", end="2025-12-31")
+    assert {bucket["period"]: bucket["total"] for bucket in timeline if bucket["total"]} == expected
@@ -0,0 +1,165 @@
+"""
+test_rate_limit.py
+------------------
+Limiter scheduling: interactive requests overtake queued background work,
+background work never takes the reserved slots, and rate-limit errors pause
+the key for their retry-after delay and slow its refill. Time comes from a
+fake clock, so every wait is decided by the test, not by the machine.
+
+Run with:  python -m pytest -q tests
+"""
+
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import rate_limit  # noqa: E402
+from rate_limit import BACKGROUND, INTERACTIVE, Limiter  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float, limiter: Limiter):
+        """Move time forward and let waiting threads look at the clock again."""
+        self.now += seconds
+        with limiter._cond:
+            limiter._cond.notify_all()
+
+
+class RateLimited(Exception):
+    code = 429
+
+
+def _wait_until(predicate, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def _queue(limiter: Limiter, priority: int, order: list, name: str) -> threading.Thread:
+    """Start a thread that takes a slot, records `name` and gives the slot back."""
+    waiting = limiter.stats()["waiting"]
+
+    def run():
+        with limiter.slot(priority):
+            order.append(name)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    _wait_until(lambda: limiter.stats()["waiting"] == waiting + 1)
+    return thread
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_interactive_overtakes_queued_background_work(clock):
+    limiter = Limiter(rpm=0, concurrency=1, clock=clock)
+    limiter.acquire(INTERACTIVE)
+    order: list[str] = []
+    threads = [
+        _queue(limiter, BACKGROUND, order, "tags 1"),
+        _queue(limiter, BACKGROUND, order, "tags 2"),
+        _queue(limiter, INTERACTIVE, order, "reply"),
+    ]
+    limiter.release()
+    for thread in threads:
+        thread.join(5)
+    assert order == ["reply", "tags 1", "tags 2"]
+
+
+def test_background_work_leaves_the_reserved_slot_free(clock):
+    limiter = Limiter(rpm=0, concurrency=1 + rate_limit.RESERVED_SLOTS, clock=clock)
+    limiter.acquire(BACKGROUND)
+    order: list[str] = []
+    background = _queue(limiter, BACKGROUND, order, "tags")
+    limiter.acquire(INTERACTIVE)        # takes the reserved slot at once
+    assert order == [] and limiter.stats()["active"] == 2
+
+    limiter.release()
+    assert limiter.stats()["waiting"] == 1      # a reserved slot is not a background one
+    limiter.release()
+    background.join(5)
+    assert order == ["tags"]
+
+
+def test_burst_then_refill(clock):
+    limiter = Limiter(rpm=60, burst=2, concurrency=4, clock=clock)
+    for _ in range(2):
+        with limiter.slot(BACKGROUND):
+            pass
+    order: list[str] = []
+    waiting = _queue(limiter, BACKGROUND, order, "third")
+    clock.advance(0.5, limiter)
+    time.sleep(0.01)
+    assert order == []
+    clock.advance(0.5, limiter)        # one request per second at 60 rpm
+    waiting.join(5)
+    assert order == ["third"]
+
+
+def test_retry_after_pauses_the_key_and_halves_the_rate(clock):
+    limiter = Limiter(rpm=60, burst=5, concurrency=4, clock=clock)
+    with pytest.raises(RateLimited):
+        with limiter.slot(INTERACTIVE):
+            raise RateLimited("429 Quota exceeded. Please retry in 7s.")
+    assert limiter.blocked_for() == 7
+    assert limiter.stats()["current_rpm"] == 30
+    assert limiter.throttled == 1
+
+    order: list[str] = []
+    waiting = _queue(limiter, INTERACTIVE, order, "reply")
+    clock.advance(6, limiter)
+    time.sleep(0.01)
+    assert order == []          # even interactive requests wait out the pause
+    clock.advance(1, limiter)
+    waiting.join(5)
+    assert order == ["reply"]
+    assert limiter.stats()["current_rpm"] == 33     # each success gives back RECOVERY_SHARE
+
+
+def test_backoff_without_retry_after_doubles_and_resets(clock):
+    limiter = Limiter(rpm=60, burst=5, concurrency=4, clock=clock)
+    for expected in (1, 2, 4):
+        limiter.acquire(BACKGROUND)
+        limiter.release(RateLimited("429 Too Many Requests"))
+        assert limiter.blocked_for() == expected
+        clock.advance(60, limiter)      # past the pause, with the bucket refilled
+    assert limiter.stats()["current_rpm"] == 60 * rate_limit.MIN_RATE_SHARE
+
+    limiter.acquire(BACKGROUND)
+    limiter.release()
+    limiter.acquire(BACKGROUND)
+    limiter.release(RateLimited("429"))
+    assert limiter.blocked_for() == 1       # a success resets the backoff
+
+
+def test_other_errors_do_not_throttle(clock):
+    limiter = Limiter(rpm=60, burst=5, concurrency=4, clock=clock)
+    with pytest.raises(ValueError):
+        with limiter.slot(BACKGROUND):
+            raise ValueError("bad JSON")
+    assert limiter.blocked_for() == 0
+    assert limiter.stats()["current_rpm"] == 60
+
+
+@pytest.mark.parametrize("message, delay", [
+    ("429 Resource exhausted. retry_delay { seconds: 12 }", 12),
+    ("Quota exceeded, please retry in 3.5s", 3.5),
+    ("503 Service Unavailable; Retry-After: 20", 20),
+    ("429 Too Many Requests", None),
+])
+def test_retry_after_parsing(message, delay):
+    assert rate_limit.retry_after(RateLimited(message)) == delay
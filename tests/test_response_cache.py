@@ -0,0 +1,46 @@
+"""
+test_response_cache.py
+----------------------
+Cached model responses are derived from a user's entries, so each diary keeps
+its own cache file and one user's answers are never served to another.
+
+Run with:  python -m pytest -q tests
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import memories_db as db  # noqa: E402
+import response_cache  # noqa: E402
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "memories.db")
+    return tmp_path
+
+
+def test_each_diary_has_its_own_cache(data_dir):
+    key = response_cache.make_key("model", "v1", "Hoy vi a Marta.")
+    response_cache.put(key, '[{"type": "Entity", "value": "Marta"}]', username="ana")
+
+    assert response_cache.get(key, username="ana") is not None
+    assert response_cache.get(key, username="luis") is None
+    assert response_cache.get(key) is None
+    ana = response_cache.cache_path("ana")
+    assert ana.parent == db.diary_path("ana").parent
+    assert ana.name == db.diary_path("ana").with_suffix(".cache.db").name
+
+
+def test_the_shared_legacy_cache_is_dropped(data_dir, monkeypatch):
+    monkeypatch.setattr(response_cache, "_initialized", set())
+    legacy = data_dir / response_cache.LEGACY_CACHE_FILENAME
+    legacy.write_bytes(b"responses from every user")
+
+    response_cache.get("any key", username="ana")
+
+    assert not legacy.exists()
@@ -0,0 +1,101 @@
+"""
+test_tag_validation.py
+----------------------
+Malformed knowledge tags from the model must neither reach the database nor
+the response cache, and an entry whose tags cannot be stored must go back to
+the queue instead of leaving its job running until the lease expires.
+
+Run with:  python -m pytest -q tests
+"""
+
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import fake_gemini  # noqa: E402
+import memories_db as db  # noqa: E402
+import ai_engine as ai  # noqa: E402
+import response_cache  # noqa: E402
+import tag_worker  # noqa: E402
+
+
+@pytest.fixture
+def diary(tmp_path, monkeypatch):
+    monkeypatch.setenv(ai.FAKE_MODEL_ENV, "1")
+    monkeypatch.delenv(ai.BACKEND_ENV, raising=False)
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "memories.db")
+    db.init_db()
+    return tmp_path
+
+
+def _answer_with(monkeypatch, batch: dict, single: list):
+    """Make the fake model answer every batch request with `batch` and every single one with `single`."""
+    def generate_content(self, contents, stream=False, **kwargs):
+        prompt = fake_gemini._last_text(contents)
+        answer = batch if "Journal entries:" in prompt else single
+        return fake_gemini.FakeResponse(json.dumps(answer))
+    monkeypatch.setattr(fake_gemini.FakeGenerativeModel, "generate_content", generate_content)
+
+
+def _jobs() -> dict[int, dict]:
+    with db.get_connection() as conn:
+        return {row["entry_id"]: dict(row) for row in conn.execute("SELECT * FROM extraction_jobs")}
+
+
+def _queue(*texts: str) -> list[int]:
+    ids = [db.save_entry(text) for text in texts]
+    for entry_id in ids:
+        db.enqueue_extraction(entry_id)
+    return ids
+
+
+def test_malformed_tags_are_dropped_before_storing_and_caching(diary, monkeypatch):
+    first, second = _queue("Comí con Marta.", "Viajé a Lisboa.")
+    _answer_with(
+        monkeypatch,
+        batch={
+            str(first): [{"type": "Entity", "value": "Marta"}, {"type": None, "value": "x"},
+                         {"type": "Number", "value": 7}, {"type": "Entity"}, "Lisboa", None],
+            str(second): "Lisboa",      # not a list: retried on its own
+        },
+        single=[None, 3, {"type": "Place", "value": "Lisboa"}, {"type": "", "value": "Oporto"}],
+    )
+
+    assert tag_worker.process_due_jobs("test-key") == 2
+
+    assert {job["status"] for job in _jobs().values()} == {"done"}
+    assert sorted((t["tag_type"], t["tag_value"]) for t in db.get_all_tags()) == [
+        ("Entity", "Marta"), ("Number", "7"), ("Place", "Lisboa"),
+    ]
+    with db.get_connection(response_cache.cache_path()) as conn:
+        cached = [json.loads(row["value"]) for row in conn.execute("SELECT value FROM responses")]
+    assert sorted(cached, key=len) == [
+        [{"type": "Place", "value": "Lisboa"}],
+        [{"type": "Entity", "value": "Marta"}, {"type": "Number", "value": "7"}],
+    ]
+
+
+def test_entry_that_cannot_be_stored_is_rescheduled(diary, monkeypatch):
+    good, bad = _queue("Comí con Marta.", "Viajé a Lisboa.")
+    save_tags_many = db.save_tags_many
+
+    def failing_save(tags_by_entry, username=None):
+        if bad in tags_by_entry:
+            raise TypeError("cannot store these tags")
+        save_tags_many(tags_by_entry, username)
+    monkeypatch.setattr(db, "save_tags_many", failing_save)
+
+    assert tag_worker.process_due_jobs("test-key") == 2
+
+    jobs = _jobs()
+    assert jobs[good]["status"] == "done"
+    assert jobs[bad]["status"] == "pending"
+    assert jobs[bad]["attempts"] == 1
+    assert "cannot store these tags" in jobs[bad]["last_error"]
+    with db.get_connection() as conn:
+        tagged = {row["entry_id"] for row in conn.execute("SELECT entry_id FROM knowledge_graph")}
+    assert tagged == {good}